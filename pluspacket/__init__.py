@@ -1,5 +1,52 @@
 from pluspacket.packet import *
 
+
+# Everything but the core parser is imported on first use so that short
+# lived tools only pay for what they touch.
+_submodules = (
+	"anonymize",
+	"archive",
+	"batch",
+	"checkpoint",
+	"cli",
+	"correlate",
+	"decap",
+	"export",
+	"flows",
+	"generator",
+	"index",
+	"ingest",
+	"metrics",
+	"parallel",
+	"pcap",
+	"pipeline",
+	"proxy",
+	"reassembly",
+	"replay",
+	"rollup",
+	"sampling",
+	"sequence",
+	"session",
+	"sketches",
+	"summary",
+)
+
+
+def __getattr__(name):
+	if name in _submodules:
+		import importlib
+
+		module = importlib.import_module("pluspacket." + name)
+		globals()[name] = module
+
+		return module
+
+	raise AttributeError("module 'pluspacket' has no attribute %r" % name)
+
+
+def __dir__():
+	return sorted(list(globals()) + [name for name in _submodules if name not in globals()])
+
 if __name__ == "__main__":
 	import tests
 	import unittest
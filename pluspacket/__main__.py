@@ -0,0 +1,6 @@
+import sys
+
+from pluspacket.cli import main
+
+
+sys.exit(main())
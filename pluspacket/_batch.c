@@ -0,0 +1,209 @@
+/*
+ * Batch parser for PLUS headers. Parses many datagrams into preallocated
+ * struct-of-arrays output buffers while the GIL is released. Semantics
+ * mirror Packet.from_bytes, see batch.py for the pure Python version.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+
+#define MIN_PACKET_LEN 20
+#define DEFAULT_MAGIC 0xd8007ffU
+
+enum {
+	OUT_STATUS, OUT_FLAGS, OUT_CAT, OUT_PSN, OUT_PSE, OUT_PCF_TYPE,
+	OUT_PCF_LEN, OUT_PCF_INTEGRITY, OUT_PCF_OFFSET, OUT_PAYLOAD_OFFSET,
+	OUT_COUNT
+};
+
+static const Py_ssize_t out_sizes[OUT_COUNT] = {1, 1, 8, 4, 4, 4, 1, 1, 4, 4};
+
+static uint32_t be32(const uint8_t *p)
+{
+	return ((uint32_t)p[0] << 24) | ((uint32_t)p[1] << 16) | ((uint32_t)p[2] << 8) | p[3];
+}
+
+static uint64_t be64(const uint8_t *p)
+{
+	return ((uint64_t)be32(p) << 32) | be32(p + 4);
+}
+
+static void parse_one(const uint8_t *p, Py_ssize_t len, Py_ssize_t i, char **out)
+{
+	int8_t status = 0;
+	uint8_t flags = 0;
+	uint64_t cat = 0;
+	uint32_t psn = 0, pse = 0;
+	int32_t pcf_type = -1, pcf_offset = -1, payload_offset = -1;
+	int8_t pcf_len = -1, pcf_integrity = -1;
+
+	if (len < MIN_PACKET_LEN) {
+		status = -1;
+		goto done;
+	}
+
+	uint32_t magic_and_flags = be32(p);
+
+	if ((magic_and_flags >> 4) != DEFAULT_MAGIC) {
+		status = -2;
+		goto done;
+	}
+
+	flags = magic_and_flags & 0x0F;
+	cat = be64(p + 4);
+	psn = be32(p + 12);
+	pse = be32(p + 16);
+
+	if (!(flags & 0x01)) {
+		payload_offset = MIN_PACKET_LEN;
+		goto done;
+	}
+
+	Py_ssize_t pos = MIN_PACKET_LEN;
+
+	if (pos >= len) {
+		status = -3;
+		goto done;
+	}
+
+	int32_t type = p[pos];
+
+	if (type == 0xFF) {
+		pcf_type = type;
+		payload_offset = (int32_t)pos + 1;
+		goto done;
+	}
+
+	if (type == 0x00) {
+		pos++;
+
+		if (pos >= len) {
+			status = -4;
+			goto done;
+		}
+
+		type = p[pos] << 8;
+	}
+
+	pos++;
+
+	if (pos >= len) {
+		status = -5;
+		goto done;
+	}
+
+	int plen = p[pos] >> 2;
+	int integrity = p[pos] & 0x03;
+	pos++;
+
+	if (len - pos < plen) {
+		status = -6;
+		goto done;
+	}
+
+	pcf_type = type;
+	pcf_len = (int8_t)plen;
+	pcf_integrity = (int8_t)integrity;
+	pcf_offset = (int32_t)pos;
+	payload_offset = (int32_t)(pos + plen);
+
+done:
+	((int8_t *)out[OUT_STATUS])[i] = status;
+	((uint8_t *)out[OUT_FLAGS])[i] = flags;
+	((uint64_t *)out[OUT_CAT])[i] = cat;
+	((uint32_t *)out[OUT_PSN])[i] = psn;
+	((uint32_t *)out[OUT_PSE])[i] = pse;
+	((int32_t *)out[OUT_PCF_TYPE])[i] = pcf_type;
+	((int8_t *)out[OUT_PCF_LEN])[i] = pcf_len;
+	((int8_t *)out[OUT_PCF_INTEGRITY])[i] = pcf_integrity;
+	((int32_t *)out[OUT_PCF_OFFSET])[i] = pcf_offset;
+	((int32_t *)out[OUT_PAYLOAD_OFFSET])[i] = payload_offset;
+}
+
+static PyObject *parse_into(PyObject *self, PyObject *args)
+{
+	PyObject *seq, *fast = NULL, *outs[OUT_COUNT];
+	Py_buffer out_views[OUT_COUNT];
+	Py_buffer *views = NULL;
+	char *out[OUT_COUNT];
+	Py_ssize_t n, i, got = 0, got_out = 0;
+	PyObject *result = NULL;
+
+	if (!PyArg_ParseTuple(args, "OOOOOOOOOOO", &seq,
+			&outs[0], &outs[1], &outs[2], &outs[3], &outs[4],
+			&outs[5], &outs[6], &outs[7], &outs[8], &outs[9]))
+		return NULL;
+
+	fast = PySequence_Fast(seq, "expected a sequence of buffers");
+
+	if (fast == NULL)
+		return NULL;
+
+	n = PySequence_Fast_GET_SIZE(fast);
+
+	for (got_out = 0; got_out < OUT_COUNT; got_out++) {
+		if (PyObject_GetBuffer(outs[got_out], &out_views[got_out], PyBUF_WRITABLE) < 0)
+			goto fail;
+
+		if (out_views[got_out].len < n * out_sizes[got_out]) {
+			PyBuffer_Release(&out_views[got_out]);
+			PyErr_SetString(PyExc_ValueError, "output buffer too small");
+			goto fail;
+		}
+
+		out[got_out] = out_views[got_out].buf;
+	}
+
+	views = PyMem_Calloc(n ? n : 1, sizeof(Py_buffer));
+
+	if (views == NULL) {
+		PyErr_NoMemory();
+		goto fail;
+	}
+
+	/* Exported buffers can not be resized by other threads. */
+	for (got = 0; got < n; got++) {
+		if (PyObject_GetBuffer(PySequence_Fast_GET_ITEM(fast, got), &views[got], PyBUF_SIMPLE) < 0)
+			goto fail;
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+
+	for (i = 0; i < n; i++)
+		parse_one(views[i].buf, views[i].len, i, out);
+
+	Py_END_ALLOW_THREADS
+
+	Py_INCREF(Py_None);
+	result = Py_None;
+
+fail:
+	for (i = 0; i < got; i++)
+		PyBuffer_Release(&views[i]);
+
+	for (i = 0; i < got_out; i++)
+		PyBuffer_Release(&out_views[i]);
+
+	PyMem_Free(views);
+	Py_XDECREF(fast);
+
+	return result;
+}
+
+static PyMethodDef methods[] = {
+	{"parse_into", parse_into, METH_VARARGS,
+		"parse_into(bufs, status, flags, cat, psn, pse, pcf_type, pcf_len, "
+		"pcf_integrity, pcf_offset, payload_offset)\n\n"
+		"Parses bufs into the writable output buffers without holding the GIL."},
+	{NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef module = {
+	PyModuleDef_HEAD_INIT, "_batch", NULL, -1, methods
+};
+
+PyMODINIT_FUNC PyInit__batch(void)
+{
+	return PyModule_Create(&module);
+}
@@ -0,0 +1,261 @@
+import hashlib
+import mmap
+import struct
+
+from pluspacket.packet import _cat_pos, _default_magic, _magic_shift, _min_packet_len, _udp_header_len
+from pluspacket.pcap import parse_global_header, iter_buffer, _global_header_len, _fold
+from pluspacket.decap import decapsulate, ip_header_offset, _ip_proto_udp
+from pluspacket.reassembly import _fragment
+from pluspacket.batch import parse_batch, rewrite_batch, STATUS_OK
+
+
+_u16 = struct.Struct(">H")
+_words = struct.Struct(">HHHH")
+_magic_and_cat = struct.Struct(">LQ")
+_cat = struct.Struct(">Q")
+
+
+class AnonymizeStats():
+
+	def __init__(self):
+		"""
+		Counters of anonymize_pcap. rewritten counts the PLUS packets whose
+		CAT was rewritten, fragments those of them that are the first
+		fragment of a fragmented datagram. passthrough counts the other UDP
+		fragments, they are copied unchanged as they do not hold the CAT
+		(or not all of it) and can not be told apart from fragments of
+		other datagrams.
+		"""
+
+		self.rewritten = 0
+		self.fragments = 0
+		self.passthrough = 0
+
+
+	def summary(self):
+		return {
+			"rewritten" : self.rewritten,
+			"fragments" : self.fragments,
+			"passthrough" : self.passthrough
+		}
+
+
+class CatAnonymizer():
+
+	def __init__(self, key, cache_size=1 << 16):
+		"""
+		Pseudonymizes CATs with a keyed hash (BLAKE2b, 64 bit digest), the
+		same CAT always maps to the same pseudonym for the same key. The
+		last cache_size CATs are cached since flows repeat their CAT.
+		"""
+
+		if isinstance(key, str):
+			key = key.encode("utf-8")
+
+		if not 0 < len(key) <= 64:
+			raise ValueError("key must be 1 to 64 bytes long")
+
+		self.key = key
+		self.cache_size = cache_size
+		self._cache = {}
+
+
+	def map(self, cat):
+		"""
+		Returns the pseudonym of cat.
+		"""
+
+		pseudonym = self._cache.get(cat)
+
+		if pseudonym is None:
+			digest = hashlib.blake2b(_cat.pack(cat), digest_size=8, key=self.key).digest()
+			pseudonym = _cat.unpack(digest)[0]
+
+			if len(self._cache) >= self.cache_size:
+				self._cache.clear()
+
+			self._cache[cat] = pseudonym
+
+		return pseudonym
+
+
+	def anonymize_batch(self, bufs, truncate=None):
+		"""
+		Rewrites the CATs of a batch of writable PLUS packets (excl. UDP
+		header) in place. With truncate, bytearrays are cut to at most
+		truncate payload bytes after the (extended) header. Returns the
+		number of packets rewritten.
+		"""
+
+		if truncate is not None:
+			result = parse_batch(bufs)
+
+			for i, buf in enumerate(bufs):
+				if result.status[i] == STATUS_OK:
+					del buf[result.payload_offset[i] + truncate:]
+
+		return rewrite_batch(bufs, cat=self.map)
+
+
+	def anonymize_frame(self, linktype, frame, result=None, stats=None):
+		"""
+		Rewrites the CAT of a PLUS packet in a writable link-layer frame in
+		place and patches the UDP checksum, also in the first fragment of a
+		fragmented datagram. Returns False if the frame does not hold a
+		PLUS packet. stats (an AnonymizeStats) is updated if given.
+		"""
+
+		if result is None:
+			result = decapsulate(linktype, frame)
+
+			if result is None:
+				return self._anonymize_fragment(linktype, frame, stats)
+
+		pos = result.payload_offset
+
+		if result.payload_end - pos < _min_packet_len:
+			return False
+
+		magic_and_flags, cat = _magic_and_cat.unpack_from(frame, pos)
+
+		if magic_and_flags >> _magic_shift != _default_magic:
+			return False
+
+		pos += _cat_pos[0]
+		old = _words.unpack_from(frame, pos)
+		_cat.pack_into(frame, pos, self.map(cat))
+		_patch_checksum(frame, result.udp_offset + 6, old, _words.unpack_from(frame, pos))
+
+		if stats is not None:
+			stats.rewritten += 1
+
+		return True
+
+
+	def _anonymize_fragment(self, linktype, frame, stats):
+		"""
+		Internal. Rewrites the CAT in the first fragment of a fragmented
+		UDP datagram, the UDP checksum covers the whole datagram but is in
+		the first fragment too.
+		"""
+
+		pos = ip_header_offset(linktype, frame)
+		fragment = None if pos is None else _fragment(frame, pos)
+
+		if fragment is None or fragment[3] != _ip_proto_udp:
+			return False
+
+		_, offset, _, _, data = fragment
+
+		if offset or len(data) < _udp_header_len + _magic_and_cat.size:
+			if stats is not None:
+				stats.passthrough += 1
+
+			return False
+
+		magic_and_flags, cat = _magic_and_cat.unpack_from(data, _udp_header_len)
+
+		if magic_and_flags >> _magic_shift != _default_magic:
+			return False
+
+		pos = _udp_header_len + _cat_pos[0]
+		old = _words.unpack_from(data, pos)
+		_cat.pack_into(data, pos, self.map(cat))
+		_patch_checksum(data, 6, old, _words.unpack_from(data, pos))
+
+		if stats is not None:
+			stats.rewritten += 1
+			stats.fragments += 1
+
+		return True
+
+
+def _patch_checksum(frame, pos, old, new):
+	"""
+	Internal. Updates the internet checksum at pos for changed 16 bit
+	words (RFC 1624), a zero (disabled) UDP checksum stays zero.
+	"""
+
+	checksum = _u16.unpack_from(frame, pos)[0]
+
+	if not checksum:
+		return
+
+	s = (~checksum & 0xFFFF) + sum(~w & 0xFFFF for w in old) + sum(new)
+	checksum = ~_fold(s) & 0xFFFF
+
+	_u16.pack_into(frame, pos, checksum or 0xFFFF)
+
+
+def anonymize_pcap(path, key, out=None, truncate=None):
+	"""
+	Pseudonymizes the CATs of all PLUS packets in the classic pcap file at
+	path. Without out the file is rewritten in place through a writable
+	mmap, otherwise a copy is written to out, with UDP payloads cut to
+	truncate bytes after the PLUS header if given (caplen shrinks, wire
+	length and IP/UDP lengths stay as captured). The CAT in the first
+	fragment of a fragmented datagram is rewritten too, its other
+	fragments are copied unchanged and not truncated. Returns an
+	AnonymizeStats.
+	"""
+
+	anonymizer = key if isinstance(key, CatAnonymizer) else CatAnonymizer(key)
+
+	if out is None:
+		if truncate is not None:
+			raise ValueError("Truncation needs an output file.")
+
+		with open(path, "r+b") as f:
+			with mmap.mmap(f.fileno(), 0) as buf:
+				return _rewrite(buf, anonymizer, None, None)
+
+	with open(path, "rb") as f:
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+			with open(out, "wb") as dst:
+				return _rewrite(buf, anonymizer, dst, truncate)
+
+
+def _rewrite(buf, anonymizer, dst, truncate, chunk=1 << 20):
+	"""
+	Internal. Rewrites buf in place (dst None) or into dst. Views into buf
+	do not outlive the call.
+	"""
+
+	record, ts_div, _, linktype = parse_global_header(buf[:_global_header_len])
+	stats = AnonymizeStats()
+
+	if dst is None:
+		for rec in iter_buffer(buf, _global_header_len, len(buf), record, ts_div):
+			anonymizer.anonymize_frame(linktype, rec.data, stats=stats)
+
+		return stats
+
+	out = bytearray(buf[:_global_header_len])
+
+	for rec in iter_buffer(buf, _global_header_len, len(buf), record, ts_div):
+		frame = bytearray(rec.data)
+		result = decapsulate(linktype, frame)
+		caplen = rec.caplen
+
+		if result is None:
+			anonymizer.anonymize_frame(linktype, frame, stats=stats)
+		elif anonymizer.anonymize_frame(linktype, frame, result, stats):
+			if truncate is not None:
+				header = parse_batch([frame[result.payload_offset : result.payload_end]])
+				end = result.payload_offset + header.payload_offset[0] + truncate
+
+				if header.ok(0) and end < caplen:
+					caplen = end
+					del frame[end:]
+
+		sec, frac, _, wirelen = record.unpack_from(buf, rec.offset)
+		out += record.pack(sec, frac, caplen, wirelen)
+		out += frame
+
+		if len(out) >= chunk:
+			dst.write(out)
+			del out[:]
+
+	dst.write(out)
+
+	return stats
@@ -0,0 +1,482 @@
+import collections
+import mmap
+import shutil
+import struct
+import tempfile
+
+from pluspacket.packet import Packet, parse_packet, detect_plus, _l_mask, _r_mask, _s_mask, _x_mask, _flags_mask, _basic_header
+from pluspacket.pcap import _open
+from pluspacket.sketches import BloomFilter
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+# File layout: header, records, PCF section (u64 length + PCF values),
+# block index, footer. Everything is little endian so the records can be
+# mapped as a NumPy array on the usual hosts without byte swapping.
+_magic = b"PLSA"
+_footer_magic = b"ASLP"
+_version = 2
+
+_header = struct.Struct("<4sHHLLLL")
+_footer = struct.Struct("<QQQQ4sL")
+_u64 = struct.Struct("<Q")
+_block = struct.Struct("<QQQQQQQ")
+
+# ts_ns, cat, psn, pse, flags, pcf_len, pcf_type, pcf_offset. pcf_offset is
+# relative to the PCF base of the block in the index, which is 64 bit as
+# the PCF section may outgrow 4 GiB.
+_record = struct.Struct("<QQLLBBHL")
+RECORD_SIZE = _record.size
+_max_pcf_len = 255
+
+# The low four bits of flags are the PLUS flags as on the wire.
+FLAG_PCF_TYPE = 0x10
+FLAG_PCF_VALUE = 0x20
+_integrity_shift = 6
+
+ArchiveRecord = collections.namedtuple("ArchiveRecord",
+	("ts_ns", "cat", "psn", "pse", "flags", "pcf_len", "pcf_type", "pcf_offset"))
+
+if numpy is not None:
+	dtype = numpy.dtype([
+		("ts_ns", "<u8"),
+		("cat", "<u8"),
+		("psn", "<u4"),
+		("pse", "<u4"),
+		("flags", "u1"),
+		("pcf_len", "u1"),
+		("pcf_type", "<u2"),
+		("pcf_offset", "<u4")
+	])
+else:
+	dtype = None
+
+
+def _ns(ts):
+	return int(round(ts * 1e9))
+
+
+class ArchiveWriter():
+
+	def __init__(self, f, block_records=4096, bloom_bits=8192, bloom_hashes=4):
+		"""
+		Writes PLUS headers as fixed 32 byte records. f can be a path or a
+		binary file object, it is only appended to. Every block_records
+		records an index entry is made with the timestamp and CAT range, a
+		Bloom filter of the CATs and the offset at which the PCF values of
+		the block start. PCF values are spilled to a temporary file and
+		appended on close.
+		"""
+
+		if not 0 < block_records * _max_pcf_len <= 0xFFFFFFFF:
+			raise ValueError("block_records must be between 1 and %d" % (0xFFFFFFFF // _max_pcf_len))
+
+		self._f, self._owned = _open(f, "wb")
+		self.block_records = block_records
+		self.bloom_bits = bloom_bits
+		self.bloom_hashes = bloom_hashes
+		self.records = 0
+
+		self._buf = bytearray(block_records * RECORD_SIZE)
+		self._n = 0
+		self._blocks = []
+		self._pcf = tempfile.TemporaryFile()
+		self._pcf_len = 0
+		self._new_block()
+
+		self._f.write(_header.pack(_magic, _version, RECORD_SIZE, block_records, bloom_bits, bloom_hashes, 0))
+
+
+	def _new_block(self):
+		self._ts_min = None
+		self._ts_max = None
+		self._cat_min = None
+		self._cat_max = None
+		self._bloom = BloomFilter(self.bloom_bits, self.bloom_hashes)
+		self._pcf_base = self._pcf_len
+
+
+	def _append(self, ts, cat, psn, pse, flags, pcf_type, pcf_integrity, pcf_value):
+		"""
+		Internal. Adds one record to the current block.
+		"""
+
+		ts_ns = _ns(ts)
+		pcf_offset = 0
+		pcf_len = 0
+
+		if pcf_type is not None:
+			flags |= FLAG_PCF_TYPE
+
+		if pcf_value is not None:
+			flags |= FLAG_PCF_VALUE | (pcf_integrity << _integrity_shift)
+			pcf_offset = self._pcf_len - self._pcf_base
+			pcf_len = len(pcf_value)
+
+			if pcf_len:
+				self._pcf.write(pcf_value)
+				self._pcf_len += pcf_len
+
+		_record.pack_into(self._buf, self._n * RECORD_SIZE, ts_ns, cat, psn, pse, flags,
+			pcf_len, pcf_type or 0, pcf_offset)
+		self._n += 1
+
+		if self._ts_min is None:
+			self._ts_min = self._ts_max = ts_ns
+			self._cat_min = self._cat_max = cat
+		else:
+			self._ts_min = min(self._ts_min, ts_ns)
+			self._ts_max = max(self._ts_max, ts_ns)
+			self._cat_min = min(self._cat_min, cat)
+			self._cat_max = max(self._cat_max, cat)
+
+		self._bloom.add(cat)
+
+		if self._n == self.block_records:
+			self._flush_block()
+
+
+	def _flush_block(self):
+		if not self._n:
+			return
+
+		self._f.write(memoryview(self._buf)[:self._n * RECORD_SIZE])
+		self._blocks.append((self.records, self._n, self._ts_min, self._ts_max,
+			self._cat_min, self._cat_max, self._pcf_base, self._bloom.to_bytes()))
+		self.records += self._n
+		self._n = 0
+		self._new_block()
+
+
+	def write(self, ts, packet):
+		"""
+		Archives the header of a Packet seen at ts (seconds). The payload
+		is not kept.
+		"""
+
+		flags = (packet.l and _l_mask) | (packet.r and _r_mask) | (packet.s and _s_mask) | (packet.x and _x_mask)
+
+		self._append(ts, packet.cat, packet.psn, packet.pse, flags,
+			packet.pcf_type, packet.pcf_integrity, packet.pcf_value)
+
+
+	def write_buf(self, ts, buf):
+		"""
+		Archives the header of a PLUS packet held in buf (bytes, bytearray
+		or memoryview). Returns False if it is not a valid PLUS packet.
+		Basic headers are read without creating a Packet.
+		"""
+
+		if not detect_plus(buf):
+			return False
+
+		magic_and_flags, cat, psn, pse = _basic_header.unpack_from(buf, 0)
+		flags = magic_and_flags & _flags_mask
+
+		if not flags & _x_mask:
+			self._append(ts, cat, psn, pse, flags, None, None, None)
+			return True
+
+		try:
+			self.write(ts, parse_packet(buf))
+		except ValueError:
+			return False
+
+		return True
+
+
+	def close(self):
+		"""
+		Writes the PCF section, the index and the footer.
+		"""
+
+		self._flush_block()
+
+		pcf_offset = _header.size + self.records * RECORD_SIZE
+		self._f.write(_u64.pack(self._pcf_len))
+		self._pcf.seek(0)
+		shutil.copyfileobj(self._pcf, self._f)
+		self._pcf.close()
+
+		index_offset = pcf_offset + _u64.size + self._pcf_len
+
+		for first, count, ts_min, ts_max, cat_min, cat_max, pcf_base, bloom in self._blocks:
+			self._f.write(_block.pack(first, count, ts_min, ts_max, cat_min, cat_max, pcf_base))
+			self._f.write(bloom)
+
+		self._f.write(_footer.pack(self.records, pcf_offset, index_offset, len(self._blocks), _footer_magic, 0))
+		self._f.flush()
+
+		if self._owned:
+			self._f.close()
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *args):
+		self.close()
+
+
+def _absolute(fields, base):
+	"""
+	Internal. Returns an ArchiveRecord of the fields of a record in a block
+	whose PCF values start at base.
+	"""
+
+	ts_ns, cat, psn, pse, flags, pcf_len, pcf_type, pcf_offset = fields
+
+	return ArchiveRecord(ts_ns, cat, psn, pse, flags, pcf_len, pcf_type, base + pcf_offset)
+
+
+_Block = collections.namedtuple("_Block", ("first", "count", "ts_min", "ts_max", "cat_min", "cat_max", "pcf_base", "bloom"))
+
+
+class ArchiveReader():
+
+	def __init__(self, path):
+		"""
+		Maps the archive at path into memory. Nothing but the index is read
+		up front. Arrays returned by records must be dropped before close.
+		The pcf_offset of ArchiveRecords is absolute, in the records array
+		it is relative to the PCF base of the block.
+		"""
+
+		self._file = open(path, "rb")
+		self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		try:
+			self._load()
+		except Exception:
+			self.close()
+			raise
+
+
+	def _load(self):
+		mm = self._mm
+
+		if len(mm) < _header.size + _footer.size:
+			raise ValueError("Not a PLUS archive.")
+
+		magic, version, record_size, self.block_records, bloom_bits, bloom_hashes, _ = _header.unpack_from(mm, 0)
+		count, pcf_offset, index_offset, blocks, footer_magic, _ = _footer.unpack_from(mm, len(mm) - _footer.size)
+
+		if magic != _magic or footer_magic != _footer_magic:
+			raise ValueError("Not a PLUS archive.")
+
+		if version != _version or record_size != RECORD_SIZE or not self.block_records:
+			raise ValueError("Unsupported archive version %d." % version)
+
+		self._count = count
+		self._pcf_start = pcf_offset + _u64.size
+		self.blocks = []
+
+		bloom_len = bloom_bits // 8
+		pos = index_offset
+
+		for i in range(blocks):
+			fields = _block.unpack_from(mm, pos)
+			pos += _block.size
+			bloom = BloomFilter(bloom_bits, bloom_hashes, data=mm[pos : pos + bloom_len])
+			pos += bloom_len
+			self.blocks.append(_Block(*(fields + (bloom,))))
+
+		self._bases = [block.pcf_base for block in self.blocks]
+
+
+	def __len__(self):
+		return self._count
+
+
+	def __getitem__(self, i):
+		if i < 0:
+			i += self._count
+
+		if not 0 <= i < self._count:
+			raise IndexError("record index out of range")
+
+		fields = _record.unpack_from(self._mm, _header.size + i * RECORD_SIZE)
+
+		return _absolute(fields, self._bases[i // self.block_records])
+
+
+	def __iter__(self):
+		return self._iter(0, self._count)
+
+
+	def _iter(self, first, count):
+		# Copies one block at a time, a view would keep the map from closing.
+		# first is the first record of a block.
+		block = first // self.block_records
+		pos = _header.size + first * RECORD_SIZE
+		end = pos + count * RECORD_SIZE
+		step = self.block_records * RECORD_SIZE
+
+		while pos < end:
+			base = self._bases[block]
+
+			for fields in _record.iter_unpack(self._mm[pos : min(pos + step, end)]):
+				yield _absolute(fields, base)
+
+			block += 1
+			pos += step
+
+
+	def records(self):
+		"""
+		Returns all records as NumPy structured array (see dtype) backed by
+		the mapped file, without parsing or copying anything.
+		"""
+
+		if numpy is None:
+			raise ImportError("records() needs numpy, iterate the reader instead")
+
+		return numpy.frombuffer(self._mm, dtype, self._count, _header.size)
+
+
+	def pcf_value(self, record, i=None):
+		"""
+		Returns the PCF value of record as bytes or None. record is an
+		ArchiveRecord or an element of the records array, then i is its
+		index in the archive (the offsets in the array are relative to the
+		block).
+		"""
+
+		if isinstance(record, ArchiveRecord):
+			flags, length, offset = record.flags, record.pcf_len, record.pcf_offset
+		else:
+			if i is None:
+				raise ValueError("The index of the record is needed.")
+
+			flags, length, offset = int(record["flags"]), int(record["pcf_len"]), int(record["pcf_offset"])
+			offset += self._bases[i // self.block_records]
+
+		if not flags & FLAG_PCF_VALUE:
+			return None
+
+		start = self._pcf_start + offset
+
+		return self._mm[start : start + length]
+
+
+	def packet(self, i):
+		"""
+		Returns the header of record i as Packet with an empty payload.
+		"""
+
+		record = self[i]
+		p = Packet()
+
+		p.l = bool(record.flags & _l_mask)
+		p.r = bool(record.flags & _r_mask)
+		p.s = bool(record.flags & _s_mask)
+		p.x = bool(record.flags & _x_mask)
+		p.cat = record.cat
+		p.psn = record.psn
+		p.pse = record.pse
+		p.payload = b""
+
+		if record.flags & FLAG_PCF_TYPE:
+			p.pcf_type = record.pcf_type
+
+		if record.flags & FLAG_PCF_VALUE:
+			p.pcf_len = record.pcf_len
+			p.pcf_integrity = record.flags >> _integrity_shift
+			p.pcf_value = self.pcf_value(record)
+
+		return p
+
+
+	def select_blocks(self, start=None, end=None, cat=None):
+		"""
+		Returns the index blocks that may hold records of cat with start
+		<= ts < end (seconds). None means unbounded.
+		"""
+
+		start_ns = None if start is None else _ns(start)
+		end_ns = None if end is None else _ns(end)
+		result = []
+
+		for block in self.blocks:
+			if start_ns is not None and block.ts_max < start_ns:
+				continue
+
+			if end_ns is not None and block.ts_min >= end_ns:
+				continue
+
+			if cat is not None and (not block.cat_min <= cat <= block.cat_max or cat not in block.bloom):
+				continue
+
+			result.append(block)
+
+		return result
+
+
+	def query(self, start=None, end=None, cat=None):
+		"""
+		Yields the ArchiveRecords of cat with start <= ts < end (seconds),
+		reading only the blocks the index can not rule out.
+		"""
+
+		start_ns = None if start is None else _ns(start)
+		end_ns = None if end is None else _ns(end)
+
+		for block in self.select_blocks(start, end, cat):
+			for record in self._iter(block.first, block.count):
+				if cat is not None and record.cat != cat:
+					continue
+
+				if start_ns is not None and record.ts_ns < start_ns:
+					continue
+
+				if end_ns is not None and record.ts_ns >= end_ns:
+					continue
+
+				yield record
+
+
+	def query_array(self, start=None, end=None, cat=None):
+		"""
+		Same as query but returns a NumPy structured array (a copy).
+		"""
+
+		records = self.records()
+		parts = []
+
+		for block in self.select_blocks(start, end, cat):
+			part = records[block.first : block.first + block.count]
+			mask = numpy.ones(len(part), dtype=bool)
+
+			if cat is not None:
+				mask &= part["cat"] == cat
+
+			if start is not None:
+				mask &= part["ts_ns"] >= _ns(start)
+
+			if end is not None:
+				mask &= part["ts_ns"] < _ns(end)
+
+			parts.append(part[mask])
+
+		if not parts:
+			return numpy.empty(0, dtype)
+
+		return numpy.concatenate(parts)
+
+
+	def close(self):
+		self._mm.close()
+		self._file.close()
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *args):
+		self.close()
@@ -0,0 +1,255 @@
+import array
+
+from pluspacket.packet import Packet, _u32, _u64, _cat_pos, _psn_pos, _pse_pos, _magic_pos, _default_magic, _magic_shift, _flags_mask, _min_packet_len, _l_mask, _r_mask, _s_mask, _x_mask, _basic_header
+
+try:
+	from pluspacket import _batch
+except ImportError:
+	_batch = None
+
+
+STATUS_OK = 0
+STATUS_TOO_SHORT = -1
+STATUS_BAD_MAGIC = -2
+STATUS_MISSING_PCF_TYPE = -3
+STATUS_MISSING_PCF_TYPE_2 = -4
+STATUS_MISSING_PCF_LEN = -5
+STATUS_INCOMPLETE_PCF_VALUE = -6
+
+_errors = {
+	STATUS_TOO_SHORT : "Minimum length of a PLUS packet is 20 bytes.",
+	STATUS_BAD_MAGIC : "Invalid Magic value",
+	STATUS_MISSING_PCF_TYPE : "Extended header must have PCF_TYPE",
+	STATUS_MISSING_PCF_TYPE_2 : "Missing additional PCF_TYPE byte",
+	STATUS_MISSING_PCF_LEN : "Missing PCF_LEN and PCF_INTEGRITY",
+	STATUS_INCOMPLETE_PCF_VALUE : "Incomplete PCF_VALUE"
+}
+
+# (name, typecode); None valued fields of from_bytes are stored as -1.
+_fields = (
+	("status", "b"),
+	("flags", "B"),
+	("cat", "Q"),
+	("psn", "I"),
+	("pse", "I"),
+	("pcf_type", "i"),
+	("pcf_len", "b"),
+	("pcf_integrity", "b"),
+	("pcf_offset", "i"),
+	("payload_offset", "i")
+)
+
+
+def has_accelerator():
+	"""
+	Returns True if the compiled batch kernel is available.
+	"""
+
+	return _batch is not None
+
+
+def _parse_python(bufs, out):
+	"""
+	Internal. Pure Python version of the kernel in _batch.c.
+	"""
+
+	status, flags_, cat_, psn_, pse_, pcf_type_, pcf_len_, pcf_integrity_, pcf_offset_, payload_offset_ = out
+	unpack_from = _basic_header.unpack_from
+
+	for i, buf in enumerate(bufs):
+		n = len(buf)
+
+		if n < _min_packet_len:
+			status[i] = STATUS_TOO_SHORT
+			continue
+
+		magic_and_flags, cat, psn, pse = unpack_from(buf, 0)
+
+		if magic_and_flags >> _magic_shift != _default_magic:
+			status[i] = STATUS_BAD_MAGIC
+			continue
+
+		flags = magic_and_flags & _flags_mask
+		flags_[i] = flags
+		cat_[i] = cat
+		psn_[i] = psn
+		pse_[i] = pse
+
+		if not flags & _x_mask:
+			payload_offset_[i] = _min_packet_len
+			continue
+
+		pos = _min_packet_len
+
+		if pos >= n:
+			status[i] = STATUS_MISSING_PCF_TYPE
+			continue
+
+		pcf_type = buf[pos]
+
+		if pcf_type == 0xFF:
+			pcf_type_[i] = pcf_type
+			payload_offset_[i] = pos + 1
+			continue
+
+		if pcf_type == 0x00:
+			pos += 1
+
+			if pos >= n:
+				status[i] = STATUS_MISSING_PCF_TYPE_2
+				continue
+
+			pcf_type = buf[pos] << 8
+
+		pos += 1
+
+		if pos >= n:
+			status[i] = STATUS_MISSING_PCF_LEN
+			continue
+
+		pcf_len = buf[pos] >> 2
+		pcf_integrity_[i] = buf[pos] & 0x03
+		pos += 1
+
+		if n - pos < pcf_len:
+			pcf_integrity_[i] = -1
+			status[i] = STATUS_INCOMPLETE_PCF_VALUE
+			continue
+
+		pcf_type_[i] = pcf_type
+		pcf_len_[i] = pcf_len
+		pcf_offset_[i] = pos
+		payload_offset_[i] = pos + pcf_len
+
+
+class BatchResult():
+	"""
+	Header fields of a batch of datagrams as one array per field. status
+	is STATUS_OK or one of the STATUS_* error codes, fields that from_bytes
+	leaves at None are -1.
+	"""
+
+	def __init__(self, bufs):
+		n = len(bufs)
+
+		self.bufs = bufs
+		self.status = array.array("b", bytes(n))
+		self.flags = array.array("B", bytes(n))
+		self.cat = array.array("Q", bytes(8 * n))
+		self.psn = array.array("I", bytes(4 * n))
+		self.pse = array.array("I", bytes(4 * n))
+		self.pcf_type = array.array("i", [-1]) * n
+		self.pcf_len = array.array("b", [-1]) * n
+		self.pcf_integrity = array.array("b", [-1]) * n
+		self.pcf_offset = array.array("i", [-1]) * n
+		self.payload_offset = array.array("i", [-1]) * n
+
+
+	def _outputs(self):
+		return [getattr(self, name) for name, typecode in _fields]
+
+
+	def __len__(self):
+		return len(self.bufs)
+
+
+	def ok(self, i):
+		return self.status[i] == STATUS_OK
+
+
+	def error(self, i):
+		"""
+		Returns the error message of datagram i or None.
+		"""
+
+		return _errors.get(self.status[i])
+
+
+	def packet(self, i):
+		"""
+		Returns datagram i as Packet, the same as from_bytes would. Raises
+		ValueError if it could not be parsed.
+		"""
+
+		if self.status[i] != STATUS_OK:
+			raise ValueError(_errors[self.status[i]])
+
+		buf = self.bufs[i]
+		flags = self.flags[i]
+		p = Packet()
+
+		p.l = bool(flags & _l_mask)
+		p.r = bool(flags & _r_mask)
+		p.s = bool(flags & _s_mask)
+		p.x = bool(flags & _x_mask)
+		p.cat = self.cat[i]
+		p.psn = self.psn[i]
+		p.pse = self.pse[i]
+		p.payload = buf[self.payload_offset[i]:]
+
+		if p.x:
+			p.pcf_type = self.pcf_type[i]
+
+		if self.pcf_offset[i] >= 0:
+			start = self.pcf_offset[i]
+			p.pcf_len = self.pcf_len[i]
+			p.pcf_integrity = self.pcf_integrity[i]
+			p.pcf_value = buf[start : start + p.pcf_len]
+
+		return p
+
+
+def parse_batch(bufs, accelerated=True):
+	"""
+	Parses a sequence of datagrams (excl. UDP header) into a BatchResult.
+	The compiled kernel, if available and accelerated is set, does not
+	hold the GIL while parsing so batches can be parsed concurrently by a
+	thread pool, e.g. executor.map(parse_batch, batches).
+	"""
+
+	result = BatchResult(bufs)
+
+	if accelerated and _batch is not None:
+		_batch.parse_into(bufs, *result._outputs())
+	else:
+		_parse_python(bufs, result._outputs())
+
+	return result
+
+
+def rewrite_batch(bufs, cat=None, psn=None, pse=None, flags=None):
+	"""
+	Rewrites header fields of many writable buffers in place, the same as
+	calling set_cat etc. on each. Every field can be left alone (None),
+	set to a value or mapped with a function of the old value, e.g.
+	cat=remap.get or flags=lambda f: f ^ 0x08. Buffers that are not PLUS
+	packets are skipped. Returns the number of rewritten buffers.
+	"""
+
+	u64_pack_into, u64_unpack_from = _u64.pack_into, _u64.unpack_from
+	u32_pack_into, u32_unpack_from = _u32.pack_into, _u32.unpack_from
+	cat_pos, psn_pos, pse_pos = _cat_pos[0], _psn_pos[0], _pse_pos[0]
+	flags_pos = _magic_pos[1] - 1
+	n = 0
+
+	for buf in bufs:
+		if len(buf) < _min_packet_len or u32_unpack_from(buf, 0)[0] >> _magic_shift != _default_magic:
+			continue
+
+		if cat is not None:
+			u64_pack_into(buf, cat_pos, cat(u64_unpack_from(buf, cat_pos)[0]) if callable(cat) else cat)
+
+		if psn is not None:
+			u32_pack_into(buf, psn_pos, psn(u32_unpack_from(buf, psn_pos)[0]) if callable(psn) else psn)
+
+		if pse is not None:
+			u32_pack_into(buf, pse_pos, pse(u32_unpack_from(buf, pse_pos)[0]) if callable(pse) else pse)
+
+		if flags is not None:
+			old = buf[flags_pos]
+			new = flags(old & _flags_mask) if callable(flags) else flags
+			buf[flags_pos] = (old & 0xF0) | (new & _flags_mask)
+
+		n += 1
+
+	return n
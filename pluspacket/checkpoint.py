@@ -0,0 +1,198 @@
+import os
+import pickle
+import struct
+import time
+import zlib
+
+from pluspacket.flows import FlowTable
+
+
+_frame_magic = b"PLCK"
+_frame_full = 0
+_frame_delta = 1
+# Pickled state of what feeds the table (sampler, ...), precedes the
+# table frame of the same checkpoint.
+_frame_state = 2
+
+# magic, kind, file offset, records consumed, payload length, crc32
+_frame_header = struct.Struct(">4sBQQLL")
+
+
+def _frame(kind, offset, records, payload):
+	"""
+	Internal. Builds a checkpoint frame.
+	"""
+
+	header = _frame_header.pack(_frame_magic, kind, offset, records, len(payload), 0)
+	crc = zlib.crc32(header[:-4] + payload) & 0xFFFFFFFF
+
+	return header[:-4] + struct.pack(">L", crc) + payload
+
+
+def _frames(buf):
+	"""
+	Internal. Yields (kind, offset, records, payload) for all intact frames.
+	Stops at the first damaged frame which is what a crash in the middle of
+	writing a frame leaves behind.
+	"""
+
+	pos = 0
+
+	while pos + _frame_header.size <= len(buf):
+		magic, kind, offset, records, length, crc = _frame_header.unpack_from(buf, pos)
+
+		start = pos + _frame_header.size
+		payload = buf[start : start + length]
+
+		if magic != _frame_magic or len(payload) != length:
+			return
+
+		if zlib.crc32(buf[pos : start - 4] + payload) & 0xFFFFFFFF != crc:
+			return
+
+		yield kind, offset, records, payload
+
+		pos = start + length
+
+
+def load_checkpoint(path, with_state=False):
+	"""
+	Restores the state recorded in a checkpoint file. Returns a tuple
+	(table, offset, records) or None if there is no usable checkpoint.
+	With with_state the state passed to Checkpointer.checkpoint (or None)
+	is appended to the tuple.
+	"""
+
+	try:
+		with open(path, "rb") as f:
+			buf = f.read()
+	except FileNotFoundError:
+		return None
+
+	table = None
+	offset = None
+	records = 0
+	state = None
+	pending_state = None
+
+	for kind, offset_, records_, payload in _frames(buf):
+		if kind == _frame_state:
+			pending_state = (offset_, records_, payload)
+			continue
+
+		if kind == _frame_full:
+			table = FlowTable()
+		elif table is None:
+			# A delta without a preceding full snapshot is useless.
+			continue
+
+		table.load_flows(payload)
+		offset = offset_
+		records = records_
+
+		# Only state written for exactly this checkpoint applies.
+		if pending_state is not None and pending_state[:2] == (offset, records):
+			state = pickle.loads(pending_state[2])
+		else:
+			state = None
+
+		pending_state = None
+
+	if table is None:
+		return None
+
+	table.clear_dirty()
+
+	if with_state:
+		return table, offset, records, state
+
+	return table, offset, records
+
+
+class Checkpointer():
+
+	def __init__(self, path, interval=5.0, full_every=64, clock=time.monotonic):
+		"""
+		Writes checkpoints of a FlowTable to path. Every checkpoint only
+		contains the flows that changed since the previous one, every
+		full_every-th checkpoint is a full snapshot which replaces the file
+		so that it does not grow without bounds.
+		"""
+
+		self.path = path
+		self.interval = interval
+		self.full_every = full_every
+		self._clock = clock
+		self._deltas = full_every
+		self._f = None
+		self._next = clock() + interval
+
+
+	def due(self):
+		"""
+		Returns True if the next checkpoint should be taken.
+		"""
+
+		return self._clock() >= self._next
+
+
+	def maybe_checkpoint(self, table, offset, records, state=None):
+		"""
+		Takes a checkpoint if interval seconds passed since the last one.
+		"""
+
+		if self._clock() < self._next:
+			return False
+
+		self.checkpoint(table, offset, records, state)
+
+		return True
+
+
+	def checkpoint(self, table, offset, records, state=None):
+		"""
+		Records that everything up to file offset (records many records)
+		has been accounted in table. state is anything picklable that must
+		be restored along with the table, e.g. sampler state.
+		"""
+
+		if state is not None:
+			state = _frame(_frame_state, offset, records, pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+		else:
+			state = b""
+
+		if self._deltas >= self.full_every:
+			self._full(table, offset, records, state)
+		else:
+			payload = table.pack_flows(table.dirty())
+			self._f.write(state + _frame(_frame_delta, offset, records, payload))
+			self._f.flush()
+			self._deltas += 1
+
+		table.clear_dirty()
+		self._next = self._clock() + self.interval
+
+
+	def _full(self, table, offset, records, state=b""):
+		"""
+		Internal. Atomically replaces the checkpoint file with a full snapshot.
+		"""
+
+		if self._f is not None:
+			self._f.close()
+
+		tmp = self.path + ".tmp"
+
+		with open(tmp, "wb") as f:
+			f.write(state + _frame(_frame_full, offset, records, table.pack_flows(table)))
+
+		os.replace(tmp, self.path)
+
+		self._f = open(self.path, "ab")
+		self._deltas = 0
+
+
+	def close(self):
+		if self._f is not None:
+			self._f.close()
+			self._f = None
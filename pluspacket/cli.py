@@ -0,0 +1,248 @@
+import argparse
+import csv
+import json
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import time
+
+from pluspacket.pcap import open_capture, parse_global_header, iter_buffer, _global_header_len
+from pluspacket.decap import udp_payload
+from pluspacket.summary import SummaryTable
+
+
+_csv_fields = ["cat", "packets", "bytes", "first_ts", "last_ts", "l", "r", "s", "x",
+	"pcf_types", "rtt_samples", "rtt_min", "rtt_mean", "rtt_max"]
+
+# How often (in records) idle flows are looked for.
+_expire_every = 4096
+
+# Largest part of a trace a worker summarizes at once.
+_chunk_bytes = 32 << 20
+
+
+class _JsonWriter():
+
+	def __init__(self, f):
+		self._f = f
+
+
+	def write(self, flow):
+		d = flow.to_dict()
+		d["pcf_types"] = dict((str(k), v) for k, v in d["pcf_types"].items())
+		self._f.write(json.dumps(d) + "\n")
+
+
+class _CsvWriter():
+
+	def __init__(self, f):
+		self._writer = csv.DictWriter(f, _csv_fields)
+		self._writer.writeheader()
+
+
+	def write(self, flow):
+		d = flow.to_dict()
+		d["pcf_types"] = " ".join("%d:%d" % item for item in d["pcf_types"].items())
+		self._writer.writerow(d)
+
+
+def _parser():
+	parser = argparse.ArgumentParser(prog="pluspacket",
+		description="Summarizes the PLUS traffic in a pcap or pcapng trace per CAT.")
+
+	parser.add_argument("input", nargs="?", default="-",
+		help="pcap or pcapng file, - for stdin (default)")
+	parser.add_argument("-f", "--format", choices=["json", "csv"], default="json",
+		help="output format, json means JSON lines (default)")
+	parser.add_argument("-o", "--output", default="-",
+		help="output file, - for stdout (default)")
+	parser.add_argument("--idle", type=float, default=60.0,
+		help="emit flows idle for this many seconds of trace time (default 60)")
+	parser.add_argument("--max-flows", type=int, default=100000,
+		help="emit the least recently active flows above this many (default 100000)")
+	parser.add_argument("--workers", type=int, default=1,
+		help="process a pcap file with this many processes (pcapng and stdin are processed sequentially)")
+	parser.add_argument("-q", "--quiet", action="store_true",
+		help="do not report throughput on stderr")
+
+	return parser
+
+
+def _stream(path, table, writer):
+	"""
+	Internal. Streams a capture through table, emitting flows as they
+	expire. Returns the number of records read.
+	"""
+
+	reader = open_capture(sys.stdin.buffer if path == "-" else path)
+	records = 0
+
+	try:
+		default = reader.linktype
+
+		for record in reader:
+			linktype = default if record.linktype is None else record.linktype
+			payload = udp_payload(linktype, record.data)
+
+			if payload is not None:
+				table.update(record.ts, payload)
+
+			records += 1
+
+			if records % _expire_every == 0:
+				for flow in table.expire(record.ts):
+					writer.write(flow)
+	finally:
+		reader.close()
+
+	return records
+
+
+def _is_pcap(path):
+	"""
+	Internal. True if path is a classic pcap file.
+	"""
+
+	with open(path, "rb") as f:
+		header = f.read(_global_header_len)
+
+	try:
+		parse_global_header(header)
+	except (ValueError, struct.error):
+		return False
+
+	return True
+
+
+def _summarize_buffer(buf, start, end, idle, max_flows):
+	"""
+	Internal. Summarizes the records in [start, end) of buf.
+	"""
+
+	record, ts_div, _, linktype = parse_global_header(buf[:_global_header_len])
+	table = SummaryTable(idle, max_flows, partial=True)
+	expired = []
+	records = 0
+	now = None
+
+	for rec in iter_buffer(buf, start, end, record, ts_div):
+		payload = udp_payload(linktype, rec.data)
+
+		if payload is not None:
+			table.update(rec.ts, payload)
+
+		now = rec.ts
+		records += 1
+
+		if records % _expire_every == 0:
+			expired.extend(table.expire(now))
+
+	return expired, table, records, now
+
+
+def _summarize(args):
+	"""
+	Internal. Runs in a worker process. Returns the flows that expired in
+	a part of the trace, the table with the others, the number of records
+	and the last timestamp.
+	"""
+
+	path, start, end, idle, max_flows = args
+
+	with open(path, "rb") as f:
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+			return _summarize_buffer(buf, start, end, idle, max_flows)
+
+
+def _parallel(path, workers, table, writer):
+	"""
+	Internal. Summarizes a pcap file in parts of at most about
+	_chunk_bytes with workers processes. The parts are merged into table
+	in file order, flows are emitted as they expire there, so only
+	table and the parts in flight are held in memory. Returns the number
+	of records read.
+	"""
+
+	from pluspacket.parallel import split_pcap
+
+	with open(path, "rb") as f:
+		size = os.fstat(f.fileno()).st_size
+
+		if size <= _global_header_len:
+			return 0
+
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+			ranges = split_pcap(buf, max(workers * 4, size // _chunk_bytes))
+
+	tasks = [(path, start, end, table.idle_timeout, table.max_flows) for start, end in ranges]
+	pool = multiprocessing.Pool(workers)
+	records = 0
+
+	try:
+		for expired, part, n, now in pool.imap(_summarize, tasks):
+			for flow in expired + list(part):
+				older = table.add_flow(flow)
+
+				if older is not None:
+					writer.write(older)
+
+			table.packets += part.packets
+			table.bytes += part.bytes
+			table.malformed += part.malformed
+			records += n
+
+			if now is not None:
+				for flow in table.expire(now):
+					writer.write(flow)
+	finally:
+		pool.close()
+		pool.join()
+
+	return records
+
+
+def main(argv=None):
+	args = _parser().parse_args(argv)
+	workers = args.workers
+
+	if workers > 1 and (args.input == "-" or not _is_pcap(args.input)):
+		if not args.quiet:
+			sys.stderr.write("--workers needs a pcap file, processing sequentially\n")
+
+		workers = 1
+
+	out = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+	writer = _JsonWriter(out) if args.format == "json" else _CsvWriter(out)
+	start = time.perf_counter()
+
+	try:
+		table = SummaryTable(args.idle, args.max_flows)
+
+		if workers > 1:
+			records = _parallel(args.input, workers, table, writer)
+		else:
+			records = _stream(args.input, table, writer)
+
+		for flow in table.flush():
+			writer.write(flow)
+	except BrokenPipeError:
+		# Output closed early, e.g. piped into head.
+		os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+		return 1
+	finally:
+		if out is not sys.stdout:
+			out.close()
+
+	elapsed = time.perf_counter() - start
+
+	if not args.quiet:
+		sys.stderr.write("%d records, %d PLUS packets, %d bytes in %.3f s (%.0f packets/s)\n" % (
+			records, table.packets, table.bytes, elapsed, table.packets / elapsed if elapsed > 0 else 0.0))
+
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,244 @@
+import collections
+import heapq
+
+from pluspacket.packet import get_cat, get_psn, detect_plus
+from pluspacket.pcap import open_capture
+from pluspacket.decap import decapsulate, ip_addresses
+from pluspacket.sketches import Reservoir
+
+
+def endpoint_direction(frame, result):
+	"""
+	Returns 0 or 1 depending on which end of the UDP flow sent a frame
+	(result is its Decapsulated). Does not hold across NATs, pass another
+	function to correlate_traces there.
+	"""
+
+	src, dst = ip_addresses(frame, result)
+	udp = result.udp_offset
+
+	return int((src, bytes(frame[udp : udp + 2])) > (dst, bytes(frame[udp + 2 : udp + 4])))
+
+
+class SegmentStats():
+
+	def __init__(self, samples=8192):
+		"""
+		One-way delay and loss between two adjacent vantage points. The
+		delay is kept exactly as mean, min and max, its percentiles are
+		estimated from a Reservoir of samples values. Delays include any
+		clock offset between the two capture points.
+		"""
+
+		self.matched = 0
+		self.lost = 0
+		self.missed = 0
+		self.min_delay = None
+		self.max_delay = None
+		self._sum_delay = 0.0
+		self._reservoir = Reservoir(samples)
+
+
+	def add(self, delay):
+		self.matched += 1
+		self._sum_delay += delay
+
+		if self.min_delay is None or delay < self.min_delay:
+			self.min_delay = delay
+
+		if self.max_delay is None or delay > self.max_delay:
+			self.max_delay = delay
+
+		self._reservoir.add(delay)
+
+
+	def percentile(self, q):
+		"""
+		Returns the q-th (0..100) percentile of the delay or None.
+		"""
+
+		return self._reservoir.percentile(q)
+
+
+	def summary(self):
+		sent = self.matched + self.lost
+
+		return {
+			"matched" : self.matched,
+			"lost" : self.lost,
+			"missed" : self.missed,
+			"loss_rate" : self.lost / sent if sent else 0.0,
+			"min_delay" : self.min_delay,
+			"mean_delay" : self._sum_delay / self.matched if self.matched else None,
+			"p50_delay" : self.percentile(50),
+			"p99_delay" : self.percentile(99),
+			"max_delay" : self.max_delay
+		}
+
+
+class Correlator():
+
+	def __init__(self, vantages, window=1.0, max_pending=1 << 20, samples=8192):
+		"""
+		Matches packets seen at vantages capture points, numbered in path
+		order, by (CAT, PSN, direction). A packet is final window seconds
+		after it was first seen or when more than max_pending packets are
+		pending, so memory is bounded. segments maps (from, to) vantage
+		pairs of both orientations to SegmentStats.
+		"""
+
+		if vantages < 2:
+			raise ValueError("Need at least two vantage points.")
+
+		self.vantages = vantages
+		self.window = window
+		self.max_pending = max_pending
+		self.segments = {}
+		self.unattributed = 0
+		self.duplicates = 0
+		self.evicted = 0
+		self._pending = collections.OrderedDict()
+
+		for i in range(vantages - 1):
+			self.segments[(i, i + 1)] = SegmentStats(samples)
+			self.segments[(i + 1, i)] = SegmentStats(samples)
+
+
+	def add(self, vantage, ts, cat, psn, direction):
+		"""
+		Accounts a packet seen at vantage. Calls must be in timestamp order
+		across all vantage points, see correlate_traces.
+		"""
+
+		pending = self._pending
+
+		while pending:
+			first = next(iter(pending.values()))
+
+			if ts - first[-1] <= self.window:
+				break
+
+			self._finalize(pending.popitem(last=False)[1])
+
+		key = (cat, psn, direction)
+		times = pending.get(key)
+
+		if times is None:
+			# One timestamp per vantage point, the last slot is the first sighting.
+			times = pending[key] = [None] * self.vantages + [ts]
+
+			if len(pending) > self.max_pending:
+				self._finalize(pending.popitem(last=False)[1])
+				self.evicted += 1
+
+		if times[vantage] is None:
+			times[vantage] = ts
+		else:
+			self.duplicates += 1
+
+
+	def _finalize(self, times):
+		"""
+		Internal. Accounts delays and losses of a packet along its path.
+		"""
+
+		times = times[:-1]
+		seen = [v for v, ts in enumerate(times) if ts is not None]
+		last = self.vantages - 1
+
+		if len(seen) == 1:
+			# Orientation is only known at the path ends.
+			if seen[0] == 0:
+				self.segments[(0, 1)].lost += 1
+			elif seen[0] == last:
+				self.segments[(last, last - 1)].lost += 1
+			else:
+				self.unattributed += 1
+
+			return
+
+		if times[seen[0]] <= times[seen[-1]]:
+			path = list(range(self.vantages))
+		else:
+			path = list(range(last, -1, -1))
+
+		positions = [i for i, v in enumerate(path) if times[v] is not None]
+		final = positions[-1]
+
+		for i in range(positions[0], len(path) - 1):
+			a, b = path[i], path[i + 1]
+
+			if times[a] is not None and times[b] is not None:
+				self.segments[(a, b)].add(times[b] - times[a])
+			elif i == final:
+				self.segments[(a, b)].lost += 1
+			elif times[b] is None:
+				# Seen further down the path, the capture missed it.
+				self.segments[(a, b)].missed += 1
+
+
+	def flush(self):
+		"""
+		Finalizes all pending packets.
+		"""
+
+		pending = self._pending
+
+		while pending:
+			self._finalize(pending.popitem(last=False)[1])
+
+
+	def summary(self):
+		return {
+			"segments" : dict(("%d->%d" % key, stats.summary()) for key, stats in sorted(self.segments.items())),
+			"unattributed" : self.unattributed,
+			"duplicates" : self.duplicates,
+			"evicted" : self.evicted
+		}
+
+
+def _sightings(vantage, path, direction):
+	"""
+	Internal. Yields (ts, vantage, cat, psn, direction) of the PLUS packets
+	in the capture at path.
+	"""
+
+	reader = open_capture(path)
+
+	try:
+		default = reader.linktype
+
+		for record in reader:
+			linktype = default if record.linktype is None else record.linktype
+			result = decapsulate(linktype, record.data)
+
+			if result is None:
+				continue
+
+			payload = record.data[result.payload_offset : result.payload_end]
+
+			if not detect_plus(payload):
+				continue
+
+			yield record.ts, vantage, get_cat(payload), get_psn(payload), direction(record.data, result)
+	finally:
+		reader.close()
+
+
+def correlate_traces(paths, window=1.0, direction=endpoint_direction, max_pending=1 << 20):
+	"""
+	Correlates the timestamp ordered captures at paths, taken at vantage
+	points in path order, with a streaming k-way merge. Returns the
+	Correlator with per segment delay and loss statistics.
+	"""
+
+	correlator = Correlator(len(paths), window, max_pending)
+	add = correlator.add
+	streams = [_sightings(i, path, direction) for i, path in enumerate(paths)]
+
+	for ts, vantage, cat, psn, dir_ in heapq.merge(*streams):
+		add(vantage, ts, cat, psn, dir_)
+
+	correlator.flush()
+
+	return correlator
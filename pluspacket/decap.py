@@ -0,0 +1,262 @@
+import collections
+import socket
+import struct
+
+from pluspacket.packet import _udp_header_len
+from pluspacket.pcap import LINKTYPE_ETHERNET, LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6
+
+
+LINKTYPE_NULL = 0
+LINKTYPE_LINUX_SLL = 113
+
+_ethertype_ipv4 = 0x0800
+_ethertype_ipv6 = 0x86DD
+_ethertype_vlan = (0x8100, 0x88A8, 0x9100)
+_ip_proto_udp = 17
+_ipv6_fragment = 44
+
+# Hop-by-hop, routing, destination options, AH, mobility, HIP, shim6.
+_ipv6_extensions = (0, 43, 60, 51, 135, 139, 140)
+
+_null_ipv6 = (24, 28, 30)
+
+_u16 = struct.Struct(">H")
+
+
+Decapsulated = collections.namedtuple("Decapsulated",
+	["family", "ip_offset", "udp_offset", "payload_offset", "payload_end"])
+
+
+def _ipv4(frame, pos):
+	"""
+	Internal. General IPv4 parser, pos is the offset of the IP header.
+	"""
+
+	if len(frame) < pos + 20 or frame[pos] >> 4 != 4:
+		return None
+
+	if frame[pos + 9] != _ip_proto_udp:
+		return None
+
+	# Fragments (except complete datagrams with DF) are not handled here.
+	if _u16.unpack_from(frame, pos + 6)[0] & 0x3FFF:
+		return None
+
+	udp = pos + (frame[pos] & 0x0F) * 4
+
+	return _udp(frame, socket.AF_INET, pos, udp)
+
+
+def _ipv6(frame, pos):
+	"""
+	Internal. General IPv6 parser that skips extension headers.
+	"""
+
+	if len(frame) < pos + 40 or frame[pos] >> 4 != 6:
+		return None
+
+	next_header = frame[pos + 6]
+	udp = pos + 40
+
+	while next_header != _ip_proto_udp:
+		if next_header == _ipv6_fragment:
+			# Unfragmented datagrams may still carry an atomic fragment header.
+			if len(frame) < udp + 8 or _u16.unpack_from(frame, udp + 2)[0] & 0xFFF9:
+				return None
+
+			next_header = frame[udp]
+			udp += 8
+		elif next_header in _ipv6_extensions:
+			if len(frame) < udp + 2:
+				return None
+
+			if next_header == 51:
+				length = (frame[udp + 1] + 2) * 4
+			else:
+				length = (frame[udp + 1] + 1) * 8
+
+			next_header = frame[udp]
+			udp += length
+		else:
+			return None
+
+	return _udp(frame, socket.AF_INET6, pos, udp)
+
+
+def _udp(frame, family, ip, udp):
+	"""
+	Internal. Builds the result once the UDP header has been found.
+	"""
+
+	if len(frame) < udp + _udp_header_len:
+		return None
+
+	end = udp + _u16.unpack_from(frame, udp + 4)[0]
+
+	if end > len(frame) or end < udp + _udp_header_len:
+		# Truncated capture or bogus length, use what is there.
+		end = len(frame)
+
+	return Decapsulated(family, ip, udp, udp + _udp_header_len, end)
+
+
+def _ip(frame, pos):
+	"""
+	Internal. Dispatches on the IP version.
+	"""
+
+	if len(frame) <= pos:
+		return None
+
+	version = frame[pos] >> 4
+
+	if version == 4:
+		return _ipv4(frame, pos)
+
+	if version == 6:
+		return _ipv6(frame, pos)
+
+	return None
+
+
+def _ethernet(frame, pos):
+	"""
+	Internal. Skips any number of VLAN tags. Returns the offset of the
+	IP header or None.
+	"""
+
+	if len(frame) < pos + 14:
+		return None
+
+	pos += 12
+	ethertype = _u16.unpack_from(frame, pos)[0]
+
+	while ethertype in _ethertype_vlan:
+		pos += 4
+
+		if len(frame) < pos + 2:
+			return None
+
+		ethertype = _u16.unpack_from(frame, pos)[0]
+
+	if ethertype in (_ethertype_ipv4, _ethertype_ipv6):
+		return pos + 2
+
+	return None
+
+
+def ip_header_offset(linktype, frame):
+	"""
+	Returns the offset of the IP header in a link-layer frame or None if
+	the frame does not carry IP.
+	"""
+
+	if linktype == LINKTYPE_ETHERNET:
+		return _ethernet(frame, 0)
+
+	if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+		return 0
+
+	if linktype == LINKTYPE_LINUX_SLL:
+		if len(frame) < 16:
+			return None
+
+		if _u16.unpack_from(frame, 14)[0] in (_ethertype_ipv4, _ethertype_ipv6):
+			return 16
+
+		return None
+
+	if linktype == LINKTYPE_NULL:
+		if len(frame) < 4:
+			return None
+
+		# The family is in the byte order of the capturing host.
+		family = struct.unpack_from("<L" if frame[0] else ">L", frame, 0)[0]
+
+		if family == 2 or family in _null_ipv6:
+			return 4
+
+		return None
+
+	raise ValueError("Unsupported link type %d" % linktype)
+
+
+def decapsulate(linktype, frame):
+	"""
+	Finds the UDP datagram in a link-layer frame. Returns a Decapsulated
+	tuple of offsets into frame or None if frame does not hold a complete
+	UDP header. Nothing is copied. Untagged Ethernet with IPv4 without
+	options or IPv6 without extension headers are recognized at fixed
+	offsets, everything else goes through the general parser.
+	"""
+
+	if linktype == LINKTYPE_ETHERNET:
+		n = len(frame)
+
+		if n >= 42 and frame[12] == 0x08 and frame[13] == 0x00 and frame[14] == 0x45 \
+				and frame[23] == _ip_proto_udp and frame[20] & 0x3F == 0 and frame[21] == 0:
+			end = 34 + ((frame[38] << 8) | frame[39])
+			return Decapsulated(socket.AF_INET, 14, 34, 42, end if 42 <= end <= n else n)
+
+		if n >= 62 and frame[12] == 0x86 and frame[13] == 0xDD and frame[20] == _ip_proto_udp:
+			end = 54 + ((frame[58] << 8) | frame[59])
+			return Decapsulated(socket.AF_INET6, 14, 54, 62, end if 62 <= end <= n else n)
+
+	pos = ip_header_offset(linktype, frame)
+
+	if pos is None:
+		return None
+
+	return _ip(frame, pos)
+
+
+def udp_payload_offset(linktype, frame):
+	"""
+	Returns the offset of the UDP payload in frame or None if frame does
+	not contain a UDP datagram.
+	"""
+
+	result = decapsulate(linktype, frame)
+
+	if result is None:
+		return None
+
+	return result.payload_offset
+
+
+def udp_payload(linktype, frame):
+	"""
+	Returns a memoryview of the UDP payload in frame (no copy) or None.
+	The view can be passed to detect_plus and parse_packet as is.
+	"""
+
+	result = decapsulate(linktype, frame)
+
+	if result is None:
+		return None
+
+	return memoryview(frame)[result.payload_offset : result.payload_end]
+
+
+def udp_payload_length(frame, result):
+	"""
+	Returns the length of the UDP payload of a decapsulated frame according
+	to the UDP header, i.e. the original length even if the capture was
+	truncated. Pass it as wire_len to parse_partial.
+	"""
+
+	return max(0, _u16.unpack_from(frame, result.udp_offset + 4)[0] - _udp_header_len)
+
+
+def ip_addresses(frame, result):
+	"""
+	Returns the (source, destination) addresses of a decapsulated frame
+	as packed bytes.
+	"""
+
+	ip = result.ip_offset
+
+	if result.family == socket.AF_INET:
+		return bytes(frame[ip + 12 : ip + 16]), bytes(frame[ip + 16 : ip + 20])
+
+	return bytes(frame[ip + 8 : ip + 24]), bytes(frame[ip + 24 : ip + 40])
@@ -0,0 +1,190 @@
+import base64
+import binascii
+
+from pluspacket.packet import _header_len
+
+
+FORMATS = ("json", "csv")
+ENCODINGS = ("hex", "base64", "length")
+
+FIELDS = ("ts", "cat", "psn", "pse", "l", "r", "s", "x", "magic", "pcf_type", "pcf_len",
+	"pcf_integrity", "pcf_value", "payload", "length")
+
+DEFAULT_FIELDS = ("ts", "cat", "psn", "pse", "l", "r", "s", "x", "pcf_type", "pcf_integrity",
+	"pcf_value", "payload")
+
+_binary_fields = ("pcf_value", "payload")
+_nullable_fields = ("ts", "pcf_type", "pcf_len", "pcf_integrity")
+
+
+def _length(p):
+	"""
+	Internal. Length of the encoded packet without encoding it.
+	"""
+
+	return _header_len(p) + len(p.payload)
+
+
+def _b64(value):
+	return base64.b64encode(value).decode("ascii")
+
+
+def _hex(value):
+	return binascii.hexlify(value).decode("ascii")
+
+
+def _compile(format, fields, encoding):
+	"""
+	Internal. Returns (header, function(ts, packet) -> line) for a schema.
+	The function is generated once so that a line is a single % operation
+	without intermediate dicts.
+	"""
+
+	json = format == "json"
+	null = "null" if json else ""
+	quote = "\"" if json else ""
+	namespace = {
+		"_null" : null,
+		"_bools" : ("false", "true") if json else ("0", "1"),
+		"_hex" : _hex,
+		"_b64" : _b64,
+		"_length" : _length
+	}
+	names = []
+	parts = []
+	exprs = []
+
+	for field in fields:
+		if field not in FIELDS:
+			raise ValueError("Unknown field %s." % field)
+
+		name = field
+
+		if field == "ts":
+			expr = "_null if ts is None else repr(ts)"
+		elif field in ("l", "r", "s", "x"):
+			expr = "_bools[bool(p.%s)]" % field
+		elif field == "length":
+			expr = "_length(p)"
+		elif field in _binary_fields:
+			value = "p.%s" % field
+
+			if encoding == "length":
+				name = field + "_len"
+				expr = "len(%s)" % value
+			else:
+				function = "_hex" if encoding == "hex" else "_b64"
+				expr = "'%s' + %s(%s) + '%s'" % (quote, function, value, quote)
+
+			if field == "pcf_value":
+				expr = "_null if p.pcf_value is None else %s" % expr
+		elif field in _nullable_fields:
+			expr = "_null if p.{0} is None else p.{0}".format(field)
+		else:
+			expr = "p.%s" % field
+
+		names.append(name)
+		exprs.append(expr)
+
+		if json:
+			parts.append("\"%s\":%%s" % name)
+		else:
+			parts.append("%s")
+
+	if json:
+		template = "{" + ",".join(parts) + "}\n"
+		header = ""
+	else:
+		template = ",".join(parts) + "\n"
+		header = ",".join(names) + "\n"
+
+	namespace["_template"] = template
+	line = eval("lambda ts, p: _template %% (%s,)" % ", ".join(exprs), namespace)
+
+	return header, line
+
+
+class PacketExporter():
+
+	def __init__(self, f, format="json", fields=DEFAULT_FIELDS, encoding="hex", buffer_lines=4096):
+		"""
+		Writes Packets as JSON lines or CSV (with a header line) to f, a
+		path or a text file object. fields selects the columns (see FIELDS)
+		and encoding how pcf_value and payload are written: hex, base64 or
+		just their length. Lines are written in chunks of buffer_lines.
+		"""
+
+		if format not in FORMATS:
+			raise ValueError("format must be one of %s" % ", ".join(FORMATS))
+
+		if encoding not in ENCODINGS:
+			raise ValueError("encoding must be one of %s" % ", ".join(ENCODINGS))
+
+		if isinstance(f, str):
+			self._f = open(f, "w")
+			self._owned = True
+		else:
+			self._f = f
+			self._owned = False
+
+		header, self._line = _compile(format, fields, encoding)
+		self._lines = []
+		self.buffer_lines = buffer_lines
+		self.count = 0
+
+		if header:
+			self._f.write(header)
+
+
+	def write(self, packet, ts=None):
+		self._lines.append(self._line(ts, packet))
+
+		if len(self._lines) >= self.buffer_lines:
+			self._drain()
+
+
+	def write_all(self, packets):
+		"""
+		Writes (ts, Packet) tuples.
+		"""
+
+		line = self._line
+		lines = self._lines
+		limit = self.buffer_lines
+
+		for ts, packet in packets:
+			lines.append(line(ts, packet))
+
+			if len(lines) >= limit:
+				self._drain()
+
+
+	def _drain(self):
+		"""
+		Internal. Writes the buffered lines in one go.
+		"""
+
+		if self._lines:
+			self.count += len(self._lines)
+			self._f.write("".join(self._lines))
+			self._lines.clear()
+
+
+	def flush(self):
+		self._drain()
+		self._f.flush()
+
+
+	def close(self):
+		self.flush()
+
+		if self._owned:
+			self._f.close()
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *args):
+		self.close()
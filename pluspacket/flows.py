@@ -0,0 +1,210 @@
+import struct
+
+from pluspacket.packet import _l_mask, _r_mask, _s_mask, _x_mask, _flags_mask, _magic_shift, _default_magic, _min_packet_len, _basic_header
+
+
+_flow_record = struct.Struct(">QQQddLLLLLL")
+
+
+class FlowState():
+	"""
+	Per-CAT counters. All fields are plain scalars so that a flow
+	can be packed into a fixed size record.
+	"""
+
+	__slots__ = ("cat", "packets", "bytes", "first_ts", "last_ts",
+		"l", "r", "s", "x", "last_psn", "last_pse")
+
+
+	def __init__(self, cat, ts=0.0):
+		self.cat = cat
+		self.packets = 0
+		self.bytes = 0
+		self.first_ts = ts
+		self.last_ts = ts
+		self.l = 0
+		self.r = 0
+		self.s = 0
+		self.x = 0
+		self.last_psn = 0
+		self.last_pse = 0
+
+
+	def update(self, ts, length, flags, psn, pse):
+		"""
+		Accounts a single packet.
+		"""
+
+		self.packets += 1
+		self.bytes += length
+		self.last_ts = ts
+
+		if flags:
+			if flags & _l_mask: self.l += 1
+			if flags & _r_mask: self.r += 1
+			if flags & _s_mask: self.s += 1
+			if flags & _x_mask: self.x += 1
+
+		self.last_psn = psn
+		self.last_pse = pse
+
+
+	def merge(self, other):
+		"""
+		Merges the counters of other (seen later in time) into this flow.
+		"""
+
+		self.packets += other.packets
+		self.bytes += other.bytes
+		self.first_ts = min(self.first_ts, other.first_ts)
+		self.last_ts = max(self.last_ts, other.last_ts)
+		self.l += other.l
+		self.r += other.r
+		self.s += other.s
+		self.x += other.x
+		self.last_psn = other.last_psn
+		self.last_pse = other.last_pse
+
+
+	def pack(self):
+		return _flow_record.pack(self.cat, self.packets, self.bytes,
+			self.first_ts, self.last_ts, self.l, self.r, self.s, self.x,
+			self.last_psn, self.last_pse)
+
+
+	@classmethod
+	def unpack_from(cls, buf, offset=0):
+		fields = _flow_record.unpack_from(buf, offset)
+
+		flow = cls(fields[0])
+		(flow.packets, flow.bytes, flow.first_ts, flow.last_ts,
+			flow.l, flow.r, flow.s, flow.x, flow.last_psn, flow.last_pse) = fields[1:]
+
+		return flow
+
+
+	def to_dict(self):
+		return dict((k, getattr(self, k)) for k in self.__slots__)
+
+
+class FlowTable():
+	"""
+	Tracks per-CAT state. The table remembers which flows changed since
+	the last call to clear_dirty so that snapshots can be incremental.
+	"""
+
+	record_len = _flow_record.size
+
+
+	def __init__(self):
+		self.flows = {}
+		self._dirty = set()
+
+
+	def update(self, ts, buf):
+		"""
+		Accounts a PLUS packet given as raw buffer (excl. UDP header). Only
+		the basic header is looked at so this is much cheaper than a
+		full parse_packet. Returns False if buf is not a PLUS packet.
+		"""
+
+		if len(buf) < _min_packet_len:
+			return False
+
+		magic_and_flags, cat, psn, pse = _basic_header.unpack_from(buf, 0)
+
+		if magic_and_flags >> _magic_shift != _default_magic:
+			return False
+
+		flow = self.flows.get(cat)
+
+		if flow is None:
+			flow = self.flows[cat] = FlowState(cat, ts)
+
+		flow.update(ts, len(buf), magic_and_flags & _flags_mask, psn, pse)
+		self._dirty.add(cat)
+
+		return True
+
+
+	def update_packet(self, ts, packet, length):
+		"""
+		Accounts an already parsed packet.
+		"""
+
+		flags = 0
+
+		if packet.l: flags |= _l_mask
+		if packet.r: flags |= _r_mask
+		if packet.s: flags |= _s_mask
+		if packet.x: flags |= _x_mask
+
+		flow = self.flows.get(packet.cat)
+
+		if flow is None:
+			flow = self.flows[packet.cat] = FlowState(packet.cat, ts)
+
+		flow.update(ts, length, flags, packet.psn, packet.pse)
+		self._dirty.add(packet.cat)
+
+
+	def merge(self, other):
+		"""
+		Merges another (later in time) table into this one.
+		"""
+
+		for cat, flow in other.flows.items():
+			mine = self.flows.get(cat)
+
+			if mine is None:
+				self.flows[cat] = flow
+			else:
+				mine.merge(flow)
+
+			self._dirty.add(cat)
+
+
+	def dirty(self):
+		"""
+		Returns the flows that changed since the last clear_dirty.
+		"""
+
+		flows = self.flows
+		return [flows[cat] for cat in self._dirty]
+
+
+	def clear_dirty(self):
+		self._dirty = set()
+
+
+	def get(self, cat):
+		return self.flows.get(cat)
+
+
+	def __len__(self):
+		return len(self.flows)
+
+
+	def __iter__(self):
+		return iter(self.flows.values())
+
+
+	def pack_flows(self, flows):
+		"""
+		Serializes flows to a compact buffer.
+		"""
+
+		return b"".join([flow.pack() for flow in flows])
+
+
+	def load_flows(self, buf):
+		"""
+		Loads flows from a buffer produced by pack_flows. Existing flows
+		with the same CAT are replaced.
+		"""
+
+		n = len(buf) // _flow_record.size
+
+		for i in range(n):
+			flow = FlowState.unpack_from(buf, i * _flow_record.size)
+			self.flows[flow.cat] = flow
@@ -0,0 +1,246 @@
+import random
+
+from pluspacket.packet import new_extended_packet, _default_magic, _magic_shift, _l_mask, _r_mask, _s_mask, _x_mask, _min_packet_len, _basic_header
+from pluspacket.pcap import UdpPcapWriter, UdpEncapsulator
+
+
+_psn_mask = 0xFFFFFFFF
+_magic = _default_magic << _magic_shift
+
+_default_payload_sizes = {0: 1, 64: 2, 512: 2, 1200: 4}
+_default_pcf_types = {0x01: 1}
+
+
+class _Association():
+
+	__slots__ = ("cat", "psn", "port")
+
+
+	def __init__(self, rnd, port):
+		self.cat = rnd.getrandbits(64)
+		self.psn = [rnd.getrandbits(32), rnd.getrandbits(32)]
+		self.port = port
+
+
+class TrafficGenerator():
+
+	def __init__(self, cats=1000, extended_ratio=0.0, pcf_types=None, pcf_len=(0, 8),
+			payload_sizes=None, loss=0.0, reorder=0.0, l_rate=0.0, r_rate=0.0,
+			stop_rate=0.0, rate=100000.0, start=0.0, seed=None):
+		"""
+		Generates synthetic PLUS traffic of cats concurrent associations.
+		Each packet belongs to a random association and direction, its PSE
+		echoes the last PSN of the other direction. A fraction extended_ratio
+		of the packets carries an extended header whose PCF type is drawn
+		from pcf_types ({type : weight}) with a PCF value of pcf_len (min, max)
+		bytes. Payload sizes are drawn from payload_sizes ({size : weight}).
+		loss is the probability that a packet is dropped after it consumed
+		its PSN, reorder the probability that a packet is held back and sent
+		after the next one. Packets get L and R set with probabilities l_rate
+		and r_rate, with probability stop_rate a packet carries S and ends
+		its association which is replaced by a new one. Timestamps start at
+		start and advance by 1/rate per packet.
+		"""
+
+		if cats < 1:
+			raise ValueError("Need at least one association.")
+
+		self._rnd = random.Random(seed)
+		self._assocs = [_Association(self._rnd, 10000 + i) for i in range(cats)]
+		self._next_port = 10000 + cats
+
+		self.extended_ratio = extended_ratio
+		self.loss = loss
+		self.reorder = reorder
+		self.l_rate = l_rate
+		self.r_rate = r_rate
+		self.stop_rate = stop_rate
+		self.ts = start
+		self._dt = 1.0 / rate
+
+		payload_sizes = payload_sizes or _default_payload_sizes
+		self._sizes = list(payload_sizes.keys())
+		self._size_weights = list(payload_sizes.values())
+		self._pool = bytes(self._rnd.getrandbits(8) for i in range(max(self._sizes)))
+
+		self._tails, self._tail_weights = self._encode_tails(pcf_types or _default_pcf_types, pcf_len)
+
+
+	def _encode_tails(self, pcf_types, pcf_len):
+		"""
+		Internal. Pre-encodes the extended part (everything after the basic
+		header) for a few PCF values of each type. Only the basic header
+		has to be encoded per packet.
+		"""
+
+		rnd = self._rnd
+		tails = []
+		weights = []
+
+		for pcf_type, weight in pcf_types.items():
+			variants = 1 if pcf_type == 0xFF else 8
+
+			for i in range(variants):
+				if pcf_type == 0xFF:
+					value, integrity = None, None
+				else:
+					value = bytes(rnd.getrandbits(8) for j in range(rnd.randint(pcf_len[0], pcf_len[1])))
+					integrity = rnd.randint(0, 3)
+
+				plus_packet = new_extended_packet(False, False, False, 0, 0, 0, pcf_type, integrity, value, b"")
+				tails.append(bytes(plus_packet.to_bytes()[_min_packet_len:]))
+				weights.append(weight / variants)
+
+		return tails, weights
+
+
+	def _generate(self, n):
+		"""
+		Internal. Returns up to n (ts, buf, port, direction) tuples.
+		"""
+
+		rnd = self._rnd
+		random_ = rnd.random
+		assocs = self._assocs
+		pool = self._pool
+		pack = _basic_header.pack
+		dt = self._dt
+		ts = self.ts
+
+		picks = rnd.choices(range(len(assocs)), k=n)
+		sizes = rnd.choices(self._sizes, self._size_weights, k=n)
+
+		if self.extended_ratio > 0:
+			tails = rnd.choices(self._tails, self._tail_weights, k=n)
+		else:
+			tails = None
+
+		extended_ratio = self.extended_ratio
+		loss = self.loss
+		reorder = self.reorder
+		l_rate = self.l_rate
+		r_rate = self.r_rate
+		stop_rate = self.stop_rate
+		events = l_rate > 0 or r_rate > 0 or stop_rate > 0
+
+		out = []
+		held = None
+
+		for i in range(n):
+			j = picks[i]
+			assoc = assocs[j]
+			direction = rnd.getrandbits(1)
+			psns = assoc.psn
+
+			psn = psns[direction] = (psns[direction] + 1) & _psn_mask
+			magic_and_flags = _magic
+
+			if events:
+				if l_rate and random_() < l_rate: magic_and_flags |= _l_mask
+				if r_rate and random_() < r_rate: magic_and_flags |= _r_mask
+
+				if stop_rate and random_() < stop_rate:
+					magic_and_flags |= _s_mask
+					assocs[j] = _Association(rnd, self._next_port)
+					self._next_port = (self._next_port + 1) & 0xFFFF or 1024
+
+			if tails is not None and random_() < extended_ratio:
+				magic_and_flags |= _x_mask
+				buf = b"".join((pack(magic_and_flags, assoc.cat, psn, psns[1 - direction]), tails[i], pool[:sizes[i]]))
+			else:
+				buf = pack(magic_and_flags, assoc.cat, psn, psns[1 - direction]) + pool[:sizes[i]]
+
+			if loss and random_() < loss:
+				continue
+
+			item = (ts, buf, assoc.port, direction)
+			ts += dt
+
+			if held is not None:
+				out.append(item)
+				out.append((ts, held[1], held[2], held[3]))
+				ts += dt
+				held = None
+			elif reorder and random_() < reorder:
+				held = item
+				ts -= dt
+			else:
+				out.append(item)
+
+		if held is not None:
+			out.append(held)
+			ts += dt
+
+		self.ts = ts
+
+		return out
+
+
+	def batch(self, n):
+		"""
+		Returns a list of (up to, due to loss) n PLUS packets as bytes.
+		"""
+
+		return [item[1] for item in self._generate(n)]
+
+
+	def packets(self, n, batch_size=4096):
+		"""
+		Yields (ts, buf, direction) for (up to) n packets. direction is 0 or
+		1 depending on which side of the association sent the packet.
+		"""
+
+		while n > 0:
+			k = min(n, batch_size)
+			n -= k
+
+			for item in self._generate(k):
+				yield item[0], item[1], item[3]
+
+
+	def write_pcap(self, f, n, batch_size=4096):
+		"""
+		Writes (up to) n packets wrapped in Ethernet/IPv4/UDP to a pcap file.
+		Each association gets its own port, the direction decides which
+		side is the source.
+		"""
+
+		encapsulators = {}
+
+		with UdpPcapWriter(f) as writer:
+			while n > 0:
+				k = min(n, batch_size)
+				n -= k
+
+				for ts, buf, port, direction in self._generate(k):
+					encapsulator = encapsulators.get((port, direction))
+
+					if encapsulator is None:
+						if direction:
+							encapsulator = UdpEncapsulator("10.0.0.2", "10.0.0.1", 9999, port)
+						else:
+							encapsulator = UdpEncapsulator("10.0.0.1", "10.0.0.2", port, 9999)
+
+						encapsulators[(port, direction)] = encapsulator
+
+					writer.write_payload(ts, buf, encapsulator)
+
+
+	def send(self, sock, addr, n, batch_size=4096):
+		"""
+		Sends (up to) n packets as fast as possible to addr. Returns the
+		number of packets sent.
+		"""
+
+		sent = 0
+		sendto = sock.sendto
+
+		while n > 0:
+			k = min(n, batch_size)
+			n -= k
+
+			for buf in self.batch(k):
+				sendto(buf, addr)
+				sent += 1
+
+		return sent
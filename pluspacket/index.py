@@ -0,0 +1,278 @@
+import array
+import bisect
+import mmap
+import os
+import struct
+import sys
+
+from pluspacket.packet import parse_packet, detect_plus, _cat_pos
+from pluspacket.pcap import parse_global_header, iter_buffer, _global_header_len, _record_header_len
+from pluspacket.decap import udp_payload
+
+
+_magic = b"PLSI"
+_version = 1
+_suffix = ".catidx"
+
+# magic, version, reserved, trace size, trace mtime (ns), block seconds, blocks
+_header = struct.Struct("<4sHHQQdL")
+# ts_min, ts_max, entries
+_block = struct.Struct("<ddQ")
+_cat = struct.Struct(">Q")
+
+
+def _le(a):
+	"""
+	Internal. The index is stored little endian.
+	"""
+
+	if sys.byteorder != "little":
+		a.byteswap()
+
+	return a
+
+
+class _Block():
+	"""
+	Internal. The PLUS packets of one time block: CATs sorted ascending,
+	with the record offsets of each CAT in file order.
+	"""
+
+	__slots__ = ("ts_min", "ts_max", "cats", "offsets")
+
+
+	def __init__(self, ts_min, ts_max, cats, offsets):
+		self.ts_min = ts_min
+		self.ts_max = ts_max
+		self.cats = cats
+		self.offsets = offsets
+
+
+	def lookup(self, cat):
+		lo = bisect.bisect_left(self.cats, cat)
+		hi = bisect.bisect_right(self.cats, cat, lo)
+
+		return self.offsets[lo:hi]
+
+
+def _make_block(ts_min, ts_max, entries):
+	entries.sort()
+
+	return _Block(ts_min, ts_max, array.array("Q", [cat for cat, offset in entries]),
+		array.array("Q", [offset for cat, offset in entries]))
+
+
+def _index_buffer(buf, block_seconds):
+	"""
+	Internal. Returns the blocks of the pcap file held in buf. Views into
+	buf do not outlive the call so the caller can close it.
+	"""
+
+	record, ts_div, _, linktype = parse_global_header(buf[:_global_header_len])
+	blocks = []
+	entries = []
+	start = ts_min = ts_max = None
+
+	for rec in iter_buffer(buf, _global_header_len, len(buf), record, ts_div):
+		payload = udp_payload(linktype, rec.data)
+
+		if payload is None or not detect_plus(payload):
+			continue
+
+		ts = rec.ts
+
+		if start is None:
+			start = ts_min = ts_max = ts
+		elif ts >= start + block_seconds:
+			blocks.append(_make_block(ts_min, ts_max, entries))
+			entries = []
+			start = ts_min = ts_max = ts
+		else:
+			ts_min = min(ts_min, ts)
+			ts_max = max(ts_max, ts)
+
+		entries.append((_cat.unpack_from(payload, _cat_pos[0])[0], rec.offset))
+
+	if entries:
+		blocks.append(_make_block(ts_min, ts_max, entries))
+
+	return blocks
+
+
+class TraceIndex():
+
+	def __init__(self, path, blocks, block_seconds, size=None, mtime=None):
+		"""
+		CAT index of the pcap file at path, see build and load.
+		"""
+
+		self.path = path
+		self.blocks = blocks
+		self.block_seconds = block_seconds
+		self.size = size
+		self.mtime = mtime
+
+
+	@classmethod
+	def build(cls, path, block_seconds=60.0):
+		"""
+		Indexes the classic pcap file at path: for every block_seconds of
+		trace time the sorted CATs of all PLUS packets and their record
+		offsets. Fragmented datagrams are not indexed.
+		"""
+
+		st = os.stat(path)
+
+		with open(path, "rb") as f:
+			if st.st_size <= _global_header_len:
+				return cls(path, [], block_seconds, st.st_size, st.st_mtime_ns)
+
+			with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+				blocks = _index_buffer(buf, block_seconds)
+
+		return cls(path, blocks, block_seconds, st.st_size, st.st_mtime_ns)
+
+
+	def save(self, index_path=None):
+		"""
+		Writes the index next to the trace (path + ".catidx") or to
+		index_path.
+		"""
+
+		with open(index_path or self.path + _suffix, "wb") as f:
+			f.write(_header.pack(_magic, _version, 0, self.size, self.mtime, self.block_seconds, len(self.blocks)))
+
+			for block in self.blocks:
+				f.write(_block.pack(block.ts_min, block.ts_max, len(block.cats)))
+				f.write(_le(array.array("Q", block.cats)).tobytes())
+				f.write(_le(array.array("Q", block.offsets)).tobytes())
+
+
+	@classmethod
+	def load(cls, path, index_path=None):
+		"""
+		Loads the index of the trace at path. Raises ValueError if it is
+		not an index or does not match the trace anymore.
+		"""
+
+		with open(index_path or path + _suffix, "rb") as f:
+			data = f.read()
+
+		if len(data) < _header.size:
+			raise ValueError("Not a CAT index.")
+
+		magic, version, _, size, mtime, block_seconds, count = _header.unpack_from(data, 0)
+
+		if magic != _magic or version != _version:
+			raise ValueError("Not a CAT index.")
+
+		st = os.stat(path)
+
+		if st.st_size != size or st.st_mtime_ns != mtime:
+			raise ValueError("CAT index is stale.")
+
+		pos = _header.size
+		blocks = []
+
+		for i in range(count):
+			ts_min, ts_max, n = _block.unpack_from(data, pos)
+			pos += _block.size
+			cats = array.array("Q")
+			offsets = array.array("Q")
+			cats.frombytes(data[pos : pos + 8 * n])
+			offsets.frombytes(data[pos + 8 * n : pos + 16 * n])
+			pos += 16 * n
+
+			if len(offsets) != n:
+				raise ValueError("Truncated CAT index.")
+
+			blocks.append(_Block(ts_min, ts_max, _le(cats), _le(offsets)))
+
+		return cls(path, blocks, block_seconds, size, mtime)
+
+
+	@classmethod
+	def open(cls, path, block_seconds=60.0, index_path=None):
+		"""
+		Loads the index of the trace at path (or from index_path), building
+		and saving it first if it is missing or stale. If it can not be
+		saved, e.g. next to a trace in a read-only directory, the index is
+		only kept in memory.
+		"""
+
+		try:
+			return cls.load(path, index_path)
+		except (OSError, ValueError):
+			index = cls.build(path, block_seconds)
+
+			try:
+				index.save(index_path)
+			except OSError:
+				pass
+
+			return index
+
+
+	def offsets(self, cat, start=None, end=None):
+		"""
+		Returns the record offsets of cat in blocks overlapping [start, end)
+		(seconds), in file order. Records near the ends of the range may
+		still be outside of it.
+		"""
+
+		result = []
+
+		for block in self.blocks:
+			if start is not None and block.ts_max < start:
+				continue
+
+			if end is not None and block.ts_min >= end:
+				continue
+
+			result.extend(block.lookup(cat))
+
+		return result
+
+
+	def query(self, cat, start=None, end=None):
+		"""
+		Yields (ts, Packet) of all packets of cat with start <= ts < end
+		(seconds). Only the indexed records are read and parsed.
+		"""
+
+		offsets = self.offsets(cat, start, end)
+
+		if not offsets:
+			return
+
+		with open(self.path, "rb") as f:
+			with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+				record, ts_div, _, linktype = parse_global_header(buf[:_global_header_len])
+
+				for offset in offsets:
+					sec, frac, caplen, _ = record.unpack_from(buf, offset)
+					ts = sec + frac / ts_div
+
+					if (start is not None and ts < start) or (end is not None and ts >= end):
+						continue
+
+					data = buf[offset + _record_header_len : offset + _record_header_len + caplen]
+
+					try:
+						packet = parse_packet(bytes(udp_payload(linktype, data)))
+					except ValueError:
+						# Malformed extended headers are indexed but skipped.
+						continue
+
+					yield ts, packet
+
+
+def query_traces(paths, cat, start=None, end=None, block_seconds=60.0):
+	"""
+	Yields (path, ts, Packet) of all packets of cat with start <= ts < end
+	in the given traces, using (and if needed building) their indexes.
+	"""
+
+	for path in paths:
+		for ts, packet in TraceIndex.open(path, block_seconds).query(cat, start, end):
+			yield path, ts, packet
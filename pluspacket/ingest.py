@@ -0,0 +1,88 @@
+from pluspacket.pcap import PcapReader
+from pluspacket.decap import udp_payload
+from pluspacket.flows import FlowTable
+from pluspacket.checkpoint import load_checkpoint
+
+
+def _state(sampler, reassembler):
+	"""
+	Internal. State checkpointed along with the table.
+	"""
+
+	state = {}
+
+	if sampler is not None:
+		state["sampler"] = sampler.get_state()
+
+	if reassembler is not None:
+		state["reassembler"] = reassembler.get_state()
+
+	return state or None
+
+
+def process_trace(path, table=None, checkpointer=None, resume=False, max_records=None, sampler=None, reassembler=None):
+	"""
+	Accounts all PLUS packets in the pcap file at path in table and returns
+	the table. If checkpointer is given checkpoints are taken periodically
+	and, if resume is set, processing continues from the last checkpoint.
+	max_records limits the number of records read in this call. If sampler
+	is given only the UDP payloads it accepts are accounted, its state is
+	checkpointed as well. If reassembler is given fragmented datagrams are
+	accounted once they are complete, fragments pending at a checkpoint
+	are part of it. Resuming gives the same result as an uninterrupted run,
+	so a checkpoint can only be resumed with a sampler and a reassembler
+	if it was taken with them, otherwise ValueError is raised.
+	"""
+
+	offset = None
+	records = 0
+
+	if resume and checkpointer is not None:
+		restored = load_checkpoint(checkpointer.path, with_state=True)
+
+		if restored is not None:
+			table, offset, records, state = restored
+
+			state = state or {}
+
+			for name, restorable in (("sampler", sampler), ("reassembler", reassembler)):
+				if (restorable is None) != (name not in state):
+					raise ValueError("Checkpoint was taken with a different %s setting, can not resume." % name)
+
+				if restorable is not None:
+					restorable.set_state(state[name])
+
+	if table is None:
+		table = FlowTable()
+
+	with PcapReader(path) as reader:
+		if offset is not None:
+			reader.seek(offset)
+
+		linktype = reader.linktype
+		update = table.update
+		n = 0
+
+		for record in reader:
+			if reassembler is None:
+				payload = udp_payload(linktype, record.data)
+			else:
+				payload = reassembler.udp_payload(record.ts, linktype, record.data)
+
+			if payload is not None:
+				if sampler is None or sampler.accept(payload, record.ts):
+					update(record.ts, payload)
+
+			records += 1
+			n += 1
+
+			if checkpointer is not None and checkpointer.due():
+				checkpointer.checkpoint(table, reader.tell(), records, _state(sampler, reassembler))
+
+			if max_records is not None and n >= max_records:
+				break
+
+		if checkpointer is not None:
+			checkpointer.checkpoint(table, reader.tell(), records, _state(sampler, reassembler))
+
+	return table
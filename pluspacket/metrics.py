@@ -0,0 +1,467 @@
+import bisect
+import http.server
+import math
+import os
+import socketserver
+import threading
+
+from pluspacket.batch import STATUS_OK, STATUS_TOO_SHORT, STATUS_BAD_MAGIC, STATUS_MISSING_PCF_TYPE, STATUS_MISSING_PCF_TYPE_2, STATUS_MISSING_PCF_LEN, STATUS_INCOMPLETE_PCF_VALUE
+
+
+_content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+_rtt_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+_reasons = {
+	STATUS_TOO_SHORT : "too_short",
+	STATUS_BAD_MAGIC : "bad_magic",
+	STATUS_MISSING_PCF_TYPE : "missing_pcf_type",
+	STATUS_MISSING_PCF_TYPE_2 : "missing_pcf_type",
+	STATUS_MISSING_PCF_LEN : "missing_pcf_len",
+	STATUS_INCOMPLETE_PCF_VALUE : "incomplete_pcf_value"
+}
+
+
+class _Cells():
+	"""
+	Internal. One list of numbers per thread. A thread only ever writes its
+	own list so updates need no lock, the lists are only summed up when
+	scraped. The lock is taken once per thread, when its list is created.
+	"""
+
+	def __init__(self, size):
+		self._size = size
+		self._local = threading.local()
+		self._cells = []
+		self._lock = threading.Lock()
+
+
+	def get(self):
+		try:
+			return self._local.cell
+		except AttributeError:
+			cell = self._local.cell = [0] * self._size
+
+			with self._lock:
+				self._cells.append(cell)
+
+			return cell
+
+
+	def sum(self):
+		with self._lock:
+			cells = list(self._cells)
+
+		return [sum(column) for column in zip(*cells)] if cells else [0] * self._size
+
+
+class _CounterCells(_Cells):
+
+	def __init__(self):
+		_Cells.__init__(self, 1)
+
+
+	def inc(self, n=1):
+		self.get()[0] += n
+
+
+class _HistogramCells(_Cells):
+
+	def __init__(self, buckets):
+		_Cells.__init__(self, len(buckets) + 2)
+		self._buckets = buckets
+
+
+	def observe(self, value):
+		cell = self.get()
+		cell[bisect.bisect_left(self._buckets, value)] += 1
+		cell[-1] += value
+
+
+class _Metric():
+	"""
+	Internal. Base of the metric types. labels() returns the accumulator
+	of a label set, which can be kept to skip the lookup on the hot path.
+	"""
+
+	kind = None
+
+
+	def __init__(self, name, help, labelnames=(), registry=None):
+		self.name = name
+		self.help = help
+		self.labelnames = tuple(labelnames)
+		self._children = {}
+		self._lock = threading.Lock()
+		self._extra = {}
+
+		if registry is not None:
+			registry.register(self)
+
+
+	def labels(self, *values):
+		"""
+		Returns the child for the given label values.
+		"""
+
+		child = self._children.get(values)
+
+		if child is None:
+			if len(values) != len(self.labelnames):
+				raise ValueError("Expected %d label values." % len(self.labelnames))
+
+			with self._lock:
+				child = self._children.setdefault(values, self._cells())
+
+		return child
+
+
+	def _cells(self):
+		"""
+		Internal. Returns new _Cells for one set of label values.
+		"""
+
+		raise NotImplementedError()
+
+
+	def _default(self):
+		if self.labelnames:
+			raise ValueError("Metric has labels, use labels().")
+
+		return self.labels()
+
+
+	def snapshot(self):
+		"""
+		Returns {label values : merged accumulator list}, including merged
+		snapshots of other processes.
+		"""
+
+		result = {values : child.sum() for values, child in list(self._children.items())}
+
+		for values, cell in self._extra.items():
+			if values in result:
+				result[values] = [a + b for a, b in zip(result[values], cell)]
+			else:
+				result[values] = list(cell)
+
+		return result
+
+
+	def merge(self, snapshot):
+		"""
+		Adds a snapshot, e.g. one sent back by a worker process.
+		"""
+
+		with self._lock:
+			for values, cell in snapshot.items():
+				mine = self._extra.get(values)
+				self._extra[values] = list(cell) if mine is None else [a + b for a, b in zip(mine, cell)]
+
+
+	def _samples(self):
+		"""
+		Internal. Yields (name, labelnames, values, value) per exposed sample.
+		"""
+
+		raise NotImplementedError()
+
+
+class Counter(_Metric):
+
+	kind = "counter"
+
+
+	def _cells(self):
+		return _CounterCells()
+
+
+	def inc(self, n=1):
+		self._default().inc(n)
+
+
+	def value(self, *values):
+		return self.snapshot().get(values, [0])[0]
+
+
+	def _samples(self):
+		for values, cell in sorted(self.snapshot().items()):
+			yield self.name, self.labelnames, values, cell[0]
+
+
+class Histogram(_Metric):
+
+	kind = "histogram"
+
+
+	def __init__(self, name, help, buckets, labelnames=(), registry=None):
+		"""
+		A histogram with the given upper bucket bounds; a +Inf bucket is
+		added. Every thread keeps one count per bucket plus the sum.
+		"""
+
+		self.buckets = tuple(sorted(buckets))
+		_Metric.__init__(self, name, help, labelnames, registry)
+
+
+	def _cells(self):
+		return _HistogramCells(self.buckets)
+
+
+	def observe(self, value):
+		self._default().observe(value)
+
+
+	def _samples(self):
+		bounds = [_format(bound) for bound in self.buckets] + ["+Inf"]
+		labelnames = self.labelnames + ("le",)
+
+		for values, cell in sorted(self.snapshot().items()):
+			total = 0
+
+			for bound, n in zip(bounds, cell):
+				total += n
+				yield self.name + "_bucket", labelnames, values + (bound,), total
+
+			yield self.name + "_sum", self.labelnames, values, cell[-1]
+			yield self.name + "_count", self.labelnames, values, total
+
+
+class Gauge(_Metric):
+
+	kind = "gauge"
+
+
+	def __init__(self, name, help, function, registry=None):
+		"""
+		A gauge whose value is read by calling function on scrape, e.g. the
+		number of active CATs of a table. Nothing is done on the packet path.
+		"""
+
+		self.function = function
+		_Metric.__init__(self, name, help, (), registry)
+
+
+	def value(self):
+		return self.function()
+
+
+	def _samples(self):
+		yield self.name, (), (), self.function()
+
+
+def _format(value):
+	"""
+	Internal. Formats a sample value the way Prometheus expects.
+	"""
+
+	if isinstance(value, float):
+		if math.isinf(value):
+			return "+Inf" if value > 0 else "-Inf"
+
+		if math.isnan(value):
+			return "NaN"
+
+		return repr(value)
+
+	return str(value)
+
+
+def _escape(value):
+	return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Registry():
+
+	def __init__(self):
+		"""
+		A set of metrics that are rendered together.
+		"""
+
+		self._metrics = []
+		self._lock = threading.Lock()
+
+
+	def register(self, metric):
+		with self._lock:
+			if any(other.name == metric.name for other in self._metrics):
+				raise ValueError("Metric %s already registered." % metric.name)
+
+			self._metrics.append(metric)
+
+		return metric
+
+
+	def counter(self, name, help, labelnames=()):
+		return Counter(name, help, labelnames, self)
+
+
+	def histogram(self, name, help, buckets, labelnames=()):
+		return Histogram(name, help, buckets, labelnames, self)
+
+
+	def gauge(self, name, help, function):
+		return Gauge(name, help, function, self)
+
+
+	def snapshot(self):
+		"""
+		Returns the merged accumulators of all counters and histograms as
+		picklable dict, see merge.
+		"""
+
+		return {metric.name : metric.snapshot() for metric in self._metrics if not isinstance(metric, Gauge)}
+
+
+	def merge(self, snapshot):
+		"""
+		Adds the snapshot of another registry with the same metrics, e.g.
+		one returned by a worker process.
+		"""
+
+		metrics = {metric.name : metric for metric in self._metrics}
+
+		for name, values in snapshot.items():
+			if name in metrics:
+				metrics[name].merge(values)
+
+
+	def render(self):
+		"""
+		Returns all metrics in the Prometheus text exposition format.
+		"""
+
+		lines = []
+
+		for metric in list(self._metrics):
+			lines.append("# HELP %s %s" % (metric.name, metric.help.replace("\\", "\\\\").replace("\n", "\\n")))
+			lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+
+			for name, labelnames, values, value in metric._samples():
+				if labelnames:
+					labels = ",".join("%s=\"%s\"" % (label, _escape(v)) for label, v in zip(labelnames, values))
+					lines.append("%s{%s} %s" % (name, labels, _format(value)))
+				else:
+					lines.append("%s %s" % (name, _format(value)))
+
+		return "\n".join(lines) + "\n"
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+	"""
+	Internal. Answers every GET with the rendered registry.
+	"""
+
+	def do_GET(self):
+		body = self.server.registry.render().encode("utf-8")
+
+		self.send_response(200)
+		self.send_header("Content-Type", _content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+	def address_string(self):
+		return str(self.client_address)
+
+
+	def log_message(self, format, *args):
+		pass
+
+
+class _HttpServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+	daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+
+def _start(server, registry):
+	server.registry = registry
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+
+	return server
+
+
+def serve_http(registry, host="127.0.0.1", port=9464):
+	"""
+	Serves registry over HTTP from a background thread. Returns the server,
+	call shutdown() and server_close() to stop it. Port 0 picks a free
+	port, see server.server_address.
+	"""
+
+	return _start(_HttpServer((host, port), _Handler), registry)
+
+
+def serve_unix(registry, path):
+	"""
+	Serves registry over HTTP on the Unix socket at path, e.g. for
+	curl --unix-socket path http://localhost/metrics.
+	"""
+
+	if os.path.exists(path):
+		os.unlink(path)
+
+	return _start(_UnixServer(path, _Handler), registry)
+
+
+class ObserverMetrics():
+
+	def __init__(self, registry=None, table=None):
+		"""
+		The standard metrics of an observer. Pass count_packet or
+		count_batch the parse results, observe_rtt the RTT samples (e.g. as
+		SummaryTable on_rtt) and a table (FlowTable, SummaryTable, ...) to
+		export its number of active CATs.
+		"""
+
+		self.registry = registry or Registry()
+		self.parsed = self.registry.counter("pluspacket_packets_parsed_total", "PLUS packets parsed.")
+		self.bytes = self.registry.counter("pluspacket_bytes_parsed_total", "Bytes of PLUS packets parsed.")
+		self.rejected = self.registry.counter("pluspacket_packets_rejected_total", "Datagrams rejected by the parser.", ("reason",))
+		self.rtt = self.registry.histogram("pluspacket_rtt_seconds", "RTT samples from PSN/PSE matching.", _rtt_buckets)
+
+		self._parsed = self.parsed.labels()
+		self._bytes = self.bytes.labels()
+		self._rtt = self.rtt.labels()
+
+		if table is not None:
+			self.registry.gauge("pluspacket_active_cats", "CATs currently held by the table.", lambda: len(table))
+
+
+	def count_packet(self, buf, status=STATUS_OK):
+		"""
+		Accounts one datagram with the given batch STATUS_* code.
+		"""
+
+		if status == STATUS_OK:
+			self._parsed.inc()
+			self._bytes.inc(len(buf))
+		else:
+			self.rejected.labels(_reasons[status]).inc()
+
+
+	def count_batch(self, result):
+		"""
+		Accounts a BatchResult of parse_batch.
+		"""
+
+		ok = 0
+		nbytes = 0
+
+		for buf, status in zip(result.bufs, result.status):
+			if status == STATUS_OK:
+				ok += 1
+				nbytes += len(buf)
+			else:
+				self.rejected.labels(_reasons[status]).inc()
+
+		self._parsed.inc(ok)
+		self._bytes.inc(nbytes)
+
+
+	def observe_rtt(self, sample):
+		self._rtt.observe(sample)
@@ -3,6 +3,9 @@ import struct
 
 _fmt_u64 = ">Q"
 _fmt_u32 = ">L"
+_u64 = struct.Struct(_fmt_u64)
+_u32 = struct.Struct(_fmt_u32)
+_basic_header = struct.Struct(">LQLL")
 _magic_shift = 4
 _flags_mask = 0x0F
 _default_magic = 0xd8007ff
@@ -140,6 +143,76 @@ def is_extended_packet(buf):
 	return get_x(buf)
 
 
+def set_psn(buf, psn):
+	"""
+	Overwrites PSN in a writable buffer (bytearray, memoryview, ...). It's
+	the caller's responsibility to make sure that buffer is large enough.
+	"""
+
+	_u32.pack_into(buf, _psn_pos[0], psn)
+
+
+def set_pse(buf, pse):
+	"""
+	Overwrites PSE in a writable buffer.
+	"""
+
+	_u32.pack_into(buf, _pse_pos[0], pse)
+
+
+def set_cat(buf, cat):
+	"""
+	Overwrites CAT in a writable buffer.
+	"""
+
+	_u64.pack_into(buf, _cat_pos[0], cat)
+
+
+def set_flags(buf, flags):
+	"""
+	Overwrites the flags (ORed bits) in a writable buffer. The magic value
+	is left alone. Changing X is the caller's business, the extended
+	header fields are not added or removed.
+	"""
+
+	# The flags are the low nibble of the last magic byte.
+	pos = _magic_pos[1] - 1
+	buf[pos] = (buf[pos] & ~_flags_mask & 0xFF) | (flags & _flags_mask)
+
+
+def _set_flag(buf, mask, value):
+	pos = _magic_pos[1] - 1
+
+	if value:
+		buf[pos] |= mask
+	else:
+		buf[pos] &= ~mask & 0xFF
+
+
+def set_l(buf, value):
+	"""
+	Sets or clears L in a writable buffer.
+	"""
+
+	_set_flag(buf, _l_mask, value)
+
+
+def set_r(buf, value):
+	"""
+	Sets or clears R in a writable buffer.
+	"""
+
+	_set_flag(buf, _r_mask, value)
+
+
+def set_s(buf, value):
+	"""
+	Sets or clears S in a writable buffer.
+	"""
+
+	_set_flag(buf, _s_mask, value)
+
+
 def parse_packet(buf):
 	"""
 	Parses a packet completely. This is a wrapper for the from_bytes method
@@ -149,6 +222,16 @@ def parse_packet(buf):
 	return Packet().from_bytes(buf)
 
 
+def parse_partial(buf, wire_len=None):
+	"""
+	Parses the header of a packet of which only the first bytes are in buf,
+	e.g. from a capture with a small snaplen. wire_len is the original
+	length of the packet. See PartialPacket.
+	"""
+
+	return PartialPacket().from_partial(buf, wire_len)
+
+
 def detect_plus_in_udp(buf):
 	"""
 	Tries to detect the presence of a PLUS header in UDP (incl. header)
@@ -186,6 +269,20 @@ def _any(xs):
 	return False
 
 
+def _header_len(packet):
+	"""
+	Internal. Length of the encoded header of packet (excl. payload).
+	"""
+
+	if not packet.x:
+		return _min_packet_len
+
+	if packet.pcf_type == _pcf_type_plus_payload:
+		return _min_packet_len + 1
+
+	return _min_packet_len + (3 if packet.pcf_type & 0x00FF == 0 else 2) + (packet.pcf_len or 0)
+
+
 def new_basic_packet(l, r, s, cat, psn, pse, payload):
 	"""
 	Creates a new packet with a basic header.
@@ -410,6 +507,52 @@ class	Packet():
 		Unparses the packet to bytes.
 		"""
 
+		buf = self._header()
+		buf += self.payload
+
+		return buf
+
+
+	def pack_into(self, buf, offset=0):
+		"""
+		Unparses the packet into the writable buffer buf (e.g. a bytearray,
+		mmap or memoryview) starting at offset. Returns the number of bytes
+		written.
+		"""
+
+		header = self._header()
+		end = offset + len(header)
+		n = len(self.payload)
+
+		if len(buf) < end + n:
+			raise ValueError("Buffer too small.")
+
+		buf[offset : end] = header
+		buf[end : end + n] = self.payload
+
+		return end + n - offset
+
+
+	def to_iovec(self, cache=None):
+		"""
+		Unparses the packet to a list of buffers, the header and the payload
+		(not copied), e.g. for socket.sendmsg. With a HeaderCache the header
+		of the flow is reused and only PSN and PSE are patched.
+		"""
+
+		header = self._header() if cache is None else cache.header(self)
+
+		if not len(self.payload):
+			return [header]
+
+		return [header, self.payload]
+
+
+	def _header(self):
+		"""
+		Internal. Unparses everything but the payload.
+		"""
+
 		if not self.is_valid():
 			raise ValueError("Internal state is not valid!")
 
@@ -428,12 +571,10 @@ class	Packet():
 		_put_u32(self.pse, buf)
 
 		if not self.x:
-			buf += self.payload
 			return buf
 
 		if self.pcf_type == 0xFF:
 			buf.append(0xFF)
-			buf += self.payload
 			return buf
 
 		if self.pcf_type & 0x00FF == 0:
@@ -445,6 +586,211 @@ class	Packet():
 
 		buf.append(self.pcf_len << 2 | self.pcf_integrity)
 		buf += self.pcf_value
-		buf += self.payload
 
 		return buf
+
+
+class HeaderCache():
+
+	def __init__(self, max_flows=1024):
+		"""
+		Encoded headers of up to max_flows flows (everything but PSN and
+		PSE equal) for Packet.to_iovec. The returned header is reused by
+		the next packet of the flow, so it must be sent before that.
+		"""
+
+		self.max_flows = max_flows
+		self._headers = {}
+
+
+	def header(self, packet):
+		pcf_value = packet.pcf_value
+
+		if pcf_value is not None and not isinstance(pcf_value, bytes):
+			pcf_value = bytes(pcf_value)
+
+		key = (packet.magic, packet.cat, packet.l, packet.r, packet.s, packet.x,
+			packet.pcf_type, packet.pcf_integrity, pcf_value)
+		buf = self._headers.get(key)
+
+		if buf is None:
+			buf = packet._header()
+
+			if len(self._headers) >= self.max_flows:
+				# Dicts keep insertion order, drop the oldest flow.
+				del self._headers[next(iter(self._headers))]
+
+			self._headers[key] = buf
+		else:
+			set_psn(buf, packet.psn)
+			set_pse(buf, packet.pse)
+
+		return buf
+
+
+	def __len__(self):
+		return len(self._headers)
+
+
+class PartialPacket(Packet):
+
+	def __init__(self):
+		"""
+		A Packet parsed from a truncated capture. wire_len is the original
+		length, payload_len the true payload length (None if the header
+		itself was cut) and truncated the names of the fields that were cut
+		or not captured at all. Fields that were not captured are None,
+		cut ones (pcf_value, payload) hold the captured bytes.
+		"""
+
+		Packet.__init__(self)
+
+		self.wire_len = None
+		self.payload_len = None
+		self.truncated = frozenset()
+
+
+	def to_dict(self):
+		d = Packet.to_dict(self)
+
+		d["wire_len"] = self.wire_len
+		d["payload_len"] = self.payload_len
+		d["truncated"] = sorted(self.truncated)
+
+		return d
+
+
+	def from_partial(self, buf, wire_len=None):
+		"""
+		Parses the captured bytes buf of a packet of wire_len bytes (default:
+		len(buf)). A complete packet is parsed exactly like from_bytes. Of a
+		truncated one every header field that was captured is decoded, the
+		magic value must be present. Raises ValueError if the header is not
+		valid at its original length.
+		"""
+
+		n = len(buf)
+
+		if wire_len is None:
+			wire_len = n
+
+		if wire_len < n:
+			raise ValueError("Wire length %d is shorter than the %d captured bytes." % (wire_len, n))
+
+		self.wire_len = wire_len
+
+		if n == wire_len:
+			self.from_bytes(buf)
+			self.payload_len = len(self.payload)
+
+			return self
+
+		if wire_len < _min_packet_len:
+			raise ValueError("Minimum length of a PLUS packet is 20 bytes.")
+
+		if n < _magic_pos[1]:
+			raise ValueError("Magic value was not captured.")
+
+		magicAndFlags = _get_u32(buf[_magic_pos[0] : _magic_pos[1]])
+
+		magic = magicAndFlags >> _magic_shift
+
+		if magic != _default_magic:
+			raise ValueError("Invalid Magic value: got %s but wanted %s" % (str(hex(magic)), str(hex(_default_magic))))
+
+		self.magic = magic
+
+		flags = magicAndFlags & _flags_mask
+
+		self.l = bool(flags & _l_mask)
+		self.r = bool(flags & _r_mask)
+		self.s = bool(flags & _s_mask)
+		self.x = bool(flags & _x_mask)
+
+		truncated = []
+
+		for name, pos, get in (("cat", _cat_pos, _get_u64), ("psn", _psn_pos, _get_u32), ("pse", _pse_pos, _get_u32)):
+			if n >= pos[1]:
+				setattr(self, name, get(buf[pos[0] : pos[1]]))
+			else:
+				truncated.append(name)
+
+		if self.x:
+			header_len = self._partial_extended(buf, wire_len, truncated)
+		else:
+			header_len = _min_packet_len
+
+		if header_len is None:
+			truncated.append("payload")
+		else:
+			self.payload = buf[header_len:]
+			self.payload_len = wire_len - header_len
+
+			if len(self.payload) < self.payload_len:
+				truncated.append("payload")
+
+		self.truncated = frozenset(truncated)
+
+		return self
+
+
+	def _partial_extended(self, buf, wire_len, truncated):
+		"""
+		Internal. Continues parsing a truncated extended header. Returns the
+		header length or None if it was not captured.
+		"""
+
+		n = len(buf)
+		pos = _min_packet_len
+		missing = ["pcf_type", "pcf_len", "pcf_integrity", "pcf_value"]
+
+		if wire_len <= pos:
+			raise ValueError("Extended header must have PCF_TYPE")
+
+		if n <= pos:
+			truncated.extend(missing)
+			return None
+
+		pcf_type = buf[pos]
+
+		if pcf_type == _pcf_type_plus_payload:
+			self.pcf_type = pcf_type
+			return pos + 1
+
+		if pcf_type == 0x00:
+			# One additional pcf_type byte
+			pos += 1
+
+			if wire_len <= pos:
+				raise ValueError("Missing additional PCF_TYPE byte")
+
+			if n <= pos:
+				truncated.extend(missing)
+				return None
+
+			pcf_type = buf[pos] << 8
+
+		self.pcf_type = pcf_type
+		pos += 1
+
+		if wire_len <= pos:
+			raise ValueError("Missing PCF_LEN and PCF_INTEGRITY")
+
+		if n <= pos:
+			truncated.extend(missing[1:])
+			return None
+
+		self.pcf_len = buf[pos] >> 2
+		self.pcf_integrity = buf[pos] & 0x03
+		pos += 1
+		end = pos + self.pcf_len
+
+		if end > wire_len:
+			raise ValueError("Incomplete PCF_VALUE")
+
+		self.pcf_value = buf[pos:end]
+
+		if end > n:
+			truncated.append("pcf_value")
+
+		return end
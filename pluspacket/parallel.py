@@ -0,0 +1,151 @@
+import mmap
+import multiprocessing
+import os
+
+from pluspacket.pcap import parse_global_header, iter_buffer, _global_header_len, _record_header_len
+from pluspacket.decap import udp_payload
+from pluspacket.flows import FlowTable
+
+
+_max_record_len = 262144
+_sync_depth = 16
+
+
+def _is_record(buf, pos, record, ts_div, snaplen):
+	"""
+	Internal. Returns True if a chain of plausible record headers starts
+	at pos. A single plausible header could be payload by chance, a chain
+	of _sync_depth of them practically can not.
+	"""
+
+	limit = snaplen or _max_record_len
+
+	for i in range(_sync_depth):
+		if pos == len(buf):
+			return True
+
+		if pos + _record_header_len > len(buf):
+			return False
+
+		sec, frac, caplen, wirelen = record.unpack_from(buf, pos)
+
+		if caplen > limit or caplen > wirelen or wirelen > _max_record_len or frac >= ts_div:
+			return False
+
+		pos += _record_header_len + caplen
+
+	return True
+
+
+def split_pcap(buf, chunks, exact=False):
+	"""
+	Splits the pcap file held in buf (e.g. an mmap) into at most chunks
+	record aligned (start, end) byte ranges of about equal size. By default
+	the record boundary nearest to each split point is found by looking
+	for a chain of plausible record headers, with exact set all record
+	headers from the start of the file are walked instead.
+	"""
+
+	record, ts_div, snaplen, _ = parse_global_header(buf[:_global_header_len])
+	size = len(buf)
+	targets = [_global_header_len + (size - _global_header_len) * i // chunks for i in range(1, chunks)]
+	boundaries = [_global_header_len]
+
+	if exact:
+		pos = _global_header_len
+
+		for target in targets:
+			while pos < target and pos < size:
+				pos += _record_header_len + record.unpack_from(buf, pos)[2]
+
+			if pos < size and pos > boundaries[-1]:
+				boundaries.append(pos)
+	else:
+		for target in targets:
+			pos = max(target, boundaries[-1] + 1)
+
+			while pos < size and not _is_record(buf, pos, record, ts_div, snaplen):
+				pos += 1
+
+			if pos < size:
+				boundaries.append(pos)
+
+	boundaries.append(size)
+
+	return [(boundaries[i], boundaries[i + 1]) for i in range(len(boundaries) - 1)]
+
+
+def _account(buf, start, end, factory):
+	"""
+	Internal. Accounts the records in [start, end) of buf.
+	"""
+
+	record, ts_div, _, linktype = parse_global_header(buf[:_global_header_len])
+	table = factory()
+	update = table.update
+
+	for rec in iter_buffer(buf, start, end, record, ts_div):
+		payload = udp_payload(linktype, rec.data)
+
+		if payload is not None:
+			update(rec.ts, payload)
+
+	return table
+
+
+def _worker(args):
+	"""
+	Internal. Runs in a worker process, only the result travels back.
+	"""
+
+	path, start, end, factory = args
+
+	with open(path, "rb") as f:
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+			return _account(buf, start, end, factory)
+
+
+def process_parallel(path, workers=None, chunks=None, factory=FlowTable, exact=False):
+	"""
+	Accounts all PLUS packets in the pcap file at path using workers
+	processes (default: one per CPU). The file is split into chunks
+	record aligned ranges (default: four per worker) which each worker
+	maps into memory and accounts into a fresh factory() table, e.g. a
+	FlowTable or CatSketch. The partial tables are merged in file order
+	so the result does not depend on scheduling and flows spanning chunk
+	boundaries end up exactly as with process_trace. Fragmented datagrams
+	are not reassembled.
+	"""
+
+	workers = workers or os.cpu_count() or 1
+	chunks = chunks or workers * 4
+
+	with open(path, "rb") as f:
+		if os.fstat(f.fileno()).st_size <= _global_header_len:
+			return factory()
+
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+			ranges = split_pcap(buf, chunks, exact)
+
+	tasks = [(path, start, end, factory) for start, end in ranges]
+
+	if workers == 1:
+		parts = map(_worker, tasks)
+	else:
+		pool = multiprocessing.Pool(workers)
+		parts = pool.imap(_worker, tasks)
+
+	try:
+		table = None
+
+		for part in parts:
+			if table is None:
+				table = part
+			else:
+				table.merge(part)
+	finally:
+		if workers != 1:
+			pool.close()
+			pool.join()
+
+	return table
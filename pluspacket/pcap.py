@@ -0,0 +1,689 @@
+import collections
+import socket
+import struct
+import sys
+
+
+_pcap_magic_us = 0xa1b2c3d4
+_pcap_magic_ns = 0xa1b23c4d
+_global_header_len = 24
+_record_header_len = 16
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+
+
+_ipv4_header = struct.Struct(">BBHHHBBH4s4s")
+_ipv6_header = struct.Struct(">LHBB16s16s")
+_udp_header = struct.Struct(">HHHH")
+
+
+_pcapng_shb = 0x0A0D0D0A
+_pcapng_idb = 0x00000001
+_pcapng_spb = 0x00000003
+_pcapng_epb = 0x00000006
+_pcapng_byte_order = 0x1A2B3C4D
+_pcapng_tsresol = 9
+
+
+# linktype is only set by readers whose records may differ in link type
+# (pcapng), otherwise the reader's linktype applies.
+PcapRecord = collections.namedtuple("PcapRecord", ["ts", "caplen", "wirelen", "data", "offset", "linktype"],
+	defaults=(None,))
+
+
+def _open(f, mode):
+	"""
+	Internal. Opens f if it is a path, otherwise returns it unchanged.
+	"""
+
+	if isinstance(f, (str, bytes)):
+		return open(f, mode), True
+
+	return f, False
+
+
+def _read_exactly(f, n):
+	"""
+	Internal. Reads exactly n bytes or returns None at a clean EOF.
+	"""
+
+	data = f.read(n)
+
+	if len(data) == n:
+		return data
+
+	if len(data) == 0:
+		return None
+
+	# Reading from a pipe may return short reads.
+	chunks = [data]
+	got = len(data)
+
+	while got < n:
+		data = f.read(n - got)
+
+		if len(data) == 0:
+			raise ValueError("Truncated pcap record.")
+
+		chunks.append(data)
+		got += len(data)
+
+	return b"".join(chunks)
+
+
+def parse_global_header(header):
+	"""
+	Parses the 24 byte pcap file header. Returns a tuple (record, ts_div,
+	snaplen, linktype) where record is the struct of the record headers
+	and ts_div the number of timestamp fractions per second.
+	"""
+
+	magic = struct.unpack("<L", header[:4])[0]
+
+	if magic in (_pcap_magic_us, _pcap_magic_ns):
+		endian = "<"
+	else:
+		magic = struct.unpack(">L", header[:4])[0]
+		endian = ">"
+
+	if magic == _pcap_magic_us:
+		ts_div = 1e6
+	elif magic == _pcap_magic_ns:
+		ts_div = 1e9
+	else:
+		raise ValueError("Not a pcap file: bad magic %s" % hex(magic))
+
+	_, _, _, _, snaplen, linktype = struct.unpack(endian + "HHlLLL", header[4:_global_header_len])
+
+	return struct.Struct(endian + "LLLL"), ts_div, snaplen, linktype
+
+
+def iter_buffer(buf, start, end, record, ts_div):
+	"""
+	Yields the records starting at offset start and before end of a pcap
+	file held in buf (e.g. an mmap). The data of the records are
+	memoryviews into buf, nothing is copied. record and ts_div are as
+	returned by parse_global_header.
+	"""
+
+	view = memoryview(buf)
+	unpack_from = record.unpack_from
+	pos = start
+
+	while pos < end:
+		if pos + _record_header_len > len(buf):
+			raise ValueError("Truncated pcap record.")
+
+		sec, frac, caplen, wirelen = unpack_from(buf, pos)
+		data_end = pos + _record_header_len + caplen
+
+		if data_end > len(buf):
+			raise ValueError("Truncated pcap record.")
+
+		yield PcapRecord(sec + frac / ts_div, caplen, wirelen, view[pos + _record_header_len : data_end], pos)
+
+		pos = data_end
+
+
+class PcapReader():
+
+	def __init__(self, f):
+		"""
+		Opens a classic pcap file. f can be a path or a binary file object.
+		The file object does not need to be seekable unless seek is used.
+		"""
+
+		self._f, self._owned = _open(f, "rb")
+
+		header = _read_exactly(self._f, _global_header_len)
+
+		if header is None:
+			raise ValueError("Empty pcap file.")
+
+		self._record, self._ts_div, self.snaplen, self.linktype = parse_global_header(header)
+		self._offset = _global_header_len
+
+
+	def tell(self):
+		"""
+		Returns the file offset of the next record.
+		"""
+
+		return self._offset
+
+
+	def seek(self, offset):
+		"""
+		Continues reading at offset which must be a value previously
+		returned by tell or a record's offset.
+		"""
+
+		self._f.seek(offset)
+		self._offset = offset
+
+
+	def read_record(self):
+		"""
+		Returns the next record or None at the end of the file.
+		"""
+
+		header = _read_exactly(self._f, _record_header_len)
+
+		if header is None:
+			return None
+
+		sec, frac, caplen, wirelen = self._record.unpack(header)
+
+		data = _read_exactly(self._f, caplen)
+
+		if data is None and caplen > 0:
+			raise ValueError("Truncated pcap record.")
+
+		offset = self._offset
+		self._offset += _record_header_len + caplen
+
+		return PcapRecord(sec + frac / self._ts_div, caplen, wirelen, data or b"", offset)
+
+
+	def __iter__(self):
+		while True:
+			record = self.read_record()
+
+			if record is None:
+				return
+
+			yield record
+
+
+	def close(self):
+		if self._owned:
+			self._f.close()
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *args):
+		self.close()
+
+
+class PcapngReader():
+
+	def __init__(self, f):
+		"""
+		Reads the packets of a pcapng file. f can be a path or a binary file
+		object which does not need to be seekable. Only enhanced and simple
+		packet blocks carry packets, all other blocks are skipped. linktype
+		is the link type of the first interface, records of interfaces
+		with a different link type carry their own.
+		"""
+
+		self._f, self._owned = _open(f, "rb")
+		self._offset = 0
+		self._interfaces = []
+		self._endian = None
+		self.linktype = None
+
+		block = self._read_block()
+
+		if block is None or block[0] != _pcapng_shb:
+			raise ValueError("Not a pcapng file.")
+
+		# The first interface usually follows right away.
+		self._pending = None
+
+		while self.linktype is None:
+			block = self._read_block()
+
+			if block is None:
+				break
+
+			if block[0] in (_pcapng_epb, _pcapng_spb):
+				self._pending = block
+				break
+
+
+	def _read_block(self):
+		"""
+		Internal. Returns (type, body, offset) of the next block or None.
+		"""
+
+		header = _read_exactly(self._f, 8)
+
+		if header is None:
+			return None
+
+		offset = self._offset
+
+		if header[:4] == b"\x0a\x0d\x0d\x0a":
+			body = _read_exactly(self._f, 4)
+
+			if body is None:
+				raise ValueError("Truncated pcapng block.")
+
+			if struct.unpack("<L", body)[0] == _pcapng_byte_order:
+				self._endian = "<"
+			elif struct.unpack(">L", body)[0] == _pcapng_byte_order:
+				self._endian = ">"
+			else:
+				raise ValueError("Bad pcapng byte order magic.")
+
+			# Interface IDs are per section.
+			self._interfaces = []
+			length = struct.unpack(self._endian + "L", header[4:])[0]
+			rest = _read_exactly(self._f, length - 12)
+			self._offset += length
+
+			return _pcapng_shb, body + (rest or b"")[:-4], offset
+
+		if self._endian is None:
+			raise ValueError("pcapng block before section header.")
+
+		block_type, length = struct.unpack(self._endian + "LL", header)
+
+		if length < 12 or length % 4:
+			raise ValueError("Bad pcapng block length %d" % length)
+
+		body = _read_exactly(self._f, length - 8)
+
+		if body is None:
+			raise ValueError("Truncated pcapng block.")
+
+		self._offset += length
+		body = body[:-4]
+
+		if block_type == _pcapng_idb:
+			self._interface(body)
+
+		return block_type, body, offset
+
+
+	def _interface(self, body):
+		"""
+		Internal. Registers an interface description block.
+		"""
+
+		linktype, _, snaplen = struct.unpack_from(self._endian + "HHL", body, 0)
+		ts_div = 1e6
+		pos = 8
+
+		while pos + 4 <= len(body):
+			code, length = struct.unpack_from(self._endian + "HH", body, pos)
+
+			if code == 0:
+				break
+
+			if code == _pcapng_tsresol and length >= 1:
+				resol = body[pos + 4]
+				ts_div = float(2 ** (resol & 0x7F) if resol & 0x80 else 10 ** resol)
+
+			pos += 4 + (length + 3) // 4 * 4
+
+		self._interfaces.append((linktype, snaplen, ts_div))
+
+		if self.linktype is None:
+			self.linktype = linktype
+
+
+	def tell(self):
+		return self._offset
+
+
+	def read_record(self):
+		"""
+		Returns the next record or None at the end of the file.
+		"""
+
+		while True:
+			if self._pending is not None:
+				block, self._pending = self._pending, None
+			else:
+				block = self._read_block()
+
+			if block is None:
+				return None
+
+			block_type, body, offset = block
+
+			if block_type == _pcapng_epb:
+				interface, high, low, caplen, wirelen = struct.unpack_from(self._endian + "LLLLL", body, 0)
+				linktype, _, ts_div = self._interfaces[interface]
+				ts = ((high << 32) | low) / ts_div
+				data = body[20 : 20 + caplen]
+			elif block_type == _pcapng_spb:
+				wirelen = struct.unpack_from(self._endian + "L", body, 0)[0]
+				linktype, snaplen, ts_div = self._interfaces[0]
+				caplen = min(wirelen, snaplen or wirelen, len(body) - 4)
+				ts = 0.0
+				data = body[4 : 4 + caplen]
+			else:
+				continue
+
+			return PcapRecord(ts, caplen, wirelen, data, offset, None if linktype == self.linktype else linktype)
+
+
+	def __iter__(self):
+		while True:
+			record = self.read_record()
+
+			if record is None:
+				return
+
+			yield record
+
+
+	def close(self):
+		if self._owned:
+			self._f.close()
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *args):
+		self.close()
+
+
+class _Prefixed():
+	"""
+	Internal. Puts bytes that were read to sniff the format back in front
+	of a file object.
+	"""
+
+	def __init__(self, prefix, f):
+		self._prefix = prefix
+		self._f = f
+
+
+	def read(self, n):
+		if not self._prefix:
+			return self._f.read(n)
+
+		data = self._prefix[:n]
+		self._prefix = self._prefix[n:]
+
+		if len(data) < n:
+			data += self._f.read(n - len(data))
+
+		return data
+
+
+	def close(self):
+		self._f.close()
+
+
+def open_capture(f):
+	"""
+	Opens a pcap or pcapng file (a path or a binary file object, e.g.
+	sys.stdin.buffer) and returns a reader for it.
+	"""
+
+	f, owned = _open(f, "rb")
+	magic = _read_exactly(f, 4) or b""
+
+	if magic == b"\x0a\x0d\x0d\x0a":
+		reader = PcapngReader(_Prefixed(magic, f))
+	else:
+		reader = PcapReader(_Prefixed(magic, f))
+
+	reader._owned = owned
+
+	return reader
+
+
+class PcapWriter():
+
+	def __init__(self, f, linktype=LINKTYPE_ETHERNET, snaplen=65535, nanosecond=False, buffer_size=1 << 20):
+		"""
+		Writes a classic pcap file. f can be a path or a binary file object.
+		Records are collected in a buffer of buffer_size bytes which is
+		written out in one go when full.
+		"""
+
+		self._f, self._owned = _open(f, "wb")
+		self._ts_mul = 10**9 if nanosecond else 10**6
+		self._record = struct.Struct("<LLLL")
+		self._buf = bytearray(buffer_size)
+		self._view = memoryview(self._buf)
+		self._pos = 0
+
+		magic = _pcap_magic_ns if nanosecond else _pcap_magic_us
+		self._f.write(struct.pack("<LHHlLLL", magic, 2, 4, 0, 0, snaplen, linktype))
+
+
+	def _reserve(self, n):
+		"""
+		Internal. Makes sure n bytes fit into the buffer and returns the
+		position to write them to.
+		"""
+
+		if self._pos + n > len(self._buf):
+			self.flush()
+
+			if n > len(self._buf):
+				self._view.release()
+				self._buf = bytearray(n)
+				self._view = memoryview(self._buf)
+
+		return self._pos
+
+
+	def _record_header(self, pos, ts, caplen, wirelen):
+		"""
+		Internal. Writes a record header into the buffer at pos.
+		"""
+
+		sec = int(ts)
+		frac = int(round((ts - sec) * self._ts_mul))
+
+		if frac >= self._ts_mul:
+			sec += 1
+			frac -= self._ts_mul
+
+		self._record.pack_into(self._buf, pos, sec, frac, caplen, caplen if wirelen is None else wirelen)
+
+
+	def write(self, ts, data, wirelen=None):
+		"""
+		Writes a single record with timestamp ts (seconds).
+		"""
+
+		n = len(data)
+		pos = self._reserve(_record_header_len + n)
+
+		self._record_header(pos, ts, n, wirelen)
+		pos += _record_header_len
+		self._view[pos : pos + n] = data
+		self._pos = pos + n
+
+
+	def write_batch(self, records):
+		"""
+		Writes (ts, data) tuples.
+		"""
+
+		write = self.write
+
+		for ts, data in records:
+			write(ts, data)
+
+
+	def flush(self):
+		if self._pos:
+			self._f.write(self._view[:self._pos])
+			self._pos = 0
+
+		self._f.flush()
+
+
+	def close(self):
+		self.flush()
+		self._view.release()
+
+		if self._owned:
+			self._f.close()
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *args):
+		self.close()
+
+
+def _ones_sum(data):
+	"""
+	Internal. One's complement sum of data as used by the internet checksum.
+	"""
+
+	if len(data) % 2:
+		data = bytes(data) + b"\x00"
+
+	s = sum(memoryview(data).cast("B").cast("H"))
+
+	while s >> 16:
+		s = (s & 0xFFFF) + (s >> 16)
+
+	# The sum was taken in host byte order.
+	if sys.byteorder == "little":
+		s = ((s & 0xFF) << 8) | (s >> 8)
+
+	return s
+
+
+def _fold(s):
+	while s >> 16:
+		s = (s & 0xFFFF) + (s >> 16)
+
+	return s
+
+
+class UdpEncapsulator():
+
+	def __init__(self, src="10.0.0.1", dst="10.0.0.2", sport=4000, dport=5000, udp_checksum=False):
+		"""
+		Builds Ethernet/IPv4 or Ethernet/IPv6 (depending on the address
+		family of src) and UDP headers around payloads. The headers are
+		pre-encoded and only the length fields and checksums are filled in
+		per packet. The IPv4 header checksum is always computed from a
+		precomputed partial sum, the UDP checksum only if udp_checksum is
+		set since it has to touch the payload.
+		"""
+
+		if ":" in src:
+			family = socket.AF_INET6
+			self.ipv6 = True
+		else:
+			family = socket.AF_INET
+			self.ipv6 = False
+
+		self._src = socket.inet_pton(family, src)
+		self._dst = socket.inet_pton(family, dst)
+		self.sport = sport
+		self.dport = dport
+		self.udp_checksum = udp_checksum
+
+		if self.ipv6:
+			self._eth = bytes(12) + b"\x86\xdd"
+			self.header_len = 14 + 40 + 8
+		else:
+			self._eth = bytes(12) + b"\x08\x00"
+			self.header_len = 14 + 20 + 8
+			# Everything but total length and checksum.
+			self._ip_partial = _ones_sum(_ipv4_header.pack(0x45, 0, 0, 0, 0x4000, 64, 17, 0, self._src, self._dst))
+
+		# Pseudo header without the length.
+		self._pseudo_partial = _ones_sum(self._src + self._dst) + 17
+
+
+	def pack_into(self, buf, offset, n):
+		"""
+		Writes the headers for a payload of n bytes into buf at offset. The
+		payload must already be present after the headers if the UDP
+		checksum is enabled.
+		"""
+
+		buf[offset : offset + 14] = self._eth
+		pos = offset + 14
+
+		if self.ipv6:
+			_ipv6_header.pack_into(buf, pos, 0x60000000, 8 + n, 17, 64, self._src, self._dst)
+			pos += 40
+		else:
+			total = 28 + n
+			checksum = ~_fold(self._ip_partial + total) & 0xFFFF
+			_ipv4_header.pack_into(buf, pos, 0x45, 0, total, 0, 0x4000, 64, 17, checksum, self._src, self._dst)
+			pos += 20
+
+		_udp_header.pack_into(buf, pos, self.sport, self.dport, 8 + n, 0)
+
+		if self.udp_checksum:
+			s = _fold(self._pseudo_partial + 8 + n + _ones_sum(memoryview(buf)[pos : pos + 8 + n]))
+			checksum = ~s & 0xFFFF
+			struct.pack_into(">H", buf, pos + 6, checksum or 0xFFFF)
+
+
+	def frame(self, payload):
+		"""
+		Returns payload wrapped in the headers.
+		"""
+
+		n = len(payload)
+		buf = bytearray(self.header_len + n)
+		buf[self.header_len:] = payload
+		self.pack_into(buf, 0, n)
+
+		return buf
+
+
+class UdpPcapWriter(PcapWriter):
+
+	def __init__(self, f, encapsulator=None, **kwargs):
+		"""
+		A PcapWriter for PLUS packets which are wrapped in synthetic
+		Ethernet/IP/UDP headers by encapsulator (a UdpEncapsulator). The
+		packets are encoded directly into the write buffer.
+		"""
+
+		PcapWriter.__init__(self, f, LINKTYPE_ETHERNET, **kwargs)
+		self.encapsulator = encapsulator or UdpEncapsulator()
+
+
+	def write_payload(self, ts, payload, encapsulator=None):
+		"""
+		Writes raw PLUS bytes. encapsulator overrides the default one, e.g.
+		to use different addresses per flow.
+		"""
+
+		encapsulator = encapsulator or self.encapsulator
+		hlen = encapsulator.header_len
+		n = len(payload)
+		pos = self._reserve(_record_header_len + hlen + n)
+
+		start = pos + _record_header_len + hlen
+		self._view[start : start + n] = payload
+		encapsulator.pack_into(self._buf, pos + _record_header_len, n)
+		self._record_header(pos, ts, hlen + n, None)
+		self._pos = start + n
+
+
+	def write_packet(self, ts, packet, encapsulator=None, max_len=65507):
+		"""
+		Writes a Packet using its pack_into method.
+		"""
+
+		encapsulator = encapsulator or self.encapsulator
+		hlen = encapsulator.header_len
+		pos = self._reserve(_record_header_len + hlen + max_len)
+
+		start = pos + _record_header_len + hlen
+		n = packet.pack_into(self._view[:start + max_len], start)
+		encapsulator.pack_into(self._buf, pos + _record_header_len, n)
+		self._record_header(pos, ts, hlen + n, None)
+		self._pos = start + n
@@ -0,0 +1,481 @@
+import array
+import collections
+import concurrent.futures
+import queue
+import socket
+import threading
+import time
+
+from pluspacket.pcap import open_capture
+from pluspacket.decap import decapsulate
+from pluspacket.batch import BatchResult, parse_batch, STATUS_OK, _fields
+
+
+class Chunk():
+	"""
+	A batch of UDP payloads (excl. UDP header) and their timestamps that
+	travels through a Pipeline. result holds the header fields as one
+	array per field once parse_chunk ran, stages can keep further columns
+	(one entry per payload) in extra.
+	"""
+
+	__slots__ = ("ts", "bufs", "result", "extra")
+
+
+	def __init__(self, ts, bufs, result=None, extra=None):
+		self.ts = ts
+		self.bufs = bufs
+		self.result = result
+		self.extra = {} if extra is None else extra
+
+
+	def __len__(self):
+		return len(self.bufs)
+
+
+	def select(self, keep):
+		"""
+		Returns a Chunk of the payloads whose entry in keep (a sequence of
+		booleans, e.g. a numpy array) is true, all columns are selected
+		the same way.
+		"""
+
+		indexes = [i for i, k in enumerate(keep) if k]
+
+		if len(indexes) == len(self.bufs):
+			return self
+
+		bufs = [self.bufs[i] for i in indexes]
+		result = None
+
+		if self.result is not None:
+			result = BatchResult.__new__(BatchResult)
+			result.bufs = bufs
+
+			for name, typecode in _fields:
+				column = getattr(self.result, name)
+				setattr(result, name, array.array(typecode, [column[i] for i in indexes]))
+
+		extra = dict((name, [column[i] for i in indexes]) for name, column in self.extra.items())
+
+		return Chunk([self.ts[i] for i in indexes], bufs, result, extra)
+
+
+	def __reduce__(self):
+		# Payloads are usually memoryviews which can not be pickled.
+		bufs = [bytes(buf) for buf in self.bufs]
+		columns = None
+
+		if self.result is not None:
+			columns = [getattr(self.result, name) for name, typecode in _fields]
+
+		return _restore_chunk, (self.ts, bufs, columns, self.extra)
+
+
+def _restore_chunk(ts, bufs, columns, extra):
+	"""
+	Internal. Unpickles a Chunk.
+	"""
+
+	result = None
+
+	if columns is not None:
+		result = BatchResult.__new__(BatchResult)
+		result.bufs = bufs
+
+		for (name, typecode), column in zip(_fields, columns):
+			setattr(result, name, column)
+
+	return Chunk(ts, bufs, result, extra)
+
+
+def pcap_source(path, batch_size=1024):
+	"""
+	Yields Chunks of up to batch_size UDP payloads from the pcap or pcapng
+	file at path. The payloads are memoryviews into the records, frames
+	without a UDP datagram are skipped.
+	"""
+
+	reader = open_capture(path)
+
+	try:
+		default = reader.linktype
+		ts = []
+		bufs = []
+
+		for record in reader:
+			linktype = default if record.linktype is None else record.linktype
+			result = decapsulate(linktype, record.data)
+
+			if result is None:
+				continue
+
+			ts.append(record.ts)
+			bufs.append(memoryview(record.data)[result.payload_offset : result.payload_end])
+
+			if len(bufs) >= batch_size:
+				yield Chunk(ts, bufs)
+				ts = []
+				bufs = []
+
+		if bufs:
+			yield Chunk(ts, bufs)
+	finally:
+		reader.close()
+
+
+def socket_source(sock, batch_size=64, stop=None, timeout=0.1, bufsize=65535):
+	"""
+	Yields Chunks of datagrams received on sock until stop (a
+	threading.Event) is set or sock is closed. A Chunk is handed on when
+	batch_size datagrams arrived or nothing arrived for timeout seconds.
+	"""
+
+	sock.settimeout(timeout)
+	ts = []
+	bufs = []
+
+	while stop is None or not stop.is_set():
+		try:
+			data = sock.recv(bufsize)
+		except socket.timeout:
+			if bufs:
+				yield Chunk(ts, bufs)
+				ts = []
+				bufs = []
+
+			continue
+		except OSError:
+			break
+
+		ts.append(time.time())
+		bufs.append(data)
+
+		if len(bufs) >= batch_size:
+			yield Chunk(ts, bufs)
+			ts = []
+			bufs = []
+
+	if bufs:
+		yield Chunk(ts, bufs)
+
+
+def parse_chunk(chunk):
+	"""
+	Stage that parses the headers of a Chunk into result (see parse_batch)
+	and drops payloads that are not PLUS packets.
+	"""
+
+	chunk.result = parse_batch(chunk.bufs)
+
+	return chunk.select([status == STATUS_OK for status in chunk.result.status])
+
+
+class Filter():
+
+	def __init__(self, mask):
+		"""
+		Stage that keeps the payloads of a Chunk for which mask(chunk), a
+		sequence of booleans, is true. Chunks that end up empty are dropped.
+		"""
+
+		self.mask = mask
+		self.__name__ = "filter"
+
+
+	def __call__(self, chunk):
+		chunk = chunk.select(self.mask(chunk))
+
+		return chunk if len(chunk) else None
+
+
+class StageStats():
+
+	def __init__(self, name):
+		"""
+		Counters of a stage. busy is the time spent in the stage function
+		(for pooled stages the time from handing a Chunk to the pool until
+		its result is collected), blocked the time spent waiting for room
+		in the queue of the next threaded stage, i.e. backpressure.
+		"""
+
+		self.name = name
+		self.chunks = 0
+		self.items_in = 0
+		self.items_out = 0
+		self.busy = 0.0
+		self.blocked = 0.0
+		self.max_latency = 0.0
+
+
+	def add(self, items_in, items_out, latency):
+		self.chunks += 1
+		self.items_in += items_in
+		self.items_out += items_out
+		self.busy += latency
+
+		if latency > self.max_latency:
+			self.max_latency = latency
+
+
+	def summary(self):
+		return {
+			"chunks" : self.chunks,
+			"items_in" : self.items_in,
+			"items_out" : self.items_out,
+			"busy" : self.busy,
+			"blocked" : self.blocked,
+			"items_per_second" : self.items_out / self.busy if self.busy > 0 else 0.0,
+			"mean_latency" : self.busy / self.chunks if self.chunks else 0.0,
+			"max_latency" : self.max_latency
+		}
+
+
+class Stage():
+
+	def __init__(self, function, name=None, workers=0, processes=False):
+		"""
+		A pipeline stage. function(chunk) returns a Chunk or None to drop
+		it. With workers 0 the stage runs in the thread of the stage before
+		it, with 1 in a thread of its own and with more (or processes set)
+		Chunks are handed to a pool of workers threads or processes, in
+		order. Process stages need a picklable function.
+		"""
+
+		self.function = function
+		self.name = name or getattr(function, "__name__", type(function).__name__)
+		self.workers = workers
+		self.processes = processes
+		self.stats = StageStats(self.name)
+
+
+	def pooled(self):
+		return self.processes or self.workers > 1
+
+
+	def __call__(self, chunk):
+		start = time.perf_counter()
+		out = self.function(chunk)
+		self.stats.add(len(chunk), 0 if out is None else len(out), time.perf_counter() - start)
+
+		return out
+
+
+	def map(self, chunks):
+		"""
+		Internal. Runs the pool over chunks keeping two Chunks per worker
+		in flight, yields the results in order.
+		"""
+
+		if self.processes:
+			executor = concurrent.futures.ProcessPoolExecutor(self.workers or 1)
+		else:
+			executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+
+		window = 2 * (self.workers or 1)
+		pending = collections.deque()
+
+		with executor:
+			for chunk in chunks:
+				pending.append((time.perf_counter(), len(chunk), executor.submit(self.function, chunk)))
+
+				if len(pending) >= window:
+					yield self._collect(*pending.popleft())
+
+			while pending:
+				yield self._collect(*pending.popleft())
+
+
+	def _collect(self, start, n, future):
+		out = future.result()
+		self.stats.add(n, 0 if out is None else len(out), time.perf_counter() - start)
+
+		return out
+
+
+class _Aborted(Exception):
+	pass
+
+
+_end = object()
+
+
+class Pipeline():
+
+	def __init__(self, source, stages=(), queue_size=4):
+		"""
+		Runs the Chunks of source (any iterable of Chunks, e.g. pcap_source)
+		through stages (Stage objects, plain functions run inline). Each
+		threaded stage reads from a queue of queue_size Chunks, when it
+		falls behind the stages before it block instead of buffering
+		without bound. stats maps stage names to StageStats, the time spent
+		producing Chunks is accounted as "source".
+		"""
+
+		self.source = source
+		self.queue_size = queue_size
+		self.stages = []
+		self.stats = collections.OrderedDict([("source", StageStats("source"))])
+
+		for stage in stages:
+			self.add(stage)
+
+
+	def add(self, function, name=None, workers=0, processes=False):
+		"""
+		Appends a stage (a function or Stage) and returns the pipeline.
+		"""
+
+		stage = function if isinstance(function, Stage) else Stage(function, name, workers, processes)
+
+		if stage.name in self.stats:
+			stage.name = "%s_%d" % (stage.name, len(self.stats))
+			stage.stats.name = stage.name
+
+		self.stages.append(stage)
+		self.stats[stage.name] = stage.stats
+
+		return self
+
+
+	def _source(self):
+		"""
+		Internal. Iterates over the source accounting its time.
+		"""
+
+		stats = self.stats["source"]
+		chunks = iter(self.source)
+
+		while True:
+			start = time.perf_counter()
+
+			try:
+				chunk = next(chunks)
+			except StopIteration:
+				return
+
+			stats.add(0, len(chunk), time.perf_counter() - start)
+
+			yield chunk
+
+
+	def _get(self, inbox):
+		"""
+		Internal. Yields the Chunks of inbox until the end or an abort.
+		"""
+
+		while True:
+			try:
+				chunk = inbox.get(timeout=0.1)
+			except queue.Empty:
+				if self._abort.is_set():
+					return
+
+				continue
+
+			if chunk is _end:
+				return
+
+			yield chunk
+
+
+	def _put(self, outbox, chunk, stats):
+		start = time.perf_counter()
+
+		while True:
+			try:
+				outbox.put(chunk, timeout=0.1)
+				break
+			except queue.Full:
+				if self._abort.is_set():
+					raise _Aborted()
+
+		stats.blocked += time.perf_counter() - start
+
+
+	def _segment(self, chunks, stages, outbox, stats):
+		"""
+		Internal. Runs chunks through the inline stages and hands them to
+		the next threaded stage. Errors abort the whole pipeline.
+		"""
+
+		try:
+			for chunk in chunks:
+				if chunk is None:
+					continue
+
+				for stage in stages:
+					chunk = stage(chunk)
+
+					if chunk is None:
+						break
+				else:
+					if outbox is not None:
+						self._put(outbox, chunk, stats)
+
+			if outbox is not None:
+				self._put(outbox, _end, stats)
+		except _Aborted:
+			pass
+		except BaseException as e:
+			if self._error is None:
+				self._error = e
+
+			self._abort.set()
+
+
+	def run(self):
+		"""
+		Runs the pipeline until the source is exhausted, the source and the
+		stages before the first threaded one run in the calling thread.
+		Returns the summaries of stats. An exception in any stage stops
+		the pipeline and is raised here.
+		"""
+
+		self._abort = threading.Event()
+		self._error = None
+
+		# Every threaded stage starts a segment of stages run by one thread.
+		segments = [(None, [])]
+
+		for stage in self.stages:
+			if stage.pooled():
+				segments.append((stage, []))
+			elif stage.workers:
+				segments.append((None, [stage]))
+			else:
+				segments[-1][1].append(stage)
+
+		queues = [queue.Queue(self.queue_size) for _ in segments[1:]]
+		threads = []
+
+		for i, (head, stages) in enumerate(segments):
+			if i == 0:
+				continue
+
+			chunks = self._get(queues[i - 1])
+
+			if head is not None:
+				chunks = head.map(chunks)
+
+			last = (stages or [head])[-1]
+			outbox = queues[i] if i < len(queues) else None
+			thread = threading.Thread(target=self._segment, args=(chunks, stages, outbox, last.stats), daemon=True)
+			thread.start()
+			threads.append(thread)
+
+		stages = segments[0][1]
+		stats = stages[-1].stats if stages else self.stats["source"]
+		self._segment(self._source(), stages, queues[0] if queues else None, stats)
+
+		for thread in threads:
+			thread.join()
+
+		if self._error is not None:
+			raise self._error
+
+		return self.summary()
+
+
+	def summary(self):
+		return collections.OrderedDict((name, stats.summary()) for name, stats in self.stats.items())
@@ -0,0 +1,301 @@
+import collections
+import selectors
+import socket
+import time
+
+from pluspacket.packet import _default_magic, _magic_shift, _flags_mask, _min_packet_len, _basic_header
+from pluspacket.sketches import Reservoir
+
+
+DOWNSTREAM = 0
+UPSTREAM = 1
+
+
+def _family(host):
+	return socket.AF_INET6 if ":" in host else socket.AF_INET
+
+
+class ForwardStats():
+
+	def __init__(self, samples=8192):
+		"""
+		Statistics of the forwarding path. The latency (from the datagram
+		being received to it being sent on) is kept exactly as mean and
+		maximum, its percentiles are estimated from a Reservoir of samples
+		values.
+		"""
+
+		self.packets = 0
+		self.bytes = 0
+		self.plus = 0
+		self.dropped = 0
+		self.expired = 0
+		self.max_latency = 0.0
+		self._sum_latency = 0.0
+		self._reservoir = Reservoir(samples)
+
+
+	def add(self, nbytes, latency):
+		self.packets += 1
+		self.bytes += nbytes
+		self._sum_latency += latency
+
+		if latency > self.max_latency:
+			self.max_latency = latency
+
+		self._reservoir.add(latency)
+
+
+	def percentile(self, q):
+		"""
+		Returns the q-th (0..100) percentile of the latency in seconds.
+		"""
+
+		return self._reservoir.percentile(q, 0.0)
+
+
+	def summary(self):
+		return {
+			"packets" : self.packets,
+			"bytes" : self.bytes,
+			"plus" : self.plus,
+			"dropped" : self.dropped,
+			"expired" : self.expired,
+			"mean_latency" : self._sum_latency / self.packets if self.packets else 0.0,
+			"p50_latency" : self.percentile(50),
+			"p99_latency" : self.percentile(99),
+			"p999_latency" : self.percentile(99.9),
+			"max_latency" : self.max_latency
+		}
+
+
+class PlusProxy():
+
+	def __init__(self, listen, upstream, batch=32, buffer_size=65535, on_packet=None, clock=time.perf_counter, samples=8192,
+		idle_timeout=60.0, max_clients=4096):
+		"""
+		Forwards UDP datagrams received on listen (host, port) to upstream
+		and the replies back to the client they belong to, every client
+		gets its own upstream socket like behind a NAT. Datagrams are
+		received into preallocated buffers and sent on from the same
+		buffer unchanged, only the basic PLUS header is read in place to
+		account packets and bytes per CAT in cats. on_packet(direction,
+		view, flags, cat, psn, pse) is called for every PLUS packet before
+		it is forwarded, view is only valid during the call. Up to batch
+		queued datagrams are received per readiness event before they are
+		sent on. The upstream socket of a client is closed once no datagram
+		went either way for idle_timeout seconds (None keeps it) or, when
+		there are max_clients, for the client that was idle the longest.
+		"""
+
+		self.upstream = upstream
+		self.batch = batch
+		self.on_packet = on_packet
+		self.clock = clock
+		self.idle_timeout = idle_timeout
+		self.max_clients = max_clients
+		self.stats = ForwardStats(samples)
+		self.cats = {}
+
+		self.sock = socket.socket(_family(listen[0]), socket.SOCK_DGRAM)
+		self.sock.bind(listen)
+		self.sock.setblocking(False)
+		self.address = self.sock.getsockname()
+
+		# client -> [upstream socket, last activity], least recently active first.
+		self._clients = collections.OrderedDict()
+		self._selector = selectors.DefaultSelector()
+		self._selector.register(self.sock, selectors.EVENT_READ, None)
+
+		self._bufs = [bytearray(buffer_size) for _ in range(batch)]
+		self._views = [memoryview(buf) for buf in self._bufs]
+		self._lengths = [0] * batch
+		self._addrs = [None] * batch
+		self._times = [0.0] * batch
+
+
+	def _upstream_socket(self, client, now):
+		"""
+		Internal. Returns the upstream socket of client, created on first use.
+		"""
+
+		entry = self._clients.get(client)
+
+		if entry is None:
+			if self.max_clients is not None and len(self._clients) >= self.max_clients:
+				self._expire_client(next(iter(self._clients)))
+
+			sock = socket.socket(_family(self.upstream[0]), socket.SOCK_DGRAM)
+			sock.connect(self.upstream)
+			sock.setblocking(False)
+			entry = self._clients[client] = [sock, now]
+			self._selector.register(sock, selectors.EVENT_READ, client)
+		else:
+			entry[1] = now
+			self._clients.move_to_end(client)
+
+		return entry[0]
+
+
+	def _expire_client(self, client):
+		"""
+		Internal. Closes the upstream socket of client.
+		"""
+
+		sock = self._clients.pop(client)[0]
+		self._selector.unregister(sock)
+		sock.close()
+		self.stats.expired += 1
+
+
+	def expire(self, now=None):
+		"""
+		Closes the upstream sockets of clients idle for idle_timeout seconds
+		(on clock). Returns the number of clients expired.
+		"""
+
+		if self.idle_timeout is None:
+			return 0
+
+		if now is None:
+			now = self.clock()
+
+		clients = self._clients
+		n = 0
+
+		while clients:
+			client, (sock, last) = next(iter(clients.items()))
+
+			if now - last < self.idle_timeout:
+				break
+
+			self._expire_client(client)
+			n += 1
+
+		return n
+
+
+	def _inspect(self, direction, view, n):
+		"""
+		Internal. Accounts a datagram if it is a PLUS packet.
+		"""
+
+		if n < _min_packet_len:
+			return
+
+		magic_and_flags, cat, psn, pse = _basic_header.unpack_from(view, 0)
+
+		if magic_and_flags >> _magic_shift != _default_magic:
+			return
+
+		self.stats.plus += 1
+		counts = self.cats.get(cat)
+
+		if counts is None:
+			counts = self.cats[cat] = [0, 0]
+
+		counts[0] += 1
+		counts[1] += n
+
+		if self.on_packet is not None:
+			self.on_packet(direction, view[:n], magic_and_flags & _flags_mask, cat, psn, pse)
+
+
+	def _forward(self, sock, client):
+		"""
+		Internal. Receives the datagrams queued on sock (up to batch) and
+		sends them on. client is None for the listening socket.
+		"""
+
+		bufs = self._bufs
+		lengths = self._lengths
+		addrs = self._addrs
+		times = self._times
+		clock = self.clock
+		n = 0
+
+		while n < self.batch:
+			try:
+				lengths[n], addrs[n] = sock.recvfrom_into(bufs[n])
+			except (BlockingIOError, InterruptedError):
+				break
+			except ConnectionRefusedError:
+				# ICMP port unreachable of an earlier send.
+				continue
+
+			times[n] = clock()
+			n += 1
+
+		direction = UPSTREAM if client is None else DOWNSTREAM
+		stats = self.stats
+
+		if n and client is not None:
+			self._clients[client][1] = times[n - 1]
+			self._clients.move_to_end(client)
+
+		for i in range(n):
+			view = self._views[i]
+			length = lengths[i]
+			self._inspect(direction, view, length)
+
+			try:
+				if client is None:
+					self._upstream_socket(addrs[i], times[i]).send(view[:length])
+				else:
+					self.sock.sendto(view[:length], client)
+			except OSError:
+				stats.dropped += 1
+				continue
+
+			stats.add(length, clock() - times[i])
+
+		return n
+
+
+	def step(self, timeout=None):
+		"""
+		Waits up to timeout seconds for datagrams and forwards them, then
+		expires idle clients. Returns the number of datagrams received.
+		"""
+
+		n = 0
+
+		for key, _ in self._selector.select(timeout):
+			client = key.data
+
+			# The client may have been evicted for a new one in this step.
+			if client is not None and self._clients.get(client, (None,))[0] is not key.fileobj:
+				continue
+
+			n += self._forward(key.fileobj, client)
+
+		self.expire()
+
+		return n
+
+
+	def serve_forever(self, stop=None, poll_interval=0.1):
+		"""
+		Forwards until stop (a threading.Event) is set.
+		"""
+
+		while stop is None or not stop.is_set():
+			self.step(poll_interval)
+
+
+	def close(self):
+		self._selector.close()
+
+		for sock, last in self._clients.values():
+			sock.close()
+
+		self._clients.clear()
+		self.sock.close()
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *args):
+		self.close()
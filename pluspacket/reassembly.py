@@ -0,0 +1,296 @@
+import collections
+import struct
+
+from pluspacket.packet import _udp_header_len
+from pluspacket.decap import decapsulate, ip_header_offset, _ipv6_extensions, _ipv6_fragment, _ip_proto_udp
+
+
+_u16 = struct.Struct(">H")
+_ipv6_fragment_header = struct.Struct(">BBHL")
+
+
+class _Datagram():
+	"""
+	Internal. Fragments of one IP datagram. The fragment payloads are kept
+	as views into the captured frames and only copied once on completion.
+	"""
+
+	__slots__ = ("first_ts", "fragments", "size", "total")
+
+
+	def __init__(self, ts):
+		self.first_ts = ts
+		self.fragments = {}
+		self.size = 0
+		self.total = None
+
+
+def _fragment(frame, pos):
+	"""
+	Internal. Returns (key, offset, more, proto, data) of an IP fragment
+	at pos or None if it is not a fragment.
+	"""
+
+	if len(frame) < pos + 20:
+		return None
+
+	version = frame[pos] >> 4
+
+	if version == 4:
+		flags_and_offset = _u16.unpack_from(frame, pos + 6)[0]
+
+		if not flags_and_offset & 0x3FFF:
+			return None
+
+		total = _u16.unpack_from(frame, pos + 2)[0]
+		end = min(pos + total, len(frame))
+		proto = frame[pos + 9]
+		key = (4, bytes(frame[pos + 12 : pos + 20]), proto, _u16.unpack_from(frame, pos + 4)[0])
+		data = memoryview(frame)[pos + (frame[pos] & 0x0F) * 4 : end]
+
+		return key, (flags_and_offset & 0x1FFF) * 8, bool(flags_and_offset & 0x2000), proto, data
+
+	if version == 6:
+		if len(frame) < pos + 40:
+			return None
+
+		end = min(pos + 40 + _u16.unpack_from(frame, pos + 4)[0], len(frame))
+		next_header = frame[pos + 6]
+		cur = pos + 40
+
+		while next_header != _ipv6_fragment:
+			if next_header not in _ipv6_extensions or len(frame) < cur + 2:
+				return None
+
+			if next_header == 51:
+				length = (frame[cur + 1] + 2) * 4
+			else:
+				length = (frame[cur + 1] + 1) * 8
+
+			next_header = frame[cur]
+			cur += length
+
+		if len(frame) < cur + 8:
+			return None
+
+		proto, _, offset_and_more, ident = _ipv6_fragment_header.unpack_from(frame, cur)
+		key = (6, bytes(frame[pos + 8 : pos + 40]), ident)
+		data = memoryview(frame)[cur + 8 : end]
+
+		return key, offset_and_more & 0xFFF8, bool(offset_and_more & 1), proto, data
+
+	return None
+
+
+class Reassembler():
+
+	def __init__(self, timeout=30.0, max_bytes=16 << 20):
+		"""
+		Reassembles fragmented IPv4/IPv6 UDP datagrams. Incomplete datagrams
+		are dropped timeout seconds after their first fragment, and the
+		oldest ones are dropped when more than max_bytes of fragment data
+		are held. Fragments are referenced, not copied, so frames passed to
+		feed must not be modified afterwards.
+		"""
+
+		self.timeout = timeout
+		self.max_bytes = max_bytes
+		self._pending = collections.OrderedDict()
+		self._bytes = 0
+
+		self.fragments = 0
+		self.completed = 0
+		self.expired = 0
+		self.evicted = 0
+
+
+	def __len__(self):
+		return len(self._pending)
+
+
+	@property
+	def held_bytes(self):
+		return self._bytes
+
+
+	def _drop(self, key):
+		datagram = self._pending.pop(key)
+		self._bytes -= datagram.size
+
+
+	def expire(self, ts):
+		"""
+		Drops datagrams whose first fragment is older than the timeout.
+		"""
+
+		pending = self._pending
+
+		while pending:
+			key, datagram = next(iter(pending.items()))
+
+			if ts - datagram.first_ts <= self.timeout:
+				break
+
+			self._drop(key)
+			self.expired += 1
+
+
+	def feed(self, ts, linktype, frame):
+		"""
+		Accounts a link-layer frame. Returns the complete UDP datagram
+		(incl. UDP header) as memoryview once its last missing fragment
+		arrived, otherwise None. Frames that are not fragments yield None.
+		"""
+
+		pos = ip_header_offset(linktype, frame)
+
+		if pos is None:
+			return None
+
+		fragment = _fragment(frame, pos)
+
+		if fragment is None:
+			return None
+
+		key, offset, more, proto, data = fragment
+
+		if proto != _ip_proto_udp:
+			return None
+
+		self.fragments += 1
+		self.expire(ts)
+
+		datagram = self._pending.get(key)
+
+		if datagram is None:
+			datagram = self._pending[key] = _Datagram(ts)
+
+		if not more:
+			datagram.total = offset + len(data)
+
+		if offset not in datagram.fragments:
+			datagram.fragments[offset] = data
+			datagram.size += len(data)
+			self._bytes += len(data)
+
+		while self._bytes > self.max_bytes and self._pending:
+			oldest = next(iter(self._pending))
+			self._drop(oldest)
+			self.evicted += 1
+
+			if oldest == key:
+				return None
+
+		if datagram.total is None or datagram.size < datagram.total:
+			return None
+
+		return self._complete(key, datagram)
+
+
+	def _complete(self, key, datagram):
+		"""
+		Internal. Copies the fragments into one buffer if they cover the
+		whole datagram.
+		"""
+
+		total = datagram.total
+		covered = 0
+
+		for offset in sorted(datagram.fragments):
+			if offset > covered:
+				# A hole, overlapping fragments made size look complete.
+				return None
+
+			covered = max(covered, offset + len(datagram.fragments[offset]))
+
+		if covered < total:
+			return None
+
+		buf = bytearray(total)
+
+		for offset, data in datagram.fragments.items():
+			end = min(offset + len(data), total)
+			buf[offset : end] = data[:end - offset]
+
+		self._drop(key)
+		self.completed += 1
+
+		return memoryview(buf)
+
+
+	def udp_payload(self, ts, linktype, frame):
+		"""
+		Returns the UDP payload of a frame as memoryview: directly if frame
+		holds a complete datagram, after reassembly if it completes a
+		fragmented one. Returns None otherwise.
+		"""
+
+		result = decapsulate(linktype, frame)
+
+		if result is not None:
+			return memoryview(frame)[result.payload_offset : result.payload_end]
+
+		datagram = self.feed(ts, linktype, frame)
+
+		if datagram is None or len(datagram) < _udp_header_len:
+			return None
+
+		end = _u16.unpack_from(datagram, 4)[0]
+
+		if not _udp_header_len <= end <= len(datagram):
+			end = len(datagram)
+
+		return datagram[_udp_header_len : end]
+
+
+	def get_state(self):
+		"""
+		Returns the pending fragments (copied) and counters, e.g. for a
+		checkpoint. set_state continues exactly where this left off.
+		"""
+
+		pending = [(key, datagram.first_ts, datagram.total, [(offset, bytes(data)) for offset, data in datagram.fragments.items()])
+			for key, datagram in self._pending.items()]
+
+		return {
+			"pending" : pending,
+			"fragments" : self.fragments,
+			"completed" : self.completed,
+			"expired" : self.expired,
+			"evicted" : self.evicted
+		}
+
+
+	def set_state(self, state):
+		"""
+		Restores what get_state returned.
+		"""
+
+		self._pending = collections.OrderedDict()
+		self._bytes = 0
+
+		for key, first_ts, total, fragments in state["pending"]:
+			datagram = self._pending[key] = _Datagram(first_ts)
+			datagram.total = total
+
+			for offset, data in fragments:
+				datagram.fragments[offset] = memoryview(data)
+				datagram.size += len(data)
+
+			self._bytes += datagram.size
+
+		self.fragments = state["fragments"]
+		self.completed = state["completed"]
+		self.expired = state["expired"]
+		self.evicted = state["evicted"]
+
+
+	def stats(self):
+		return {
+			"fragments" : self.fragments,
+			"completed" : self.completed,
+			"expired" : self.expired,
+			"evicted" : self.evicted,
+			"pending" : len(self._pending),
+			"held_bytes" : self._bytes
+		}
@@ -0,0 +1,133 @@
+import time
+
+from pluspacket.pcap import PcapReader
+from pluspacket.decap import udp_payload
+from pluspacket.sketches import Reservoir
+
+
+class ReplayStats():
+
+	def __init__(self, samples=8192):
+		"""
+		Pacing statistics of a replay. Lateness (actual minus scheduled
+		send time) is kept exactly as mean and maximum, its percentiles
+		are estimated from a Reservoir of samples values.
+		"""
+
+		self.packets = 0
+		self.bytes = 0
+		self.duration = 0.0
+		self.max_lateness = 0.0
+		self._sum_lateness = 0.0
+		self._reservoir = Reservoir(samples)
+
+
+	def add(self, nbytes, lateness):
+		self.packets += 1
+		self.bytes += nbytes
+		self._sum_lateness += lateness
+
+		if lateness > self.max_lateness:
+			self.max_lateness = lateness
+
+		self._reservoir.add(lateness)
+
+
+	def percentile(self, q):
+		"""
+		Returns the q-th (0..100) percentile of the lateness in seconds.
+		"""
+
+		return self._reservoir.percentile(q, 0.0)
+
+
+	def summary(self):
+		return {
+			"packets" : self.packets,
+			"bytes" : self.bytes,
+			"duration" : self.duration,
+			"pps" : self.packets / self.duration if self.duration > 0 else 0.0,
+			"mean_lateness" : self._sum_lateness / self.packets if self.packets else 0.0,
+			"p50_lateness" : self.percentile(50),
+			"p99_lateness" : self.percentile(99),
+			"max_lateness" : self.max_lateness
+		}
+
+
+class Replayer():
+
+	def __init__(self, sock, addr, speed=1.0, spin=0.0005, clock=time.perf_counter, sleep=time.sleep):
+		"""
+		Sends payloads to addr using sock. With speed 1.0 the original
+		timing is reproduced, other values scale it (2.0 is twice as fast),
+		None sends as fast as possible. The last spin seconds before a send
+		are busy-waited since sleeping is not accurate enough.
+		"""
+
+		if speed is not None and speed <= 0:
+			raise ValueError("speed must be positive or None")
+
+		self.sock = sock
+		self.addr = addr
+		self.speed = speed
+		self.spin = spin
+		self._clock = clock
+		self._sleep = sleep
+
+
+	def replay(self, records):
+		"""
+		Sends the payloads of (ts, payload) tuples and returns ReplayStats.
+		"""
+
+		clock = self._clock
+		sleep = self._sleep
+		sendto = self.sock.sendto
+		addr = self.addr
+		spin = self.spin
+		speed = self.speed
+		stats = ReplayStats()
+
+		start = clock()
+		first = None
+
+		for ts, payload in records:
+			if speed is None:
+				target = clock()
+			else:
+				if first is None:
+					first = ts
+
+				target = start + (ts - first) / speed
+				wait = target - clock()
+
+				if wait > spin:
+					sleep(wait - spin)
+
+				while clock() < target:
+					pass
+
+			sendto(payload, addr)
+			stats.add(len(payload), clock() - target)
+
+		stats.duration = clock() - start
+
+		return stats
+
+
+def replay_pcap(path, sock, addr, speed=1.0):
+	"""
+	Replays the UDP payloads of a pcap file to addr. Returns ReplayStats.
+	"""
+
+	def payloads(reader):
+		linktype = reader.linktype
+
+		for record in reader:
+			payload = udp_payload(linktype, record.data)
+
+			if payload is not None:
+				yield record.ts, payload
+
+	with PcapReader(path) as reader:
+		return Replayer(sock, addr, speed).replay(payloads(reader))
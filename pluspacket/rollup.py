@@ -0,0 +1,408 @@
+import array
+import collections
+import math
+
+from pluspacket.packet import detect_plus, parse_packet, _header_len, _flags_mask, _x_mask, _basic_header
+from pluspacket.batch import STATUS_OK
+from pluspacket.sketches import HyperLogLog
+from pluspacket.summary import _pending_psns
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+# RTT histogram: _rtt_steps buckets per octave starting at _rtt_min seconds.
+_rtt_min = 1e-6
+_rtt_steps = 8
+_rtt_buckets = 28 * _rtt_steps
+
+
+class Window():
+	"""
+	Aggregates of one time window: packets, bytes, extended headers, PCF
+	types, distinct CATs (HyperLogLog) and an RTT histogram with eight
+	buckets per octave. The memory used does not depend on the traffic.
+	"""
+
+	__slots__ = ("index", "start", "width", "packets", "bytes", "extended", "pcf_types", "cats", "rtt", "rtt_count")
+
+
+	def __init__(self, index, width, p=10):
+		self.index = index
+		self.start = index * width
+		self.width = width
+		self.packets = 0
+		self.bytes = 0
+		self.extended = 0
+		self.pcf_types = {}
+		self.cats = HyperLogLog(p)
+		self.rtt = array.array("L", [0]) * _rtt_buckets
+		self.rtt_count = 0
+
+
+	def add_rtt(self, sample):
+		if sample <= _rtt_min:
+			i = 0
+		else:
+			i = min(int(math.log2(sample / _rtt_min) * _rtt_steps), _rtt_buckets - 1)
+
+		self.rtt[i] += 1
+		self.rtt_count += 1
+
+
+	def rtt_percentile(self, q):
+		"""
+		Returns the q-th (0..100) RTT percentile as the middle of its
+		histogram bucket (within 5%), or None without samples.
+		"""
+
+		if not self.rtt_count:
+			return None
+
+		rank = max(1, int(math.ceil(self.rtt_count * q / 100.0)))
+		seen = 0
+
+		for i, n in enumerate(self.rtt):
+			seen += n
+
+			if seen >= rank:
+				return _rtt_min * 2 ** ((i + 0.5) / _rtt_steps)
+
+
+	def merge(self, other):
+		"""
+		Adds another window, e.g. a finer one lying within this one.
+		"""
+
+		self.packets += other.packets
+		self.bytes += other.bytes
+		self.extended += other.extended
+
+		for pcf_type, n in other.pcf_types.items():
+			self.pcf_types[pcf_type] = self.pcf_types.get(pcf_type, 0) + n
+
+		self.cats.merge(other.cats)
+
+		if other.rtt_count:
+			rtt = self.rtt
+
+			for i, n in enumerate(other.rtt):
+				if n:
+					rtt[i] += n
+
+			self.rtt_count += other.rtt_count
+
+
+	def to_dict(self):
+		return {
+			"start" : self.start,
+			"end" : self.start + self.width,
+			"packets" : self.packets,
+			"bytes" : self.bytes,
+			"distinct_cats" : int(round(self.cats.count())) if self.packets else 0,
+			"extended_ratio" : self.extended / self.packets if self.packets else 0.0,
+			"pcf_types" : dict(sorted(self.pcf_types.items())),
+			"rtt_samples" : self.rtt_count,
+			"rtt_p50" : self.rtt_percentile(50),
+			"rtt_p90" : self.rtt_percentile(90),
+			"rtt_p99" : self.rtt_percentile(99)
+		}
+
+
+class Rollup():
+
+	def __init__(self, width=1.0, lateness=2, on_window=None, p=10, rtt_flows=4096):
+		"""
+		Aggregates traffic into windows of width seconds kept in a ring of
+		lateness + 1 slots, so packets may arrive up to lateness windows
+		out of order; older ones are counted as late and dropped. A window
+		is handed to on_window once it leaves the ring (or on flush),
+		without callback completed windows queue up in windows. Windows
+		without traffic are not emitted. RTT samples are taken by matching
+		PSEs against the last PSNs of up to rtt_flows recently active CATs
+		(like FlowSummary), None disables this.
+		"""
+
+		self.width = width
+		self.on_window = on_window
+		self.p = p
+		self.windows = collections.deque()
+		self.late = 0
+		self.malformed = 0
+		self.rtt_flows = rtt_flows
+		self._ring = [None] * (lateness + 1)
+		self._newest = None
+		self._psns = collections.OrderedDict()
+
+
+	def _emit(self, window):
+		if self.on_window is None:
+			self.windows.append(window)
+		else:
+			self.on_window(window)
+
+
+	def _advance(self, index):
+		"""
+		Internal. Emits the windows that fall out of the ring when index
+		becomes the newest window.
+		"""
+
+		ring = self._ring
+		n = len(ring)
+
+		for i in range(self._newest - n + 1, min(index - n, self._newest) + 1):
+			window = ring[i % n]
+
+			if window is not None and window.index == i:
+				ring[i % n] = None
+				self._emit(window)
+
+		self._newest = index
+
+
+	def _get(self, index):
+		"""
+		Internal. Returns the window for index or None if it is too late.
+		"""
+
+		newest = self._newest
+
+		if newest is None:
+			self._newest = index
+		elif index > newest:
+			self._advance(index)
+		elif index <= newest - len(self._ring):
+			return None
+
+		ring = self._ring
+		slot = index % len(ring)
+		window = ring[slot]
+
+		if window is None:
+			window = ring[slot] = Window(index, self.width, self.p)
+
+		return window
+
+
+	def _echo(self, ts, cat, psn, pse):
+		"""
+		Internal. Remembers psn and returns an RTT sample if pse echoes a
+		PSN seen before, None otherwise.
+		"""
+
+		flows = self._psns
+		psns = flows.get(cat)
+
+		if psns is None:
+			psns = flows[cat] = collections.OrderedDict()
+
+			if len(flows) > self.rtt_flows:
+				flows.popitem(last=False)
+		else:
+			flows.move_to_end(cat)
+
+		seen = psns.pop(pse, None)
+
+		if psn not in psns:
+			psns[psn] = ts
+
+			if len(psns) > _pending_psns:
+				psns.popitem(last=False)
+
+		return None if seen is None else ts - seen
+
+
+	def _match(self, ts, cat, psn, pse):
+		"""
+		Internal. Takes an RTT sample if pse echoes a PSN seen before.
+		"""
+
+		sample = self._echo(ts, cat, psn, pse)
+
+		if sample is not None:
+			self.add_rtt(ts, sample)
+
+
+	def _account(self, ts, length, flags, cat, pcf_type):
+		window = self._get(int(math.floor(ts / self.width)))
+
+		if window is None:
+			self.late += 1
+			return
+
+		window.packets += 1
+		window.bytes += length
+
+		if flags & _x_mask:
+			window.extended += 1
+
+		if pcf_type is not None:
+			window.pcf_types[pcf_type] = window.pcf_types.get(pcf_type, 0) + 1
+
+		window.cats.add(cat)
+
+
+	def update(self, ts, buf):
+		"""
+		Accounts a UDP payload seen at ts. Returns False if it is not a PLUS
+		packet.
+		"""
+
+		if not detect_plus(buf):
+			return False
+
+		magic_and_flags, cat, psn, pse = _basic_header.unpack_from(buf, 0)
+		flags = magic_and_flags & _flags_mask
+		pcf_type = None
+
+		if flags & _x_mask:
+			try:
+				pcf_type = parse_packet(buf).pcf_type
+			except ValueError:
+				self.malformed += 1
+				return False
+
+		self._account(ts, len(buf), flags, cat, pcf_type)
+
+		if self.rtt_flows:
+			self._match(ts, cat, psn, pse)
+
+		return True
+
+
+	def update_packet(self, ts, packet, length=None):
+		"""
+		Accounts a parsed Packet. length defaults to its encoded length.
+		"""
+
+		if length is None:
+			length = _header_len(packet) + len(packet.payload)
+
+		self._account(ts, length, _x_mask if packet.x else 0, packet.cat, packet.pcf_type)
+
+		if self.rtt_flows:
+			self._match(ts, packet.cat, packet.psn, packet.pse)
+
+
+	def update_batch(self, ts, result):
+		"""
+		Accounts a BatchResult of parse_batch, ts holds the timestamp of
+		each datagram. With numpy the batch is grouped by window and every
+		window is updated once, CATs are deduplicated before they go into
+		the distinct counter.
+		"""
+
+		if numpy is None:
+			for i, buf in enumerate(result.bufs):
+				if result.status[i] != STATUS_OK:
+					self.malformed += 1
+					continue
+
+				pcf_type = result.pcf_type[i]
+				self._account(ts[i], len(buf), result.flags[i], result.cat[i], None if pcf_type < 0 else pcf_type)
+
+				if self.rtt_flows:
+					self._match(ts[i], result.cat[i], result.psn[i], result.pse[i])
+
+			return
+
+		n = len(result)
+		ok = numpy.frombuffer(result.status, numpy.int8) == STATUS_OK
+		self.malformed += n - int(ok.sum())
+
+		indexes = numpy.floor(numpy.asarray(ts, dtype=numpy.float64)[ok] / self.width).astype(numpy.int64)
+		lengths = numpy.fromiter(map(len, result.bufs), numpy.int64, n)[ok]
+		extended = (numpy.frombuffer(result.flags, numpy.uint8)[ok] & _x_mask) != 0
+		cats = numpy.frombuffer(result.cat, numpy.uint64)[ok]
+		pcf_types = numpy.frombuffer(result.pcf_type, numpy.int32)[ok]
+		rtts = {}
+
+		if self.rtt_flows:
+			# Echo matching depends on packet order, it is not vectorized.
+			echo = self._echo
+			cat, psn, pse = result.cat, result.psn, result.pse
+
+			for i, index in zip(numpy.flatnonzero(ok).tolist(), indexes.tolist()):
+				sample = echo(ts[i], cat[i], psn[i], pse[i])
+
+				if sample is not None:
+					rtts.setdefault(index, []).append(sample)
+
+		for index in numpy.unique(indexes).tolist():
+			mask = indexes == index
+			window = self._get(index)
+
+			samples = rtts.get(index, ())
+
+			if window is None:
+				self.late += int(mask.sum()) + len(samples)
+			else:
+				window.packets += int(mask.sum())
+				window.bytes += int(lengths[mask].sum())
+				window.extended += int(extended[mask].sum())
+
+				types, counts = numpy.unique(pcf_types[mask & (pcf_types >= 0)], return_counts=True)
+
+				for pcf_type, count in zip(types.tolist(), counts.tolist()):
+					window.pcf_types[pcf_type] = window.pcf_types.get(pcf_type, 0) + count
+
+				add = window.cats.add
+
+				for cat in numpy.unique(cats[mask]).tolist():
+					add(cat)
+
+				for sample in samples:
+					window.add_rtt(sample)
+
+
+	def add_rtt(self, ts, sample):
+		"""
+		Accounts an RTT sample taken at ts by other means, samples of PSN
+		and PSE echoes are taken by the update methods already.
+		"""
+
+		window = self._get(int(math.floor(ts / self.width)))
+
+		if window is None:
+			self.late += 1
+		else:
+			window.add_rtt(sample)
+
+
+	def add_window(self, window):
+		"""
+		Merges a completed finer window, e.g. to build per-minute windows
+		from per-second ones with on_window=minutes.add_window.
+		"""
+
+		mine = self._get(int(math.floor((window.start + window.width / 2.0) / self.width)))
+
+		if mine is None:
+			self.late += window.packets
+		else:
+			mine.merge(window)
+
+
+	def flush(self):
+		"""
+		Emits all windows still in the ring, oldest first.
+		"""
+
+		windows = sorted((window for window in self._ring if window is not None), key=lambda window: window.index)
+		self._ring = [None] * len(self._ring)
+		self._newest = None
+
+		for window in windows:
+			self._emit(window)
+
+
+	def pop_windows(self):
+		"""
+		Removes and yields the completed windows queued so far.
+		"""
+
+		while self.windows:
+			yield self.windows.popleft()
@@ -0,0 +1,246 @@
+import time
+import struct
+
+from pluspacket.packet import _cat_pos
+
+
+_fmt_cat = struct.Struct(">Q")
+_u64_mask = 2**64 - 1
+
+
+def _mix64(x):
+	"""
+	Internal. splitmix64 finalizer, spreads CATs uniformly over 64 bits.
+	"""
+
+	x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _u64_mask
+	x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _u64_mask
+
+	return x ^ (x >> 31)
+
+
+class Sampler():
+	"""
+	Base class of all samplers. A sampler decides on raw buffers whether a
+	packet is kept and accounts what it dropped so that statistics derived
+	from the kept packets can be scaled up.
+	"""
+
+	# Attributes that change while sampling, see get_state.
+	_state_fields = ("seen", "kept", "seen_bytes", "kept_bytes")
+
+
+	def __init__(self):
+		self.seen = 0
+		self.kept = 0
+		self.seen_bytes = 0
+		self.kept_bytes = 0
+
+
+	def get_state(self):
+		"""
+		Returns the counters and decision state as a dict, e.g. for a
+		checkpoint. set_state continues exactly where this left off.
+		"""
+
+		return dict((name, getattr(self, name)) for name in self._state_fields)
+
+
+	def set_state(self, state):
+		"""
+		Restores what get_state returned.
+		"""
+
+		for name in self._state_fields:
+			setattr(self, name, state[name])
+
+
+	def _keep(self, buf):
+		raise NotImplementedError()
+
+
+	def accept(self, buf, now=None):
+		"""
+		Returns True if buf should be parsed, False if it is shed. now is
+		the packet's timestamp and only used by time based samplers.
+		"""
+
+		n = len(buf)
+		self.seen += 1
+		self.seen_bytes += n
+
+		if self._keep(buf):
+			self.kept += 1
+			self.kept_bytes += n
+			return True
+
+		return False
+
+
+	def filter(self, bufs):
+		"""
+		Yields the kept buffers of bufs.
+		"""
+
+		accept = self.accept
+
+		for buf in bufs:
+			if accept(buf):
+				yield buf
+
+
+	@property
+	def dropped(self):
+		return self.seen - self.kept
+
+
+	@property
+	def scale(self):
+		"""
+		Factor to scale packet counts of the kept packets by.
+		"""
+
+		if self.kept == 0:
+			return 0.0 if self.seen == 0 else float("inf")
+
+		return self.seen / self.kept
+
+
+	@property
+	def byte_scale(self):
+		"""
+		Factor to scale byte counts of the kept packets by.
+		"""
+
+		if self.kept_bytes == 0:
+			return 0.0 if self.seen_bytes == 0 else float("inf")
+
+		return self.seen_bytes / self.kept_bytes
+
+
+	def stats(self):
+		return {
+			"seen" : self.seen,
+			"kept" : self.kept,
+			"dropped" : self.dropped,
+			"seen_bytes" : self.seen_bytes,
+			"kept_bytes" : self.kept_bytes,
+			"scale" : self.scale,
+			"byte_scale" : self.byte_scale
+		}
+
+
+class NthSampler(Sampler):
+
+	_state_fields = Sampler._state_fields + ("_i",)
+
+
+	def __init__(self, n):
+		"""
+		Keeps deterministically every n-th packet starting with the first.
+		"""
+
+		Sampler.__init__(self)
+
+		if n < 1:
+			raise ValueError("n must be at least 1")
+
+		self.n = n
+		self._i = 0
+
+
+	def _keep(self, buf):
+		i = self._i
+		self._i = i + 1 if i + 1 < self.n else 0
+
+		return i == 0
+
+
+class CatHashSampler(Sampler):
+
+	def __init__(self, rate, seed=0):
+		"""
+		Keeps all packets of a fraction rate of the CATs so that flows are
+		either kept or dropped as a whole. Samplers with the same seed make
+		the same decision for a CAT, e.g. on different observers.
+		"""
+
+		Sampler.__init__(self)
+
+		if not 0.0 < rate <= 1.0:
+			raise ValueError("rate must be in (0, 1]")
+
+		self.rate = rate
+		self.seed = seed & _u64_mask
+		self._threshold = int(rate * 2**64)
+
+
+	def _keep(self, buf):
+		if len(buf) < _cat_pos[1]:
+			return False
+
+		cat = _fmt_cat.unpack_from(buf, _cat_pos[0])[0]
+
+		return _mix64(cat ^ self.seed) < self._threshold
+
+
+	def keeps_cat(self, cat):
+		"""
+		Returns True if packets of CAT cat are kept.
+		"""
+
+		return _mix64(cat ^ self.seed) < self._threshold
+
+
+	@property
+	def flow_scale(self):
+		"""
+		Factor to scale flow counts (e.g. distinct CATs) by.
+		"""
+
+		return 1.0 / self.rate
+
+
+class TokenBucketSampler(Sampler):
+
+	_state_fields = Sampler._state_fields + ("_tokens", "_last")
+
+
+	def __init__(self, rate, burst, clock=time.monotonic):
+		"""
+		Keeps at most rate packets per second on average with bursts of up
+		to burst packets. If accept is called with a timestamp (e.g. capture
+		time) the clock is not consulted.
+		"""
+
+		Sampler.__init__(self)
+
+		self.rate = float(rate)
+		self.burst = float(burst)
+		self._clock = clock
+		self._tokens = float(burst)
+		self._last = None
+
+
+	def accept(self, buf, now=None):
+		if now is None:
+			now = self._clock()
+
+		last = self._last
+
+		if last is not None and now > last:
+			tokens = self._tokens + (now - last) * self.rate
+			self._tokens = tokens if tokens < self.burst else self.burst
+
+		if last is None or now > last:
+			self._last = now
+
+		return Sampler.accept(self, buf, now)
+
+
+	def _keep(self, buf):
+		if self._tokens >= 1.0:
+			self._tokens -= 1.0
+			return True
+
+		return False
@@ -0,0 +1,166 @@
+import struct
+
+from pluspacket.packet import _cat_pos
+
+
+_psn_mod = 2**32
+_psn_half = 2**31
+_cat_and_psn = struct.Struct(">QL")
+
+_counters = ("received", "lost", "duplicates", "reordered", "late", "gaps")
+
+
+class SeqState():
+	"""
+	PSN progression of one direction of an association. Bit i of window
+	is set if PSN highest - i has been received, span is the number of
+	PSNs up to highest that were expected since the first one.
+	"""
+
+	__slots__ = ("highest", "window", "span") + _counters
+
+
+	def __init__(self, psn):
+		self.highest = psn
+		self.window = 1
+		self.span = 1
+		self.received = 1
+		self.lost = 0
+		self.duplicates = 0
+		self.reordered = 0
+		self.late = 0
+		self.gaps = 0
+
+
+	def to_dict(self):
+		return dict((k, getattr(self, k)) for k in _counters)
+
+
+def _rates(counters):
+	"""
+	Internal. Adds loss, reordering and duplicate rates to counters.
+	"""
+
+	received = counters["received"]
+	expected = received + counters["lost"]
+
+	counters["loss_rate"] = counters["lost"] / expected if expected else 0.0
+	counters["reorder_rate"] = counters["reordered"] / received if received else 0.0
+	counters["duplicate_rate"] = counters["duplicates"] / received if received else 0.0
+
+	return counters
+
+
+class SeqAnalyzer():
+
+	def __init__(self, window=64):
+		"""
+		Detects gaps, duplicates and reordering in the PSNs of each
+		(CAT, direction). A PSN missing when a higher one arrives counts as
+		lost until it shows up within window PSNs of the highest one, then
+		it counts as reordered instead. PSNs older than the window or than
+		the first PSN of the flow count as late. Memory per flow is fixed and the work per packet is O(1).
+		"""
+
+		if window < 1:
+			raise ValueError("window must be at least 1")
+
+		self.window = window
+		self._mask = (1 << window) - 1
+		self.flows = {}
+
+
+	def update(self, cat, psn, direction=0):
+		key = (cat, direction)
+		state = self.flows.get(key)
+
+		if state is None:
+			self.flows[key] = SeqState(psn)
+			return
+
+		delta = (psn - state.highest) % _psn_mod
+
+		if delta == 0:
+			state.duplicates += 1
+		elif delta < _psn_half:
+			# Ahead of the highest PSN, everything in between is missing.
+			if delta > 1:
+				state.lost += delta - 1
+				state.gaps += 1
+
+			if delta >= self.window:
+				state.window = 1
+			else:
+				state.window = ((state.window << delta) | 1) & self._mask
+
+			state.span = min(state.span + delta, self.window)
+			state.highest = psn
+			state.received += 1
+		else:
+			back = _psn_mod - delta
+
+			# PSNs before the first one were never counted as lost.
+			if back >= state.span:
+				state.late += 1
+			elif state.window >> back & 1:
+				state.duplicates += 1
+			else:
+				state.window |= 1 << back
+				state.reordered += 1
+				state.lost -= 1
+				state.received += 1
+
+
+	def update_packet(self, packet, direction=0):
+		"""
+		Accounts a Packet or any object with cat and psn attributes.
+		"""
+
+		self.update(packet.cat, packet.psn, direction)
+
+
+	def update_buf(self, buf, direction=0):
+		"""
+		Accounts a raw PLUS packet (excl. UDP header). It's the caller's
+		responsibility to make sure that buffer holds a PLUS header.
+		"""
+
+		cat, psn = _cat_and_psn.unpack_from(buf, _cat_pos[0])
+		self.update(cat, psn, direction)
+
+
+	def metrics(self, cat, direction=0):
+		"""
+		Returns the counters and rates of one direction of a CAT or None.
+		"""
+
+		state = self.flows.get((cat, direction))
+
+		if state is None:
+			return None
+
+		return _rates(state.to_dict())
+
+
+	def per_cat(self):
+		"""
+		Returns a dict mapping (cat, direction) to counters and rates.
+		"""
+
+		return dict((key, _rates(state.to_dict())) for key, state in list(self.flows.items()))
+
+
+	def aggregate(self):
+		"""
+		Returns the counters and rates summed over all flows.
+		"""
+
+		total = dict((k, 0) for k in _counters)
+
+		for state in list(self.flows.values()):
+			for k in _counters:
+				total[k] += getattr(state, k)
+
+		total["flows"] = len(self.flows)
+
+		return _rates(total)
@@ -0,0 +1,239 @@
+import random
+import struct
+
+from pluspacket.packet import parse_packet, _default_magic, _magic_shift, _flags_mask, _min_packet_len, _l_mask, _r_mask, _s_mask, _x_mask, _psn_pos, _basic_header
+
+
+_magic_and_cat = struct.Struct(">LQ")
+_psn_pse = struct.Struct(">LL")
+_u32_mask = 0xFFFFFFFF
+
+
+def _after(a, b):
+	"""
+	Internal. True if sequence number a is b or comes after it (mod 2^32).
+	"""
+
+	return (a - b) & _u32_mask < 0x80000000
+
+
+class PlusSession():
+	"""
+	One end of a PLUS association. It numbers outgoing packets, echoes
+	the PSN of the last packet received as PSE and runs the stop exchange:
+	stop() sets S on all further packets, the peer confirms with S and the
+	session is stopped once the confirmation echoes a stop packet. A peer
+	that stops first is confirmed automatically.
+	"""
+
+	__slots__ = ("cat", "psn", "pse", "addr", "sent", "received",
+		"stopping", "stopped", "peer_stopped", "_stop_psn", "_header")
+
+
+	def __init__(self, cat=None, psn=None, l=False, r=False, addr=None, rnd=random):
+		"""
+		Creates a session. cat and the initial psn default to random values.
+		"""
+
+		self.cat = rnd.getrandbits(64) if cat is None else cat
+		self.psn = rnd.getrandbits(32) if psn is None else psn
+		self.pse = 0
+		self.addr = addr
+		self.sent = 0
+		self.received = 0
+		self.stopping = False
+		self.stopped = False
+		self.peer_stopped = False
+		self._stop_psn = None
+
+		flags = (_l_mask if l else 0) | (_r_mask if r else 0)
+		self._header = bytearray(_basic_header.pack(_default_magic << _magic_shift | flags, self.cat, 0, 0))
+
+
+	def _next(self):
+		"""
+		Internal. Advances PSN and patches the pre-encoded header.
+		"""
+
+		if self.sent:
+			self.psn = (self.psn + 1) & _u32_mask
+
+		self.sent += 1
+
+		if self.stopping and self._stop_psn is None:
+			self._stop_psn = self.psn
+
+			if self.peer_stopped:
+				# Our S confirms the peer's.
+				self.stopped = True
+
+		_psn_pse.pack_into(self._header, _psn_pos[0], self.psn, self.pse)
+
+		return self._header
+
+
+	def send(self, payload=b""):
+		"""
+		Returns the wire bytes of the next packet carrying payload.
+		"""
+
+		return self._next() + payload
+
+
+	def send_iovec(self, payload=b""):
+		"""
+		Same as send but returns [header, payload] for socket.sendmsg. The
+		header buffer is reused by the next packet.
+		"""
+
+		return [self._next(), payload]
+
+
+	def stop(self):
+		"""
+		Starts the stop exchange, further packets carry S.
+		"""
+
+		if not self.stopping:
+			self.stopping = True
+			self._header[3] |= _s_mask
+
+
+	def receive(self, buf):
+		"""
+		Accounts a packet of the peer. Returns its payload as memoryview
+		or None if buf is not a PLUS packet of this association.
+		"""
+
+		if len(buf) < _min_packet_len:
+			return None
+
+		magic_and_flags, cat, psn, pse = _basic_header.unpack_from(buf, 0)
+
+		if magic_and_flags >> _magic_shift != _default_magic or cat != self.cat:
+			return None
+
+		flags = magic_and_flags & _flags_mask
+		offset = _min_packet_len
+
+		if flags & _x_mask:
+			try:
+				offset = len(buf) - len(parse_packet(bytes(buf)).payload)
+			except ValueError:
+				return None
+
+		self.received += 1
+		self.pse = psn
+
+		if flags & _s_mask:
+			if self._stop_psn is not None and _after(pse, self._stop_psn):
+				self.stopped = True
+
+			if not self.peer_stopped:
+				self.peer_stopped = True
+				self.stop()
+
+		return memoryview(buf)[offset:]
+
+
+class SessionTable():
+
+	def __init__(self, accept=True, rnd=random):
+		"""
+		The sessions of one endpoint by CAT. Packets with unknown CATs open
+		a new session if accept is set (a server), otherwise they are
+		dropped. Stopped sessions are removed.
+		"""
+
+		self.sessions = {}
+		self.accept = accept
+		self.rnd = rnd
+		self.unknown = 0
+		self.malformed = 0
+
+
+	def open(self, cat=None, addr=None, l=False, r=False):
+		"""
+		Opens a session, e.g. on the client side. CATs are unique.
+		"""
+
+		sessions = self.sessions
+
+		if cat is None:
+			cat = self.rnd.getrandbits(64)
+
+			while cat in sessions:
+				cat = self.rnd.getrandbits(64)
+		elif cat in sessions:
+			raise ValueError("CAT %d already in use." % cat)
+
+		session = sessions[cat] = PlusSession(cat, None, l, r, addr, self.rnd)
+
+		return session
+
+
+	def receive(self, buf, addr=None):
+		"""
+		Dispatches a packet to its session. Returns (session, payload) or
+		(None, None) if it was dropped.
+		"""
+
+		if len(buf) < _min_packet_len:
+			self.malformed += 1
+			return None, None
+
+		magic_and_flags, cat = _magic_and_cat.unpack_from(buf, 0)
+
+		if magic_and_flags >> _magic_shift != _default_magic:
+			self.malformed += 1
+			return None, None
+
+		session = self.sessions.get(cat)
+
+		if session is None:
+			if not self.accept:
+				self.unknown += 1
+				return None, None
+
+			session = self.sessions[cat] = PlusSession(cat, None, addr=addr, rnd=self.rnd)
+
+		payload = session.receive(buf)
+
+		if payload is None:
+			self.malformed += 1
+			return None, None
+
+		if addr is not None:
+			session.addr = addr
+
+		if session.stopped:
+			del self.sessions[cat]
+
+		return session, payload
+
+
+	def send(self, cat, payload=b""):
+		"""
+		Returns the wire bytes of the next packet of session cat. Sessions
+		whose stop confirmation this is are removed.
+		"""
+
+		session = self.sessions[cat]
+		buf = session.send(payload)
+
+		if session.stopped:
+			del self.sessions[cat]
+
+		return buf
+
+
+	def get(self, cat):
+		return self.sessions.get(cat)
+
+
+	def __len__(self):
+		return len(self.sessions)
+
+
+	def __iter__(self):
+		return iter(self.sessions.values())
@@ -0,0 +1,419 @@
+import array
+import math
+import random
+import struct
+
+from pluspacket.packet import _magic_shift, _default_magic, _min_packet_len
+from pluspacket.sampling import _mix64
+
+
+_u64_mask = 2**64 - 1
+_magic_and_cat = struct.Struct(">LQ")
+
+# Odd constants to derive independent hash functions per row.
+_row_seeds = [(0x9e3779b97f4a7c15 * (i + 1)) & _u64_mask for i in range(32)]
+
+# Separates the sketch hashes from CatHashSampler's, which keeps the CATs
+# with small hashes. Hashing them the same way would put the sampled CATs
+# into the low HyperLogLog registers and undercount by the sampling rate.
+_sketch_domain = 0x5851f42d4c957f2d
+
+
+def _hash(key, seed):
+	"""
+	Internal. 64 bit hash of key for the sketches.
+	"""
+
+	return _mix64(key ^ seed ^ _sketch_domain)
+
+
+def _check_compatible(a, b):
+	if a.__class__ != b.__class__ or a._params() != b._params():
+		raise ValueError("Can only merge sketches with identical parameters.")
+
+
+class CountMinSketch():
+
+	def __init__(self, width=2048, depth=4, seed=0):
+		"""
+		Count-min sketch over 64 bit keys. width must be a power of two.
+		Estimates never undercount and overcount by at most
+		e/width * total with probability 1 - exp(-depth).
+		"""
+
+		if width & (width - 1) or width <= 0:
+			raise ValueError("width must be a power of two")
+
+		if not 0 < depth <= len(_row_seeds):
+			raise ValueError("depth must be between 1 and %d" % len(_row_seeds))
+
+		self.width = width
+		self.depth = depth
+		self.seed = seed
+		self.total = 0
+		self._seeds = [s ^ seed for s in _row_seeds[:depth]]
+		self._counters = array.array("Q", bytes(8 * width * depth))
+
+
+	def _params(self):
+		return (self.width, self.depth, self.seed)
+
+
+	def _indexes(self, key):
+		mask = self.width - 1
+		width = self.width
+
+		return [i * width + (_hash(key, s) & mask) for i, s in enumerate(self._seeds)]
+
+
+	def update(self, key, count=1):
+		counters = self._counters
+
+		for i in self._indexes(key):
+			counters[i] += count
+
+		self.total += count
+
+
+	def estimate(self, key):
+		counters = self._counters
+
+		return min([counters[i] for i in self._indexes(key)])
+
+
+	def merge(self, other):
+		"""
+		Adds the counts of other which must have the same parameters.
+		"""
+
+		_check_compatible(self, other)
+
+		counters = self._counters
+
+		for i, c in enumerate(other._counters):
+			if c:
+				counters[i] += c
+
+		self.total += other.total
+
+
+class HyperLogLog():
+
+	def __init__(self, p=14, seed=0):
+		"""
+		HyperLogLog distinct counter over 64 bit keys with 2**p one byte
+		registers. The standard error is about 1.04 / sqrt(2**p).
+		"""
+
+		if not 4 <= p <= 18:
+			raise ValueError("p must be between 4 and 18")
+
+		self.p = p
+		self.seed = seed
+		self._registers = bytearray(1 << p)
+
+
+	def _params(self):
+		return (self.p, self.seed)
+
+
+	def add(self, key):
+		p = self.p
+		h = _hash(key, self.seed)
+		index = h >> (64 - p)
+		rest = (h << p) & _u64_mask
+		rank = 64 - rest.bit_length() + 1
+
+		if rank > 64 - p + 1:
+			rank = 64 - p + 1
+
+		if rank > self._registers[index]:
+			self._registers[index] = rank
+
+
+	def count(self):
+		"""
+		Returns the estimated number of distinct keys added.
+		"""
+
+		m = len(self._registers)
+		registers = self._registers
+
+		if m == 16:
+			alpha = 0.673
+		elif m == 32:
+			alpha = 0.697
+		elif m == 64:
+			alpha = 0.709
+		else:
+			alpha = 0.7213 / (1 + 1.079 / m)
+
+		estimate = alpha * m * m / math.fsum([2.0 ** -r for r in registers])
+		zeros = registers.count(0)
+
+		if estimate <= 2.5 * m and zeros:
+			# Small range correction: linear counting.
+			return m * math.log(m / zeros)
+
+		return estimate
+
+
+	def merge(self, other):
+		_check_compatible(self, other)
+		self._registers = bytearray(map(max, self._registers, other._registers))
+
+
+class HeavyHitters():
+
+	def __init__(self, k=32, sketch=None):
+		"""
+		Tracks the k keys with the highest estimated counts in sketch, a
+		CountMinSketch that must be updated before calling update.
+		"""
+
+		self.k = k
+		self.sketch = sketch if sketch is not None else CountMinSketch()
+		self._top = {}
+		self._min = 0
+
+
+	def _params(self):
+		return (self.k,) + self.sketch._params()
+
+
+	def update(self, key):
+		"""
+		Considers key after its count in the sketch has been updated.
+		"""
+
+		top = self._top
+
+		if key in top:
+			old = top[key]
+			top[key] = self.sketch.estimate(key)
+
+			if old == self._min:
+				# Counts only grow, the minimum can only have moved up.
+				self._min = min(top.values())
+
+			return
+
+		estimate = self.sketch.estimate(key)
+
+		if len(top) < self.k:
+			top[key] = estimate
+			self._min = min(top.values())
+		elif estimate > self._min:
+			# Only happens when a key overtakes the current minimum so
+			# the linear scan is rare once the heavy hitters are found.
+			del top[min(top, key=top.get)]
+			top[key] = estimate
+			self._min = min(top.values())
+
+
+	def top(self):
+		"""
+		Returns (key, estimate) tuples, largest first.
+		"""
+
+		estimate = self.sketch.estimate
+		items = [(key, estimate(key)) for key in self._top]
+		items.sort(key=lambda item: (-item[1], item[0]))
+
+		return items
+
+
+	def merge(self, other):
+		"""
+		Merges other. Both sketches must have been merged before.
+		"""
+
+		_check_compatible(self, other)
+
+		estimate = self.sketch.estimate
+		candidates = set(self._top) | set(other._top)
+		items = sorted(candidates, key=lambda key: (-estimate(key), key))[:self.k]
+
+		self._top = dict((key, estimate(key)) for key in items)
+		self._min = min(self._top.values()) if self._top else 0
+
+
+class BloomFilter():
+
+	def __init__(self, bits=2048, hashes=4, seed=0, data=None):
+		"""
+		Bloom filter over 64 bit keys with bits bits (a power of two, at
+		least 8). data restores the bytes returned by to_bytes.
+		"""
+
+		if bits & (bits - 1) or bits < 8:
+			raise ValueError("bits must be a power of two >= 8")
+
+		if data is not None and len(data) != bits // 8:
+			raise ValueError("data must be bits / 8 bytes long")
+
+		self.bits = bits
+		self.hashes = hashes
+		self.seed = seed
+		self._bits = bytearray(data) if data is not None else bytearray(bits // 8)
+
+
+	def _params(self):
+		return (self.bits, self.hashes, self.seed)
+
+
+	def _positions(self, key):
+		# Double hashing, one 64 bit hash gives all positions.
+		h = _hash(key, self.seed)
+		h1 = h & 0xFFFFFFFF
+		h2 = (h >> 32) | 1
+		mask = self.bits - 1
+
+		return [(h1 + i * h2) & mask for i in range(self.hashes)]
+
+
+	def add(self, key):
+		bits = self._bits
+
+		for pos in self._positions(key):
+			bits[pos >> 3] |= 1 << (pos & 7)
+
+
+	def __contains__(self, key):
+		"""
+		False if key was never added, True if it probably was.
+		"""
+
+		bits = self._bits
+
+		for pos in self._positions(key):
+			if not bits[pos >> 3] & (1 << (pos & 7)):
+				return False
+
+		return True
+
+
+	def merge(self, other):
+		_check_compatible(self, other)
+		self._bits = bytearray(a | b for a, b in zip(self._bits, other._bits))
+
+
+	def to_bytes(self):
+		return bytes(self._bits)
+
+
+class Reservoir():
+
+	def __init__(self, size=8192, seed=0):
+		"""
+		Uniform random sample of up to size of the values added (reservoir
+		sampling), for percentiles over streams of any length.
+		"""
+
+		self.size = size
+		self.count = 0
+		self.samples = []
+		self._rnd = random.Random(seed)
+
+
+	def add(self, value):
+		self.count += 1
+
+		if len(self.samples) < self.size:
+			self.samples.append(value)
+		else:
+			i = self._rnd.randrange(self.count)
+
+			if i < self.size:
+				self.samples[i] = value
+
+
+	def percentile(self, q, default=None):
+		"""
+		Returns the q-th (0..100) percentile of the sample, default if it
+		is empty.
+		"""
+
+		if not self.samples:
+			return default
+
+		samples = sorted(self.samples)
+
+		return samples[min(len(samples) - 1, int(q / 100.0 * len(samples)))]
+
+
+class CatSketch():
+	"""
+	Fixed memory per-CAT statistics: packet and byte counts per CAT,
+	number of distinct CATs and the CATs with the most packets. It has the
+	same update method as FlowTable and can be used in its place when
+	exact per-flow state does not fit in memory.
+	"""
+
+	def __init__(self, width=2048, depth=4, p=14, k=32, seed=0):
+		self.packets = CountMinSketch(width, depth, seed)
+		self.bytes = CountMinSketch(width, depth, seed)
+		self.distinct = HyperLogLog(p, seed)
+		self.heavy = HeavyHitters(k, self.packets)
+
+
+	def update_cat(self, cat, length):
+		self.packets.update(cat)
+		self.bytes.update(cat, length)
+		self.distinct.add(cat)
+		self.heavy.update(cat)
+
+
+	def update(self, ts, buf):
+		"""
+		Accounts a PLUS packet given as raw buffer (excl. UDP header).
+		Returns False if buf is not a PLUS packet.
+		"""
+
+		if len(buf) < _min_packet_len:
+			return False
+
+		magic_and_flags, cat = _magic_and_cat.unpack_from(buf, 0)
+
+		if magic_and_flags >> _magic_shift != _default_magic:
+			return False
+
+		self.update_cat(cat, len(buf))
+
+		return True
+
+
+	def update_packet(self, ts, packet, length):
+		self.update_cat(packet.cat, length)
+
+
+	def merge(self, other):
+		self.packets.merge(other.packets)
+		self.bytes.merge(other.bytes)
+		self.distinct.merge(other.distinct)
+		self.heavy.merge(other.heavy)
+
+
+	def estimate(self, cat):
+		"""
+		Returns estimated (packets, bytes) of cat.
+		"""
+
+		return self.packets.estimate(cat), self.bytes.estimate(cat)
+
+
+	def distinct_cats(self):
+		return self.distinct.count()
+
+
+	def top(self):
+		return self.heavy.top()
+
+
+	def memory(self):
+		"""
+		Returns the approximate number of bytes used by the sketches.
+		"""
+
+		return (self.packets._counters.itemsize * len(self.packets._counters) * 2
+			+ len(self.distinct._registers) + self.heavy.k * 16)
@@ -0,0 +1,279 @@
+import collections
+
+from pluspacket.packet import parse_packet, detect_plus, _l_mask, _r_mask, _s_mask, _x_mask, _flags_mask, _basic_header
+
+
+_pending_psns = 32
+
+
+class FlowSummary():
+	"""
+	Per-CAT summary: packet and byte counts, flag events, PCF type
+	histogram and RTT samples. RTT samples are taken by remembering when
+	the last few PSNs were seen and matching them against later PSEs, the
+	way an on-path observer would.
+	"""
+
+	__slots__ = ("cat", "packets", "bytes", "first_ts", "last_ts", "l", "r", "s", "x",
+		"pcf_types", "rtt_count", "rtt_sum", "rtt_min", "rtt_max", "_psns", "_unmatched")
+
+
+	def __init__(self, cat, ts):
+		self.cat = cat
+		self.packets = 0
+		self.bytes = 0
+		self.first_ts = ts
+		self.last_ts = ts
+		self.l = 0
+		self.r = 0
+		self.s = 0
+		self.x = 0
+		self.pcf_types = {}
+		self.rtt_count = 0
+		self.rtt_sum = 0.0
+		self.rtt_min = None
+		self.rtt_max = None
+		self._psns = collections.OrderedDict()
+		self._unmatched = None
+
+
+	def update(self, ts, length, flags, psn, pse, pcf_type):
+		"""
+		Accounts a single packet. Returns the RTT sample it produced or None.
+		"""
+
+		self.packets += 1
+		self.bytes += length
+		self.last_ts = ts
+
+		if flags:
+			if flags & _l_mask: self.l += 1
+			if flags & _r_mask: self.r += 1
+			if flags & _s_mask: self.s += 1
+			if flags & _x_mask: self.x += 1
+
+		if pcf_type is not None:
+			self.pcf_types[pcf_type] = self.pcf_types.get(pcf_type, 0) + 1
+
+		psns = self._psns
+		seen = psns.pop(pse, None)
+
+		if psn not in psns:
+			psns[psn] = ts
+
+			if len(psns) > _pending_psns:
+				psns.popitem(last=False)
+
+		if seen is not None:
+			self._rtt(ts - seen)
+			return ts - seen
+
+		if self._unmatched is not None and self.packets <= _pending_psns:
+			# May echo a PSN of the part of the trace before this one.
+			self._unmatched.append((ts, pse))
+
+		return None
+
+
+	def _rtt(self, sample):
+		self.rtt_count += 1
+		self.rtt_sum += sample
+
+		if self.rtt_min is None or sample < self.rtt_min:
+			self.rtt_min = sample
+
+		if self.rtt_max is None or sample > self.rtt_max:
+			self.rtt_max = sample
+
+
+	def merge(self, other):
+		"""
+		Merges the summary of other (seen later in time) into this one.
+		"""
+
+		self.packets += other.packets
+		self.bytes += other.bytes
+		self.first_ts = min(self.first_ts, other.first_ts)
+		self.last_ts = max(self.last_ts, other.last_ts)
+		self.l += other.l
+		self.r += other.r
+		self.s += other.s
+		self.x += other.x
+
+		for pcf_type, n in other.pcf_types.items():
+			self.pcf_types[pcf_type] = self.pcf_types.get(pcf_type, 0) + n
+
+		if other.rtt_count:
+			self.rtt_count += other.rtt_count
+			self.rtt_sum += other.rtt_sum
+			self.rtt_min = other.rtt_min if self.rtt_min is None else min(self.rtt_min, other.rtt_min)
+			self.rtt_max = other.rtt_max if self.rtt_max is None else max(self.rtt_max, other.rtt_max)
+
+		psns = self._psns
+
+		for ts, pse in other._unmatched or ():
+			seen = psns.pop(pse, None)
+
+			if seen is not None:
+				self._rtt(ts - seen)
+
+		for psn, ts in other._psns.items():
+			psns.pop(psn, None)
+			psns[psn] = ts
+
+		while len(psns) > _pending_psns:
+			psns.popitem(last=False)
+
+
+	def to_dict(self):
+		return {
+			"cat" : self.cat,
+			"packets" : self.packets,
+			"bytes" : self.bytes,
+			"first_ts" : self.first_ts,
+			"last_ts" : self.last_ts,
+			"l" : self.l,
+			"r" : self.r,
+			"s" : self.s,
+			"x" : self.x,
+			"pcf_types" : dict(sorted(self.pcf_types.items())),
+			"rtt_samples" : self.rtt_count,
+			"rtt_min" : self.rtt_min,
+			"rtt_mean" : self.rtt_sum / self.rtt_count if self.rtt_count else None,
+			"rtt_max" : self.rtt_max
+		}
+
+
+class SummaryTable():
+
+	def __init__(self, idle_timeout=None, max_flows=None, on_rtt=None, partial=False):
+		"""
+		Collects FlowSummary objects per CAT. Flows idle for idle_timeout
+		seconds (trace time) are handed out by expire, and if more than
+		max_flows are active the least recently active ones are handed out
+		as well, which bounds the memory used. on_rtt is called with every
+		RTT sample. partial marks a table of a part of a trace, its flows
+		keep what is needed to take RTT samples across the border when
+		they are merged into the flows of the part before.
+		"""
+
+		self.flows = collections.OrderedDict()
+		self.idle_timeout = idle_timeout
+		self.max_flows = max_flows
+		self.on_rtt = on_rtt
+		self.partial = partial
+		self.packets = 0
+		self.bytes = 0
+		self.malformed = 0
+
+
+	def update(self, ts, buf):
+		"""
+		Accounts a UDP payload. Returns False if it is not a PLUS packet.
+		"""
+
+		if not detect_plus(buf):
+			return False
+
+		magic_and_flags, cat, psn, pse = _basic_header.unpack_from(buf, 0)
+		flags = magic_and_flags & _flags_mask
+		pcf_type = None
+
+		if flags & _x_mask:
+			try:
+				pcf_type = parse_packet(buf).pcf_type
+			except ValueError:
+				self.malformed += 1
+				return False
+
+		flows = self.flows
+		flow = flows.get(cat)
+
+		if flow is None:
+			flow = flows[cat] = FlowSummary(cat, ts)
+
+			if self.partial:
+				flow._unmatched = []
+		else:
+			flows.move_to_end(cat)
+
+		rtt = flow.update(ts, len(buf), flags, psn, pse, pcf_type)
+
+		if rtt is not None and self.on_rtt is not None:
+			self.on_rtt(rtt)
+
+		self.packets += 1
+		self.bytes += len(buf)
+
+		return True
+
+
+	def expire(self, now):
+		"""
+		Removes and yields flows that are idle or exceed max_flows.
+		"""
+
+		flows = self.flows
+
+		while flows:
+			cat, flow = next(iter(flows.items()))
+
+			over = self.max_flows is not None and len(flows) > self.max_flows
+			idle = self.idle_timeout is not None and now - flow.last_ts > self.idle_timeout
+
+			if not over and not idle:
+				break
+
+			del flows[cat]
+			yield flow
+
+
+	def flush(self):
+		"""
+		Removes and yields all flows.
+		"""
+
+		while self.flows:
+			yield self.flows.popitem(last=False)[1]
+
+
+	def add_flow(self, flow):
+		"""
+		Adds a flow of a later part of the trace. It continues the flow of
+		the same CAT unless that was idle in between, then the older flow
+		is removed and returned so it can be emitted.
+		"""
+
+		flows = self.flows
+		mine = flows.pop(flow.cat, None)
+
+		if mine is not None and (self.idle_timeout is None or flow.first_ts - mine.last_ts <= self.idle_timeout):
+			mine.merge(flow)
+			flows[flow.cat] = mine
+			return None
+
+		flows[flow.cat] = flow
+
+		return mine
+
+
+	def merge(self, other):
+		for cat, flow in other.flows.items():
+			mine = self.flows.get(cat)
+
+			if mine is None:
+				self.flows[cat] = flow
+			else:
+				mine.merge(flow)
+
+		self.packets += other.packets
+		self.bytes += other.bytes
+		self.malformed += other.malformed
+
+
+	def __len__(self):
+		return len(self.flows)
+
+
+	def __iter__(self):
+		return iter(self.flows.values())
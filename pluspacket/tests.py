@@ -1,5 +1,12 @@
+import os
+import sys
 import unittest
-import packet
+
+# The tests are run from within the package directory (python -m unittest
+# tests), the package itself has to be importable for its submodules.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pluspacket import packet
 
 class TestDummy(unittest.TestCase):
 
@@ -879,5 +886,2483 @@ class TestFuzzy(unittest.TestCase):
 			i += 1
 
 
+import struct
+import tempfile
+
+from pluspacket import pcap, flows, checkpoint, ingest
+
+
+def _udp_frame(payload, sport=4000, dport=5000):
+	"""
+	Wraps payload in Ethernet, IPv4 and UDP headers.
+	"""
+
+	udp = struct.pack(">HHHH", sport, dport, 8 + len(payload), 0) + bytes(payload)
+	ip = struct.pack(">BBHHHBBH4s4s", 0x45, 0, 20 + len(udp), 0, 0, 64, 17, 0,
+		bytes([10, 0, 0, 1]), bytes([10, 0, 0, 2]))
+	eth = bytes(12) + struct.pack(">H", 0x0800)
+
+	return eth + ip + udp
+
+
+def _write_pcap(path, frames):
+	"""
+	Writes (ts, frame) tuples to a classic pcap file.
+	"""
+
+	with open(path, "wb") as f:
+		f.write(struct.pack("<LHHlLLL", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+
+		for ts, frame in frames:
+			f.write(struct.pack("<LLLL", int(ts), int(round((ts % 1) * 1e6)), len(frame), len(frame)))
+			f.write(frame)
+
+
+def _random_trace(n, ncats=16, seed=1):
+	"""
+	Returns n (ts, frame) tuples of PLUS traffic.
+	"""
+
+	rnd = random.Random(seed)
+	cats = [rnd.randint(0, 2**64 - 1) for i in range(ncats)]
+	psns = [rnd.randint(0, 2**32 - 1) for i in range(ncats)]
+	frames = []
+
+	for i in range(n):
+		j = rnd.randrange(ncats)
+		psns[j] = (psns[j] + 1) % 2**32
+		plus_packet = packet.new_basic_packet(bool(rnd.randint(0, 1)), False, False,
+			cats[j], psns[j], 0, bytes(rnd.randint(0, 64)))
+		frames.append((1000.0 + i * 0.001, _udp_frame(plus_packet.to_bytes())))
+
+	return frames
+
+
+class TestCheckpoint(unittest.TestCase):
+	"""
+	Trace ingestion and checkpoint/resume tests.
+	"""
+
+	def setUp(self):
+		self.dir = tempfile.TemporaryDirectory()
+		self.trace = os.path.join(self.dir.name, "trace.pcap")
+		_write_pcap(self.trace, _random_trace(1000))
+
+
+	def tearDown(self):
+		self.dir.cleanup()
+
+
+	def _flows(self, table):
+		return sorted(flow.to_dict().items() for flow in table)
+
+
+	def test_process_trace(self):
+		"""
+		Tests if all packets are accounted.
+		"""
+
+		table = ingest.process_trace(self.trace)
+
+		self.assertEqual(sum(flow.packets for flow in table), 1000)
+		self.assertEqual(len(table), 16)
+
+
+	def test_resume(self):
+		"""
+		Tests if resuming from a checkpoint gives identical results.
+		"""
+
+		expected = ingest.process_trace(self.trace)
+
+		path = os.path.join(self.dir.name, "trace.ckpt")
+		clock = iter(range(10**6)).__next__
+
+		# Checkpoint every record, a full snapshot every 10th.
+		ckpt = checkpoint.Checkpointer(path, interval=1, full_every=10, clock=clock)
+		ingest.process_trace(self.trace, checkpointer=ckpt, max_records=333)
+		ckpt.close()
+
+		# Simulate a crash in the middle of writing a frame.
+		with open(path, "ab") as f:
+			f.write(b"PLCK\x01garbage")
+
+		ckpt = checkpoint.Checkpointer(path, interval=1000)
+		table = ingest.process_trace(self.trace, checkpointer=ckpt, resume=True)
+		ckpt.close()
+
+		self.assertEqual(self._flows(table), self._flows(expected))
+
+		_, _, records = checkpoint.load_checkpoint(path)
+		self.assertEqual(records, 1000)
+
+
+	def test_resume_sampler(self):
+		"""
+		Tests if the sampler continues where it was checkpointed.
+		"""
+
+		for make in (lambda: sampling.NthSampler(3), lambda: sampling.TokenBucketSampler(rate=200, burst=5)):
+			sampler = make()
+			expected = ingest.process_trace(self.trace, sampler=sampler)
+
+			path = os.path.join(self.dir.name, "sampler.ckpt")
+			clock = iter(range(10**6)).__next__
+			ckpt = checkpoint.Checkpointer(path, interval=7, full_every=3, clock=clock)
+			ingest.process_trace(self.trace, checkpointer=ckpt, max_records=333, sampler=make())
+			ckpt.close()
+
+			resumed = make()
+			ckpt = checkpoint.Checkpointer(path, interval=1000)
+			table = ingest.process_trace(self.trace, checkpointer=ckpt, resume=True, sampler=resumed)
+			ckpt.close()
+			os.remove(path)
+
+			self.assertEqual(self._flows(table), self._flows(expected))
+			self.assertEqual(resumed.get_state(), sampler.get_state())
+			self.assertTrue(0 < resumed.kept < 1000)
+
+
+	def test_resume_mismatch(self):
+		"""
+		Tests if resuming with other sampler or reassembler settings fails.
+		"""
+
+		path = os.path.join(self.dir.name, "trace.ckpt")
+
+		ckpt = checkpoint.Checkpointer(path)
+		ingest.process_trace(self.trace, checkpointer=ckpt, max_records=100)
+		ckpt.close()
+
+		with self.assertRaises(ValueError):
+			ingest.process_trace(self.trace, checkpointer=checkpoint.Checkpointer(path), resume=True, sampler=sampling.NthSampler(2))
+
+		with self.assertRaises(ValueError):
+			ingest.process_trace(self.trace, checkpointer=checkpoint.Checkpointer(path), resume=True, reassembler=reassembly.Reassembler())
+
+		ckpt = checkpoint.Checkpointer(path)
+		ingest.process_trace(self.trace, checkpointer=ckpt, max_records=100, sampler=sampling.NthSampler(2))
+		ckpt.close()
+
+		with self.assertRaises(ValueError):
+			ingest.process_trace(self.trace, checkpointer=checkpoint.Checkpointer(path), resume=True)
+
+
+	def test_no_checkpoint(self):
+		"""
+		Tests if a missing checkpoint file is not an error.
+		"""
+
+		self.assertEqual(checkpoint.load_checkpoint(os.path.join(self.dir.name, "x")), None)
+
+
+from pluspacket import sampling
+
+
+class TestSampling(unittest.TestCase):
+	"""
+	Sampler tests.
+	"""
+
+	def _bufs(self, n, ncats=100):
+		return [packet.new_basic_packet(False, False, False, i % ncats, i, 0, b"").to_bytes()
+			for i in range(n)]
+
+
+	def test_nth(self):
+		"""
+		Tests if every n-th packet is kept and the scale factor is exact.
+		"""
+
+		sampler = sampling.NthSampler(4)
+		kept = list(sampler.filter(self._bufs(1000)))
+
+		self.assertEqual(len(kept), 250)
+		self.assertEqual(sampler.dropped, 750)
+		self.assertEqual(sampler.scale, 4.0)
+		self.assertEqual(packet.get_psn(kept[1]), 4)
+
+
+	def test_cat_hash(self):
+		"""
+		Tests if flows are kept or dropped as a whole.
+		"""
+
+		sampler = sampling.CatHashSampler(0.25, seed=42)
+		kept = list(sampler.filter(self._bufs(10000, ncats=1000)))
+		cats = set(packet.get_cat(buf) for buf in kept)
+
+		for cat in range(1000):
+			self.assertEqual(cat in cats, sampler.keeps_cat(cat))
+
+		# Every CAT has the same number of packets.
+		self.assertEqual(len(kept), len(cats) * 10)
+		self.assertTrue(150 < len(cats) < 350)
+		self.assertEqual(sampler.flow_scale, 4.0)
+		self.assertEqual(sampler.scale, 10000 / len(kept))
+
+
+	def test_token_bucket(self):
+		"""
+		Tests if the token bucket limits the rate.
+		"""
+
+		sampler = sampling.TokenBucketSampler(rate=100, burst=10)
+		bufs = self._bufs(1000)
+
+		# 1000 packets in one second.
+		for i, buf in enumerate(bufs):
+			sampler.accept(buf, i / 1000.0)
+
+		self.assertEqual(sampler.seen, 1000)
+		self.assertTrue(105 <= sampler.kept <= 111)
+		self.assertAlmostEqual(sampler.seen_bytes, sampler.kept_bytes * sampler.byte_scale)
+
+
+import pickle
+
+from pluspacket import sketches
+
+
+class TestSketches(unittest.TestCase):
+	"""
+	Approximate statistics tests.
+	"""
+
+	def test_count_min(self):
+		"""
+		Tests if count-min never undercounts and stays within its bound.
+		"""
+
+		cms = sketches.CountMinSketch(width=1024, depth=4)
+		rnd = random.Random(7)
+		exact = {}
+
+		for i in range(20000):
+			key = rnd.randint(0, 2000)
+			exact[key] = exact.get(key, 0) + 1
+			cms.update(key)
+
+		for key, count in exact.items():
+			estimate = cms.estimate(key)
+			self.assertTrue(count <= estimate <= count + 3 * 20000 // 1024)
+
+
+	def test_hyperloglog(self):
+		"""
+		Tests if the distinct count is within a few standard errors.
+		"""
+
+		hll = sketches.HyperLogLog(p=12)
+
+		for i in range(50000):
+			hll.add(i * 7919)
+
+		self.assertTrue(abs(hll.count() - 50000) < 50000 * 0.05)
+
+		hll = sketches.HyperLogLog(p=12)
+
+		for i in range(100):
+			hll.add(i)
+
+		self.assertTrue(abs(hll.count() - 100) < 5)
+
+
+	def test_merge(self):
+		"""
+		Tests if merging partial sketches equals sketching everything.
+		"""
+
+		rnd = random.Random(3)
+		cats = [rnd.randint(0, 2**64 - 1) for i in range(500)]
+		bufs = []
+
+		for i in range(5000):
+			# CAT j has weight ~ 1/(j+1) so there are clear heavy hitters.
+			j = int(len(cats) ** rnd.random()) - 1
+			bufs.append(packet.new_basic_packet(False, False, False, cats[j], i, 0, bytes(j % 10)).to_bytes())
+
+		whole = sketches.CatSketch(width=512, k=5)
+		a = sketches.CatSketch(width=512, k=5)
+		b = sketches.CatSketch(width=512, k=5)
+
+		for i, buf in enumerate(bufs):
+			whole.update(0, buf)
+			(a if i % 2 else b).update(0, buf)
+
+		a.merge(pickle.loads(pickle.dumps(b)))
+
+		self.assertEqual(a.packets._counters, whole.packets._counters)
+		self.assertEqual(a.bytes._counters, whole.bytes._counters)
+		self.assertEqual(a.distinct_cats(), whole.distinct_cats())
+		self.assertEqual(a.top()[0][0], cats[0])
+		self.assertEqual([cat for cat, n in a.top()][:3], [cat for cat, n in whole.top()][:3])
+
+		with self.assertRaises(ValueError):
+			a.merge(sketches.CatSketch(width=1024))
+
+
+	def test_heavy_hitters_minimum(self):
+		"""
+		Tests if updating the current minimum key moves the minimum.
+		"""
+
+		heavy = sketches.HeavyHitters(k=2, sketch=sketches.CountMinSketch(width=1 << 16))
+
+		def update(key, n=1):
+			for i in range(n):
+				heavy.sketch.update(key)
+				heavy.update(key)
+
+		update(1)
+		update(2)
+		update(1, 4)
+		update(2, 4)
+		update(3, 2)
+
+		self.assertEqual(heavy._min, 5)
+		self.assertEqual(sorted(key for key, n in heavy.top()), [1, 2])
+
+		update(3, 4)
+		self.assertEqual(heavy.top(), [(3, 6), (2, 5)])
+
+
+	def test_sampled_distinct(self):
+		"""
+		Tests if the distinct count of a CatHashSampler sampled stream is
+		not skewed by the sampler's hash.
+		"""
+
+		sampler = sampling.CatHashSampler(0.25)
+		rnd = random.Random(5)
+		cats = [cat for cat in (rnd.getrandbits(64) for i in range(200000)) if sampler.keeps_cat(cat)]
+		hll = sketches.HyperLogLog(p=12)
+		window = rollup.Window(0, 1.0)
+
+		for cat in cats:
+			hll.add(cat)
+			window.cats.add(cat)
+
+		self.assertTrue(abs(hll.count() - len(cats)) < len(cats) * 0.05)
+		self.assertTrue(abs(window.cats.count() - len(cats)) < len(cats) * 0.1)
+
+
+	def test_reservoir(self):
+		r = sketches.Reservoir(1000)
+
+		self.assertEqual(r.percentile(50, 0.0), 0.0)
+
+		for i in range(100000):
+			r.add(i)
+
+		self.assertEqual((r.count, len(r.samples)), (100000, 1000))
+		self.assertTrue(abs(r.percentile(50) - 50000) < 5000)
+		self.assertTrue(r.percentile(99) > 95000)
+
+
+from pluspacket import sequence
+
+
+class TestSequence(unittest.TestCase):
+	"""
+	PSN gap, reordering and duplicate detection tests.
+	"""
+
+	def _analyze(self, psns, window=64):
+		analyzer = sequence.SeqAnalyzer(window)
+
+		for psn in psns:
+			analyzer.update(1, psn % 2**32)
+
+		return analyzer.metrics(1)
+
+
+	def test_in_order(self):
+		m = self._analyze(range(100))
+
+		self.assertEqual(m["received"], 100)
+		self.assertEqual(m["lost"], 0)
+		self.assertEqual(m["loss_rate"], 0.0)
+
+
+	def test_loss_reorder_duplicate(self):
+		"""
+		Tests 0 1 3 2 2 6 7: 2 is reordered and duplicated, 4 and 5 lost.
+		"""
+
+		m = self._analyze([0, 1, 3, 2, 2, 6, 7])
+
+		self.assertEqual(m["received"], 6)
+		self.assertEqual(m["lost"], 2)
+		self.assertEqual(m["reordered"], 1)
+		self.assertEqual(m["duplicates"], 1)
+		self.assertEqual(m["gaps"], 2)
+
+
+	def test_wraparound(self):
+		"""
+		Tests if PSN wraparound is not mistaken for loss.
+		"""
+
+		m = self._analyze([2**32 - 2, 2**32 - 1, 1, 0, 2])
+
+		self.assertEqual(m["received"], 5)
+		self.assertEqual(m["lost"], 0)
+		self.assertEqual(m["reordered"], 1)
+
+
+	def test_late(self):
+		"""
+		Tests if PSNs older than the window are counted as late.
+		"""
+
+		m = self._analyze([0, 100, 1], window=16)
+
+		self.assertEqual(m["late"], 1)
+		self.assertEqual(m["lost"], 99)
+
+
+	def test_before_first(self):
+		"""
+		Tests if PSNs before the first one are late, not reordered.
+		"""
+
+		m = self._analyze([5, 4, 6])
+
+		self.assertEqual(m["lost"], 0)
+		self.assertEqual(m["loss_rate"], 0.0)
+		self.assertEqual(m["late"], 1)
+		self.assertEqual(m["reordered"], 0)
+
+		m = self._analyze([5, 8, 4, 7, 6, 6])
+
+		self.assertEqual(m["lost"], 0)
+		self.assertEqual(m["reordered"], 2)
+		self.assertEqual(m["duplicates"], 1)
+		self.assertEqual(m["late"], 1)
+
+
+	def test_directions_and_aggregate(self):
+		analyzer = sequence.SeqAnalyzer()
+
+		for psn in range(10):
+			buf = packet.new_basic_packet(False, False, False, 5, psn * 2, 0, b"").to_bytes()
+			analyzer.update_buf(buf, direction=0)
+			analyzer.update(5, psn, direction=1)
+
+		self.assertEqual(analyzer.metrics(5, 0)["lost"], 9)
+		self.assertEqual(analyzer.metrics(5, 1)["lost"], 0)
+
+		total = analyzer.aggregate()
+
+		self.assertEqual(total["flows"], 2)
+		self.assertEqual(total["received"], 20)
+		self.assertEqual(total["lost"], 9)
+
+
+from pluspacket import generator
+
+
+class TestGenerator(unittest.TestCase):
+	"""
+	Synthetic traffic generator tests.
+	"""
+
+	def test_valid_packets(self):
+		"""
+		Tests if all generated packets parse and the mix is as configured.
+		"""
+
+		gen = generator.TrafficGenerator(cats=50, extended_ratio=0.5,
+			pcf_types={0x01: 1, 0xFF: 1, 0x0100: 1}, l_rate=0.1, stop_rate=0.01, seed=1)
+		bufs = gen.batch(5000)
+
+		self.assertEqual(len(bufs), 5000)
+
+		parsed = [packet.parse_packet(buf) for buf in bufs]
+		extended = [p for p in parsed if p.x]
+
+		self.assertTrue(2000 < len(extended) < 3000)
+		self.assertEqual(set(p.pcf_type for p in extended), set([0x01, 0xFF, 0x0100]))
+		self.assertTrue(any(p.l for p in parsed))
+		self.assertTrue(any(p.s for p in parsed))
+
+		for p in parsed:
+			self.assertEqual(p.to_bytes(), packet.parse_packet(p.to_bytes()).to_bytes())
+
+
+	def test_loss_and_reorder(self):
+		"""
+		Tests if the generated loss and reordering is detected.
+		"""
+
+		gen = generator.TrafficGenerator(cats=10, loss=0.05, reorder=0.05, seed=2)
+		analyzer = sequence.SeqAnalyzer()
+		n = 0
+
+		for ts, buf, direction in gen.packets(20000):
+			analyzer.update_buf(buf, direction)
+			n += 1
+
+		total = analyzer.aggregate()
+
+		self.assertTrue(18500 < n < 19500)
+		self.assertTrue(0.04 < total["loss_rate"] < 0.06)
+		self.assertTrue(total["reordered"] > 0)
+
+
+	def test_write_pcap(self):
+		with tempfile.TemporaryDirectory() as d:
+			path = os.path.join(d, "gen.pcap")
+			generator.TrafficGenerator(cats=20, seed=3).write_pcap(path, 1000)
+			table = ingest.process_trace(path)
+
+		self.assertEqual(sum(flow.packets for flow in table), 1000)
+		self.assertEqual(len(table), 20)
+
+
+import socket
+
+from pluspacket import replay, decap
+
+
+class TestPcapWriter(unittest.TestCase):
+	"""
+	pcap writer, encapsulation and replay tests.
+	"""
+
+	def test_pack_into(self):
+		"""
+		Tests if pack_into writes the same bytes as to_bytes.
+		"""
+
+		plus_packet = packet.new_extended_packet(True, False, True, 1234, 5, 6, 0x0100, 2, b"abc", b"payload")
+		buf = bytearray(64)
+		n = plus_packet.pack_into(buf, 3)
+
+		self.assertEqual(buf[3 : 3 + n], plus_packet.to_bytes())
+
+		with self.assertRaises(ValueError):
+			plus_packet.pack_into(bytearray(10))
+
+
+	def test_roundtrip(self):
+		"""
+		Tests if written packets are read back with valid checksums.
+		"""
+
+		encapsulators = [pcap.UdpEncapsulator(udp_checksum=True),
+			pcap.UdpEncapsulator("fe80::1", "fe80::2", 1, 2, udp_checksum=True)]
+		packets = [packet.new_basic_packet(False, False, False, i, i, i, bytes(i)) for i in range(50)]
+
+		with tempfile.TemporaryDirectory() as d:
+			path = os.path.join(d, "out.pcap")
+
+			# A tiny buffer forces flushes and growing.
+			with pcap.UdpPcapWriter(path, buffer_size=64) as writer:
+				for i, plus_packet in enumerate(packets):
+					if i % 2:
+						writer.write_packet(i * 0.5, plus_packet, encapsulators[(i // 2) % 2])
+					else:
+						writer.write_payload(i * 0.5, plus_packet.to_bytes(), encapsulators[(i // 2) % 2])
+
+			with pcap.PcapReader(path) as reader:
+				records = list(reader)
+				linktype = reader.linktype
+
+		self.assertEqual(len(records), 50)
+
+		for i, record in enumerate(records):
+			pos = decap.udp_payload_offset(linktype, record.data)
+
+			self.assertEqual(record.ts, i * 0.5)
+			self.assertEqual(record.data[pos:], packets[i].to_bytes())
+
+			if record.data[14] >> 4 == 4:
+				self.assertEqual(pcap._ones_sum(record.data[14:34]), 0xFFFF)
+				pseudo = record.data[26:34] + struct.pack(">HH", 17, pos - 34 + len(packets[i].to_bytes()))
+				self.assertEqual(pcap._fold(pcap._ones_sum(pseudo) + pcap._ones_sum(record.data[34:])), 0xFFFF)
+			else:
+				pseudo = record.data[22:54] + struct.pack(">HH", 17, len(record.data) - 54)
+				self.assertEqual(pcap._fold(pcap._ones_sum(pseudo) + pcap._ones_sum(record.data[54:])), 0xFFFF)
+
+
+	def test_replay(self):
+		"""
+		Tests if replay over loopback keeps the original timing.
+		"""
+
+		receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		receiver.bind(("127.0.0.1", 0))
+		sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+		records = [(100 + i * 0.002, b"x" * i) for i in range(20)]
+
+		try:
+			stats = replay.Replayer(sender, receiver.getsockname()).replay(records)
+			received = [receiver.recv(100) for i in range(20)]
+
+			fast = replay.Replayer(sender, receiver.getsockname(), speed=None).replay(records)
+		finally:
+			sender.close()
+			receiver.close()
+
+		self.assertEqual(received, [payload for ts, payload in records])
+		self.assertEqual(stats.packets, 20)
+		self.assertTrue(stats.duration >= 0.038)
+		self.assertTrue(fast.duration < stats.duration)
+		self.assertTrue(stats.summary()["p50_lateness"] < 0.002)
+
+
+class TestDecap(unittest.TestCase):
+	"""
+	Link-layer/IP/UDP decapsulation tests.
+	"""
+
+	def setUp(self):
+		self.plus = bytes(packet.new_basic_packet(False, False, False, 7, 8, 9, b"data").to_bytes())
+		self.udp = struct.pack(">HHHH", 1, 2, 8 + len(self.plus), 0) + self.plus
+
+
+	def _ipv4(self, options=b"", frag=0):
+		ihl = 5 + len(options) // 4
+		return struct.pack(">BBHHHBBH4s4s", 0x40 | ihl, 0, ihl * 4 + len(self.udp), 0, frag, 64, 17, 0,
+			bytes(4), bytes(4)) + options + self.udp
+
+
+	def _ipv6(self, extensions=()):
+		# extensions: (type, body) with body padded to a multiple of 8 - 2.
+		chain = b""
+		types = [t for t, body in extensions] + [17]
+
+		for i, (t, body) in enumerate(extensions):
+			chain += bytes([types[i + 1], (len(body) + 2) // 8 - 1]) + body
+
+		return struct.pack(">LHBB16s16s", 0x60000000, len(chain) + len(self.udp), types[0], 64,
+			bytes(16), bytes(16)) + chain + self.udp
+
+
+	def _check(self, linktype, frame, offset=None):
+		result = decap.decapsulate(linktype, frame)
+
+		self.assertNotEqual(result, None)
+
+		if offset is not None:
+			self.assertEqual(result.payload_offset, offset)
+
+		view = decap.udp_payload(linktype, frame)
+
+		self.assertEqual(bytes(view), self.plus)
+		self.assertTrue(packet.detect_plus(view))
+		self.assertEqual(packet.parse_packet(view).psn, 8)
+
+
+	def test_fast_paths(self):
+		eth4 = bytes(12) + b"\x08\x00"
+		eth6 = bytes(12) + b"\x86\xdd"
+
+		self._check(pcap.LINKTYPE_ETHERNET, eth4 + self._ipv4(), 42)
+		self._check(pcap.LINKTYPE_ETHERNET, eth6 + self._ipv6(), 62)
+
+		# Ethernet padding must not end up in the payload.
+		self._check(pcap.LINKTYPE_ETHERNET, eth4 + self._ipv4() + bytes(10), 42)
+
+
+	def test_general(self):
+		vlan = bytes(12) + b"\x81\x00\x00\x01\x81\x00\x00\x02\x08\x00"
+
+		self._check(pcap.LINKTYPE_ETHERNET, vlan + self._ipv4(), 50)
+		self._check(pcap.LINKTYPE_ETHERNET, bytes(12) + b"\x08\x00" + self._ipv4(bytes(8)), 50)
+		self._check(pcap.LINKTYPE_ETHERNET, bytes(12) + b"\x86\xdd" + self._ipv6([(0, bytes(6)), (60, bytes(14))]), 86)
+		self._check(pcap.LINKTYPE_RAW, self._ipv6([(44, bytes(6))]), 56)
+		self._check(pcap.LINKTYPE_IPV4, self._ipv4(), 28)
+		self._check(decap.LINKTYPE_LINUX_SLL, bytes(14) + b"\x08\x00" + self._ipv4(), 44)
+		self._check(decap.LINKTYPE_NULL, struct.pack("<L", 2) + self._ipv4(), 32)
+
+
+	def test_not_udp(self):
+		eth4 = bytes(12) + b"\x08\x00"
+
+		# More fragments / fragment offset set.
+		self.assertEqual(decap.decapsulate(pcap.LINKTYPE_ETHERNET, eth4 + self._ipv4(frag=0x2000)), None)
+		self.assertEqual(decap.decapsulate(pcap.LINKTYPE_ETHERNET, eth4 + self._ipv4(frag=0x0010)), None)
+		self.assertEqual(decap.decapsulate(pcap.LINKTYPE_ETHERNET, bytes(12) + b"\x08\x06" + bytes(28)), None)
+		self.assertEqual(decap.decapsulate(pcap.LINKTYPE_ETHERNET, eth4 + self._ipv4()[:25]), None)
+		self.assertEqual(decap.udp_payload_offset(pcap.LINKTYPE_RAW, b""), None)
+
+		with self.assertRaises(ValueError):
+			decap.decapsulate(12345, b"")
+
+
+from pluspacket import reassembly
+
+
+def _fragments(udp, size, ipv6=False, ident=1):
+	"""
+	Splits a UDP datagram into Ethernet framed IP fragments of size bytes.
+	"""
+
+	frames = []
+
+	for offset in range(0, len(udp), size):
+		data = udp[offset : offset + size]
+		more = offset + size < len(udp)
+
+		if ipv6:
+			frag = struct.pack(">BBHL", 17, 0, offset | more, ident)
+			ip = struct.pack(">LHBB16s16s", 0x60000000, 8 + len(data), 44, 64, bytes(16), bytes(15) + b"\x01")
+			frames.append(bytes(12) + b"\x86\xdd" + ip + frag + data)
+		else:
+			ip = struct.pack(">BBHHHBBH4s4s", 0x45, 0, 20 + len(data), ident, (offset // 8) | (more << 13),
+				64, 17, 0, bytes(4), bytes(4))
+			frames.append(bytes(12) + b"\x08\x00" + ip + data)
+
+	return frames
+
+
+class TestReassembly(unittest.TestCase):
+	"""
+	IP fragment reassembly tests.
+	"""
+
+	def setUp(self):
+		self.plus = bytes(packet.new_extended_packet(True, False, False, 1, 2, 3, 0x01, 3, bytes(60), bytes(3000)).to_bytes())
+		self.udp = struct.pack(">HHHH", 1, 2, 8 + len(self.plus), 0) + self.plus
+
+
+	def test_ipv4_out_of_order(self):
+		r = reassembly.Reassembler()
+		frames = _fragments(self.udp, 1480)
+		frames.reverse()
+
+		# A duplicate fragment must not confuse anything.
+		frames.insert(1, frames[1])
+
+		results = [r.udp_payload(0, pcap.LINKTYPE_ETHERNET, frame) for frame in frames]
+
+		self.assertEqual(results[:-1], [None] * (len(frames) - 1))
+		self.assertEqual(bytes(results[-1]), self.plus)
+		self.assertEqual(packet.parse_packet(results[-1]).pcf_len, 60)
+		self.assertEqual(len(r), 0)
+		self.assertEqual(r.held_bytes, 0)
+
+
+	def test_resume(self):
+		"""
+		Tests if a datagram whose fragments straddle a checkpoint is kept.
+		"""
+
+		frames = [(1.0 + i, _udp_frame(packet.new_basic_packet(False, False, False, 9, i, 0, b"").to_bytes())) for i in range(10)]
+		frames += [(11.0, frame) for frame in _fragments(self.udp, 1480)]
+
+		with tempfile.TemporaryDirectory() as d:
+			trace = os.path.join(d, "trace.pcap")
+			path = os.path.join(d, "trace.ckpt")
+			_write_pcap(trace, frames)
+			expected = ingest.process_trace(trace, reassembler=reassembly.Reassembler())
+
+			ckpt = checkpoint.Checkpointer(path)
+			ingest.process_trace(trace, checkpointer=ckpt, max_records=11, reassembler=reassembly.Reassembler())
+			ckpt.close()
+
+			r = reassembly.Reassembler()
+			ckpt = checkpoint.Checkpointer(path)
+			table = ingest.process_trace(trace, checkpointer=ckpt, resume=True, reassembler=r)
+			ckpt.close()
+
+		self.assertEqual(sorted(flow.to_dict().items() for flow in table), sorted(flow.to_dict().items() for flow in expected))
+		self.assertEqual(sum(flow.packets for flow in table), 11)
+		self.assertEqual((r.fragments, r.completed, len(r)), (3, 1, 0))
+
+
+	def test_ipv6(self):
+		r = reassembly.Reassembler()
+		frames = _fragments(self.udp, 1232, ipv6=True)
+		results = [r.udp_payload(0, pcap.LINKTYPE_ETHERNET, frame) for frame in frames]
+
+		self.assertEqual(bytes(results[-1]), self.plus)
+		self.assertEqual(r.completed, 1)
+
+
+	def test_timeout_and_memory_cap(self):
+		r = reassembly.Reassembler(timeout=1.0, max_bytes=4000)
+
+		r.feed(0, pcap.LINKTYPE_ETHERNET, _fragments(self.udp, 1480, ident=1)[0])
+		r.feed(5, pcap.LINKTYPE_ETHERNET, _fragments(self.udp, 1480, ident=2)[0])
+
+		self.assertEqual(r.expired, 1)
+		self.assertEqual(len(r), 1)
+
+		for i in range(3, 6):
+			r.feed(5, pcap.LINKTYPE_ETHERNET, _fragments(self.udp, 1480, ident=i)[0])
+
+		self.assertTrue(r.held_bytes <= 4000)
+		self.assertEqual(r.evicted, 2)
+
+
+	def test_ingest(self):
+		with tempfile.TemporaryDirectory() as d:
+			path = os.path.join(d, "frag.pcap")
+			_write_pcap(path, [(i, frame) for i, frame in enumerate(_fragments(self.udp, 1480))])
+
+			self.assertEqual(len(ingest.process_trace(path)), 0)
+			table = ingest.process_trace(path, reassembler=reassembly.Reassembler())
+
+		self.assertEqual(table.get(1).packets, 1)
+		self.assertEqual(table.get(1).bytes, len(self.plus))
+
+
+import mmap
+
+from pluspacket import parallel
+
+
+class TestParallel(unittest.TestCase):
+	"""
+	Parallel pcap processing tests.
+	"""
+
+	@classmethod
+	def setUpClass(cls):
+		cls.dir = tempfile.TemporaryDirectory()
+		cls.trace = os.path.join(cls.dir.name, "trace.pcap")
+		generator.TrafficGenerator(cats=30, l_rate=0.1, seed=4).write_pcap(cls.trace, 3000)
+
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.dir.cleanup()
+
+
+	def _flows(self, table):
+		return sorted(flow.to_dict().items() for flow in table)
+
+
+	def test_split(self):
+		"""
+		Tests if heuristic splitting finds the same boundaries as walking.
+		"""
+
+		with open(self.trace, "rb") as f:
+			with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+				ranges = parallel.split_pcap(buf, 7)
+				exact = parallel.split_pcap(buf, 7, exact=True)
+				size = len(buf)
+
+		self.assertEqual(ranges, exact)
+		self.assertEqual(len(ranges), 7)
+		self.assertEqual(ranges[0][0], 24)
+		self.assertEqual(ranges[-1][1], size)
+
+		offsets = set()
+
+		with pcap.PcapReader(self.trace) as reader:
+			for record in reader:
+				offsets.add(record.offset)
+
+		for start, end in ranges:
+			self.assertTrue(start in offsets)
+
+
+	def test_parallel(self):
+		"""
+		Tests if the merged result equals sequential processing.
+		"""
+
+		expected = ingest.process_trace(self.trace)
+
+		self.assertEqual(self._flows(parallel.process_parallel(self.trace, workers=1, chunks=5)), self._flows(expected))
+		self.assertEqual(self._flows(parallel.process_parallel(self.trace, workers=3, chunks=10)), self._flows(expected))
+
+		sketch = parallel.process_parallel(self.trace, workers=2, factory=sketches.CatSketch)
+		self.assertEqual(sketch.packets.total, 3000)
+
+
+import concurrent.futures
+
+from pluspacket import batch
+
+
+class TestBatch(unittest.TestCase):
+	"""
+	Differential tests of the batch parser against from_bytes.
+	"""
+
+	_fields = ["l", "r", "s", "x", "cat", "psn", "pse", "pcf_type", "pcf_len", "pcf_integrity", "pcf_value", "payload"]
+
+
+	def _vectors(self):
+		fuzzy = TestFuzzy()
+		rnd = random.getstate()
+		random.seed(5)
+
+		bufs = [fuzzy._random_buf_1() for i in range(3000)]
+		bufs += [fuzzy._random_buf_2() for i in range(3000)]
+		bufs += [bytes([0xD8, 0x00, 0x7F, 0xFF]) + bytes(16) + tail
+			for tail in [b"", b"\x00", b"\x00\x01", b"\x05", b"\x05\x08", b"\x05\x08a", b"\xff"]]
+		bufs += [b"", bytes(19), bytearray(25), memoryview(bytes(40))]
+
+		random.setstate(rnd)
+
+		return bufs
+
+
+	def _check(self, accelerated):
+		bufs = self._vectors()
+		result = batch.parse_batch(bufs, accelerated)
+
+		self.assertEqual(len(result), len(bufs))
+
+		for i, buf in enumerate(bufs):
+			try:
+				expected = packet.parse_packet(buf)
+			except ValueError:
+				expected = None
+
+			if expected is None:
+				self.assertFalse(result.ok(i))
+				self.assertNotEqual(result.error(i), None)
+
+				with self.assertRaises(ValueError):
+					result.packet(i)
+
+				continue
+
+			self.assertTrue(result.ok(i))
+			got = result.packet(i)
+
+			for field in self._fields:
+				self.assertEqual(getattr(got, field), getattr(expected, field))
+
+
+	def test_python(self):
+		self._check(False)
+
+
+	@unittest.skipUnless(batch.has_accelerator(), "batch kernel not built")
+	def test_accelerated(self):
+		self._check(True)
+
+		with self.assertRaises(TypeError):
+			batch.parse_batch([1, 2, 3])
+
+
+	def test_threads(self):
+		"""
+		Tests if batches parsed in a thread pool give the same results.
+		"""
+
+		bufs = self._vectors()
+		batches = [bufs[i : i + 500] for i in range(0, len(bufs), 500)]
+
+		with concurrent.futures.ThreadPoolExecutor(4) as executor:
+			results = list(executor.map(batch.parse_batch, batches))
+
+		self.assertEqual(sum([list(r.cat) for r in results], []), list(batch.parse_batch(bufs).cat))
+
+
+import subprocess
+
+import pluspacket
+
+
+class TestImport(unittest.TestCase):
+	"""
+	Startup footprint tests.
+	"""
+
+	def _run(self, code):
+		env = dict(os.environ)
+		env["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.abspath(pluspacket.__file__)))
+
+		return subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+			env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+
+	def test_lazy_submodules(self):
+		"""
+		Tests if importing the package only loads the core parser.
+		"""
+
+		out = self._run("import sys, pluspacket; pluspacket.parse_packet; print(sorted(m for m in sys.modules if m.startswith('pluspacket')))")
+
+		self.assertEqual(out.stdout.strip(), "['pluspacket', 'pluspacket.packet']")
+
+		out = self._run("import sys, pluspacket; pluspacket.sketches.CatSketch; print('pluspacket.sketches' in sys.modules)")
+
+		self.assertEqual(out.stdout.strip(), "True")
+
+		with self.assertRaises(AttributeError):
+			pluspacket.no_such_module
+
+		self.assertTrue("pcap" in dir(pluspacket))
+
+
+	def test_import_time(self):
+		"""
+		Fails if importing the package takes 10ms or more (best of 5).
+		"""
+
+		best = None
+
+		for i in range(5):
+			err = self._run("import pluspacket").stderr
+
+			for line in err.splitlines():
+				fields = line.split("|")
+
+				if len(fields) == 3 and fields[2].strip() == "pluspacket":
+					us = int(fields[1])
+					best = us if best is None else min(best, us)
+
+		self.assertNotEqual(best, None)
+		self.assertTrue(best < 10000, "import pluspacket took %d us" % best)
+
+
+import io
+import json
+
+from pluspacket import cli, summary
+
+
+def _write_pcapng(path, frames):
+	"""
+	Writes (ts, frame) tuples to a pcapng file with nanosecond resolution.
+	"""
+
+	def block(block_type, body):
+		body += bytes(-len(body) % 4)
+		return struct.pack("<LL", block_type, len(body) + 12) + body + struct.pack("<L", len(body) + 12)
+
+	with open(path, "wb") as f:
+		f.write(block(0x0A0D0D0A, struct.pack("<LHHq", 0x1A2B3C4D, 1, 0, -1)))
+		# if_tsresol = 9, end of options.
+		f.write(block(1, struct.pack("<HHL", 1, 0, 65535) + struct.pack("<HHB3x", 9, 1, 9) + bytes(4)))
+		# Some block that has to be skipped.
+		f.write(block(5, bytes(8)))
+
+		for ts, frame in frames:
+			ns = int(round(ts * 1e9))
+			f.write(block(6, struct.pack("<LLLLL", 0, ns >> 32, ns & 0xFFFFFFFF, len(frame), len(frame)) + frame))
+
+
+class TestCli(unittest.TestCase):
+	"""
+	pcapng reader, summaries and command line tool tests.
+	"""
+
+	@classmethod
+	def setUpClass(cls):
+		cls.dir = tempfile.TemporaryDirectory()
+		cls.trace = os.path.join(cls.dir.name, "trace.pcap")
+		generator.TrafficGenerator(cats=10, extended_ratio=0.5, pcf_types={1: 1, 0xFF: 1}, seed=6).write_pcap(cls.trace, 2000)
+
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.dir.cleanup()
+
+
+	def _run(self, *args):
+		out = os.path.join(self.dir.name, "out")
+		self.assertEqual(cli.main(list(args) + ["-q", "-o", out]), 0)
+
+		with open(out) as f:
+			return f.read()
+
+
+	def test_pcapng(self):
+		path = os.path.join(self.dir.name, "trace.pcapng")
+
+		with pcap.PcapReader(self.trace) as reader:
+			records = list(reader)
+
+		_write_pcapng(path, [(r.ts, r.data) for r in records])
+
+		with pcap.open_capture(path) as reader:
+			self.assertEqual(reader.linktype, pcap.LINKTYPE_ETHERNET)
+			got = list(reader)
+
+		self.assertEqual([bytes(r.data) for r in got], [bytes(r.data) for r in records])
+		self.assertEqual([round(r.ts, 6) for r in got], [round(r.ts, 6) for r in records])
+
+		self.assertEqual(self._run(path), self._run(self.trace))
+
+
+	def test_json(self):
+		lines = [json.loads(line) for line in self._run(self.trace).splitlines()]
+
+		self.assertEqual(len(lines), 10)
+		self.assertEqual(sum(d["packets"] for d in lines), 2000)
+		self.assertEqual(sum(sum(d["pcf_types"].values()) for d in lines), sum(d["x"] for d in lines))
+		self.assertTrue(all(d["rtt_samples"] > 0 and d["rtt_min"] > 0 for d in lines))
+
+
+	def test_csv_and_workers(self):
+		serial = self._run(self.trace, "-f", "csv").splitlines()
+		parallel_ = self._run(self.trace, "-f", "csv", "--workers", "2").splitlines()
+
+		self.assertEqual(serial[0].split(","), cli._csv_fields)
+		self.assertEqual(len(serial), 11)
+
+		# Everything but the RTT mean, which is summed up in another order.
+		key = lambda line: line.split(",")[:12] + line.split(",")[13:]
+		self.assertEqual(sorted(map(key, serial)), sorted(map(key, parallel_)))
+
+
+	def test_workers_bounded(self):
+		"""
+		Tests --workers with many small parts, flow expiry and pcapng.
+		"""
+
+		path = os.path.join(self.dir.name, "workers.pcapng")
+
+		with pcap.PcapReader(self.trace) as reader:
+			_write_pcapng(path, [(r.ts, r.data) for r in reader])
+
+		chunk_bytes = cli._chunk_bytes
+
+		try:
+			cli._chunk_bytes = 8192
+
+			key = lambda d: (d["cat"], d["packets"], d["bytes"], d["rtt_samples"], d["rtt_min"], d["rtt_max"])
+			serial = [json.loads(line) for line in self._run(self.trace).splitlines()]
+			parallel_ = [json.loads(line) for line in self._run(self.trace, "--workers", "3").splitlines()]
+
+			self.assertEqual(sorted(map(key, serial)), sorted(map(key, parallel_)))
+
+			# Flows are emitted as they are pushed out between the parts.
+			parallel_ = [json.loads(line) for line in self._run(self.trace, "--workers", "3", "--max-flows", "3").splitlines()]
+			packets = {}
+
+			for d in parallel_:
+				packets[d["cat"]] = packets.get(d["cat"], 0) + d["packets"]
+
+			self.assertTrue(len(parallel_) > len(serial))
+			self.assertEqual(sorted(packets.items()), sorted((d["cat"], d["packets"]) for d in serial))
+		finally:
+			cli._chunk_bytes = chunk_bytes
+
+		self.assertEqual(self._run(path, "--workers", "2"), self._run(path))
+
+
+	def test_bounded_flows(self):
+		"""
+		Tests if the table never holds more than max_flows flows.
+		"""
+
+		table = summary.SummaryTable(idle_timeout=None, max_flows=3)
+		emitted = []
+
+		with pcap.PcapReader(self.trace) as reader:
+			for record in reader:
+				table.update(record.ts, decap.udp_payload(reader.linktype, record.data))
+				emitted.extend(table.expire(record.ts))
+				self.assertTrue(len(table) <= 3)
+
+		emitted.extend(table.flush())
+
+		self.assertEqual(sum(flow.packets for flow in emitted), 2000)
+
+
+import threading
+import urllib.request
+
+from pluspacket import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+	def test_threads(self):
+		"""
+		Tests if per-thread counts add up on scrape.
+		"""
+
+		registry = metrics.Registry()
+		counter = registry.counter("test_total", "Test.")
+
+		def work():
+			for i in range(10000):
+				counter.inc()
+
+		threads = [threading.Thread(target=work) for i in range(4)]
+
+		for thread in threads:
+			thread.start()
+
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(counter.value(), 40000)
+		self.assertIn("test_total 40000\n", registry.render())
+
+
+	def test_render(self):
+		"""
+		Tests the text format of labelled counters, histograms and gauges.
+		"""
+
+		registry = metrics.Registry()
+		rejected = registry.counter("rejected_total", "Rejected.", ("reason",))
+		rtt = registry.histogram("rtt_seconds", "RTT.", (0.01, 0.1))
+		registry.gauge("active", "Active.", lambda: 3)
+
+		rejected.labels("bad_magic").inc(2)
+		rtt.observe(0.005)
+		rtt.observe(0.05)
+		rtt.observe(5.0)
+
+		text = registry.render()
+
+		self.assertIn("# TYPE rejected_total counter\n", text)
+		self.assertIn("rejected_total{reason=\"bad_magic\"} 2\n", text)
+		self.assertIn("rtt_seconds_bucket{le=\"0.01\"} 1\n", text)
+		self.assertIn("rtt_seconds_bucket{le=\"0.1\"} 2\n", text)
+		self.assertIn("rtt_seconds_bucket{le=\"+Inf\"} 3\n", text)
+		self.assertIn("rtt_seconds_count 3\n", text)
+		self.assertIn("active 3\n", text)
+
+		self.assertRaises(ValueError, rejected.inc)
+		self.assertRaises(ValueError, registry.counter, "active", "Again.")
+
+
+	def test_merge(self):
+		"""
+		Tests if snapshots of other processes are added on scrape.
+		"""
+
+		a = metrics.ObserverMetrics()
+		b = metrics.ObserverMetrics()
+
+		result = batch.parse_batch([packet.new_basic_packet(False, False, False, 1, 2, 3, b"x").to_bytes(), b"short"])
+		a.count_batch(result)
+		b.count_batch(result)
+		b.observe_rtt(0.02)
+
+		a.registry.merge(pickle.loads(pickle.dumps(b.registry.snapshot())))
+
+		self.assertEqual(a.parsed.value(), 2)
+		self.assertEqual(a.bytes.value(), 42)
+		self.assertEqual(a.rejected.value("too_short"), 2)
+		self.assertIn("pluspacket_rtt_seconds_count 1\n", a.registry.render())
+
+
+	def test_summary(self):
+		"""
+		Tests RTT and active CAT export of a SummaryTable.
+		"""
+
+		table = summary.SummaryTable()
+		observer = metrics.ObserverMetrics(table=table)
+		table.on_rtt = observer.observe_rtt
+
+		table.update(1.0, packet.new_basic_packet(False, False, False, 7, 10, 0, b"").to_bytes())
+		table.update(1.03, packet.new_basic_packet(False, False, False, 7, 20, 10, b"").to_bytes())
+
+		text = observer.registry.render()
+
+		self.assertIn("pluspacket_active_cats 1\n", text)
+		self.assertIn("pluspacket_rtt_seconds_bucket{le=\"0.05\"} 1\n", text)
+		self.assertIn("pluspacket_rtt_seconds_bucket{le=\"0.025\"} 0\n", text)
+
+
+	def test_http(self):
+		"""
+		Tests scraping over HTTP and over a Unix socket.
+		"""
+
+		registry = metrics.Registry()
+		registry.counter("scraped_total", "Test.").inc(5)
+
+		server = metrics.serve_http(registry, port=0)
+
+		try:
+			url = "http://127.0.0.1:%d/metrics" % server.server_address[1]
+
+			with urllib.request.urlopen(url) as response:
+				self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+				self.assertIn(b"scraped_total 5\n", response.read())
+		finally:
+			server.shutdown()
+			server.server_close()
+
+		with tempfile.TemporaryDirectory() as tmp:
+			path = os.path.join(tmp, "metrics.sock")
+			server = metrics.serve_unix(registry, path)
+
+			try:
+				with socket.socket(socket.AF_UNIX) as s:
+					s.connect(path)
+					s.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+					response = b""
+
+					while True:
+						data = s.recv(4096)
+
+						if not data:
+							break
+
+						response += data
+
+				self.assertTrue(response.startswith(b"HTTP/1.0 200"))
+				self.assertIn(b"scraped_total 5\n", response)
+			finally:
+				server.shutdown()
+				server.server_close()
+
+
+from pluspacket import archive
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+class TestArchive(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.tmp.name, "trace.plsa")
+		self.packets = []
+
+		rnd = random.Random(3)
+
+		with archive.ArchiveWriter(self.path, block_records=64) as writer:
+			for i in range(1000):
+				ts = 1000.0 + i * 0.01
+				cat = i // 100 * 7 + 1
+
+				if i % 3:
+					p = packet.new_basic_packet(bool(i & 1), False, False, cat, i, i + 1, b"payload")
+				else:
+					value = bytes(rnd.randint(0, 255) for j in range(i % 5))
+					p = packet.new_extended_packet(False, True, False, cat, i, i + 1, 0x01, 2, value, b"payload")
+
+				self.packets.append((ts, p))
+
+				if i % 2:
+					writer.write(ts, p)
+				else:
+					self.assertTrue(writer.write_buf(ts, memoryview(p.to_bytes())))
+
+			self.assertFalse(writer.write_buf(0.0, b"not a plus packet at all"))
+
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+
+	def test_roundtrip(self):
+		"""
+		Tests if headers and PCF values read back unchanged.
+		"""
+
+		with archive.ArchiveReader(self.path) as reader:
+			self.assertEqual(len(reader), 1000)
+
+			for i, (ts, p) in enumerate(self.packets):
+				q = reader.packet(i)
+				p.payload = b""
+
+				self.assertEqual(q.to_bytes(), p.to_bytes())
+				self.assertEqual(reader[i].ts_ns, int(round(ts * 1e9)))
+
+			self.assertEqual([record.psn for record in reader], list(range(1000)))
+
+
+	def test_pcf_base(self):
+		"""
+		Tests if PCF offsets are relative to a 64 bit base per block.
+		"""
+
+		with archive.ArchiveReader(self.path) as reader:
+			bases = [block.pcf_base for block in reader.blocks]
+			offsets = [record.pcf_offset for record in reader]
+
+			self.assertEqual(bases[0], 0)
+			self.assertTrue(all(a < b for a, b in zip(bases, bases[1:])))
+			self.assertEqual([reader[i].pcf_offset for i in range(1000)], offsets)
+
+			for i in range(64, 1000, 97):
+				if self.packets[i][1].pcf_value:
+					self.assertEqual(reader.pcf_value(reader[i]), self.packets[i][1].pcf_value)
+
+		# Move the PCF section of every block beyond 4 GiB in the index.
+		with open(self.path, "r+b") as f:
+			data = bytearray(f.read())
+			count, pcf_offset, index_offset, blocks, _, _ = archive._footer.unpack_from(data, len(data) - archive._footer.size)
+			size = archive._block.size + 8192 // 8
+
+			for i in range(blocks):
+				fields = list(archive._block.unpack_from(data, index_offset + i * size))
+				fields[-1] += 5 << 32
+				archive._block.pack_into(data, index_offset + i * size, *fields)
+
+			f.seek(0)
+			f.write(data)
+
+		with archive.ArchiveReader(self.path) as reader:
+			self.assertEqual([record.pcf_offset for record in reader], [offset + (5 << 32) for offset in offsets])
+
+		with self.assertRaises(ValueError):
+			archive.ArchiveWriter(io.BytesIO(), block_records=1 << 25)
+
+
+	def test_query(self):
+		"""
+		Tests if queries only read blocks that may match.
+		"""
+
+		with archive.ArchiveReader(self.path) as reader:
+			self.assertEqual(len(reader.blocks), 16)
+
+			result = list(reader.query(cat=15))
+			self.assertEqual([record.psn for record in result], list(range(200, 300)))
+			self.assertTrue(len(reader.select_blocks(cat=15)) <= 4)
+
+			result = list(reader.query(start=1002.0, end=1003.0))
+			self.assertEqual([record.psn for record in result], list(range(200, 300)))
+
+			result = list(reader.query(start=1002.5, end=1004.0, cat=15))
+			self.assertEqual([record.psn for record in result], list(range(250, 300)))
+
+			self.assertEqual(list(reader.query(cat=2)), [])
+
+
+	@unittest.skipIf(numpy is None, "numpy is not installed")
+	def test_numpy(self):
+		"""
+		Tests the structured array view and vectorized queries.
+		"""
+
+		with archive.ArchiveReader(self.path) as reader:
+			records = reader.records()
+
+			self.assertEqual(len(records), 1000)
+			self.assertEqual(records.dtype.itemsize, 32)
+			self.assertEqual(list(records["psn"][:5]), [0, 1, 2, 3, 4])
+			self.assertEqual(reader.pcf_value(records[3], 3), self.packets[3][1].pcf_value)
+			self.assertEqual(reader.pcf_value(records[999], 999), self.packets[999][1].pcf_value)
+			self.assertRaises(ValueError, reader.pcf_value, records[3])
+			self.assertEqual(list(reader.query_array(cat=15)["psn"]), list(range(200, 300)))
+
+			del records
+
+
+	def test_bloom(self):
+		"""
+		Tests that Bloom filters have no false negatives and survive bytes.
+		"""
+
+		bloom = sketches.BloomFilter(1024, 3)
+
+		for key in range(0, 1000, 10):
+			bloom.add(key)
+
+		restored = sketches.BloomFilter(1024, 3, data=bloom.to_bytes())
+
+		self.assertTrue(all(key in restored for key in range(0, 1000, 10)))
+		self.assertTrue(sum(key in restored for key in range(1, 1000, 10)) < 20)
+
+
+from pluspacket import index
+
+
+class TestIndex(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.trace = os.path.join(self.tmp.name, "trace.pcap")
+		self.frames = _random_trace(5000, ncats=32, seed=5)
+		self.frames.insert(100, (1000.1, _udp_frame(b"not plus")))
+		_write_pcap(self.trace, self.frames)
+
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+
+	def _scan(self, cat, start, end):
+		result = []
+
+		for ts, frame in self.frames:
+			buf = frame[42:]
+
+			if packet.detect_plus(buf) and packet.get_cat(buf) == cat and start <= ts < end:
+				result.append(buf)
+
+		return result
+
+
+	def test_query(self):
+		"""
+		Tests if indexed queries find the same packets as a full scan.
+		"""
+
+		idx = index.TraceIndex.build(self.trace, block_seconds=0.5)
+		cat = packet.get_cat(self.frames[0][1][42:])
+
+		self.assertEqual(len(idx.blocks), 10)
+		self.assertEqual(sum(len(block.cats) for block in idx.blocks), 5000)
+
+		for start, end in ((0, 2000), (1001.2, 1003.7), (1004.9, 1005.0)):
+			found = [p.to_bytes() for ts, p in idx.query(cat, start, end)]
+			self.assertEqual(found, self._scan(cat, start, end))
+
+		self.assertTrue(len(idx.offsets(cat, 1001.0, 1001.4)) < len(idx.offsets(cat)) / 4)
+		self.assertEqual(list(idx.query(12345)), [])
+
+
+	def test_sidecar(self):
+		"""
+		Tests saving, loading and rebuilding stale indexes.
+		"""
+
+		idx = index.TraceIndex.open(self.trace, block_seconds=0.5)
+		self.assertTrue(os.path.exists(self.trace + ".catidx"))
+
+		loaded = index.TraceIndex.load(self.trace)
+		cat = packet.get_cat(self.frames[0][1][42:])
+
+		self.assertEqual(loaded.offsets(cat), idx.offsets(cat))
+		self.assertEqual(len(loaded.blocks), 10)
+
+		_write_pcap(self.trace, self.frames[:1000])
+		os.utime(self.trace, ns=(0, 0))
+
+		self.assertRaises(ValueError, index.TraceIndex.load, self.trace)
+
+		found = list(index.query_traces([self.trace], cat, block_seconds=0.5))
+
+		self.assertEqual([p.to_bytes() for path, ts, p in found], self._scan(cat, 0, 1001.0))
+		self.assertEqual(len(index.TraceIndex.load(self.trace).blocks), 2)
+
+
+	def test_read_only(self):
+		"""
+		Tests if traces in read-only directories are indexed in memory.
+		"""
+
+		cat = packet.get_cat(self.frames[0][1][42:])
+		sidecar = os.path.join(self.tmp.name, "other", "trace.catidx")
+
+		os.chmod(self.tmp.name, 0o555)
+
+		try:
+			if os.access(self.tmp.name, os.W_OK):
+				# E.g. as root, a missing directory fails the same way.
+				idx = index.TraceIndex.open(self.trace, 0.5, sidecar)
+			else:
+				idx = index.TraceIndex.open(self.trace, 0.5)
+		finally:
+			os.chmod(self.tmp.name, 0o755)
+
+		self.assertFalse(os.path.exists(self.trace + ".catidx"))
+		self.assertFalse(os.path.exists(sidecar))
+		self.assertEqual([p.to_bytes() for ts, p in idx.query(cat)], self._scan(cat, 0, 2000))
+
+		os.mkdir(os.path.dirname(sidecar))
+		index.TraceIndex.open(self.trace, 0.5, sidecar)
+		self.assertEqual(index.TraceIndex.load(self.trace, sidecar).offsets(cat), idx.offsets(cat))
+
+
+class TestRewrite(unittest.TestCase):
+
+	def test_setters(self):
+		"""
+		Tests if setters patch fields in place and leave the rest alone.
+		"""
+
+		p = packet.new_extended_packet(True, False, True, 1, 2, 3, 0x01, 3, b"\x01\x02", b"payload")
+		buf = bytearray(p.to_bytes())
+
+		view = memoryview(buf)
+		packet.set_cat(view, 2**64 - 1)
+		packet.set_psn(view, 10)
+		packet.set_pse(buf, 2**32 - 1)
+		packet.set_l(buf, False)
+		packet.set_r(buf, True)
+		view.release()
+
+		q = packet.parse_packet(bytes(buf))
+
+		self.assertEqual((q.cat, q.psn, q.pse), (2**64 - 1, 10, 2**32 - 1))
+		self.assertEqual((q.l, q.r, q.s, q.x), (False, True, True, True))
+		self.assertEqual((q.pcf_type, q.pcf_value, q.payload), (0x01, b"\x01\x02", b"payload"))
+
+		packet.set_flags(buf, 0)
+		self.assertEqual(packet.get_flags(buf), 0)
+		self.assertTrue(packet.detect_plus(buf))
+
+		self.assertRaises(TypeError, packet.set_psn, bytes(buf), 1)
+		self.assertRaises(struct.error, packet.set_pse, bytearray(10), 1)
+
+
+	def test_batch(self):
+		"""
+		Tests batch rewrites with values and functions.
+		"""
+
+		bufs = [bytearray(packet.new_basic_packet(False, False, False, i, i, 0, b"x").to_bytes()) for i in range(10)]
+		bufs.append(bytearray(b"not a plus packet, left alone"))
+		other = bytes(bufs[-1])
+		remap = {i : i + 100 for i in range(5)}
+
+		n = batch.rewrite_batch(bufs, cat=lambda cat: remap.get(cat, cat), pse=7, flags=lambda f: f | 0x08)
+
+		self.assertEqual(n, 10)
+		self.assertEqual([packet.get_cat(buf) for buf in bufs[:10]], list(range(100, 105)) + list(range(5, 10)))
+		self.assertTrue(all(packet.get_pse(buf) == 7 and packet.get_l(buf) for buf in bufs[:10]))
+		self.assertEqual([packet.get_psn(buf) for buf in bufs[:10]], list(range(10)))
+		self.assertEqual(bytes(bufs[-1]), other)
+
+
+class TestIovec(unittest.TestCase):
+
+	def test_iovec(self):
+		"""
+		Tests if header and payload buffers make up to_bytes.
+		"""
+
+		payload = bytearray(1400)
+		p = packet.new_extended_packet(False, True, False, 1, 2, 3, 0x0100, 2, b"\x05", payload)
+		iovec = p.to_iovec()
+
+		self.assertEqual(b"".join(iovec), p.to_bytes())
+		self.assertTrue(iovec[1] is payload)
+
+		p.payload = b""
+		self.assertEqual(p.to_iovec(), [p.to_bytes()])
+
+
+	def test_cache(self):
+		"""
+		Tests if cached headers are patched per packet.
+		"""
+
+		cache = packet.HeaderCache(max_flows=2)
+
+		for cat in (1, 2, 1, 3):
+			for psn in range(3):
+				p = packet.new_basic_packet(True, False, False, cat, psn, psn + 10, b"data")
+				self.assertEqual(b"".join(p.to_iovec(cache)), p.to_bytes())
+
+		self.assertEqual(len(cache), 2)
+
+
+	def test_sendmsg(self):
+		"""
+		Tests sending the buffers with sendmsg.
+		"""
+
+		a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+		with a, b:
+			p = packet.new_basic_packet(False, False, True, 7, 8, 9, b"payload" * 100)
+			a.sendmsg(p.to_iovec(packet.HeaderCache()))
+
+			self.assertEqual(b.recv(2048), p.to_bytes())
+
+
+from pluspacket import session
+
+
+class TestSession(unittest.TestCase):
+
+	def test_exchange(self):
+		"""
+		Tests PSN numbering and PSE echo between two sessions.
+		"""
+
+		a = session.PlusSession(cat=42, psn=2**32 - 2, l=True)
+		b = session.PlusSession(cat=42, psn=100)
+
+		for i in range(3):
+			buf = a.send(b"ping")
+			p = packet.parse_packet(bytes(buf))
+
+			self.assertEqual((p.cat, p.psn, p.l, p.payload), (42, (2**32 - 2 + i) % 2**32, True, b"ping"))
+			self.assertEqual(bytes(b.receive(buf)), b"ping")
+
+			p = packet.parse_packet(bytes(b.send(b"pong")))
+			self.assertEqual((p.psn, p.pse), (100 + i, (2**32 - 2 + i) % 2**32))
+
+		self.assertEqual(b.receive(session.PlusSession(cat=43).send(b"x")), None)
+		self.assertEqual(b.received, 3)
+
+		ext = packet.new_extended_packet(False, False, False, 42, 5, 0, 0x01, 0, b"ab", b"data")
+		self.assertEqual(bytes(b.receive(ext.to_bytes())), b"data")
+		p = packet.parse_packet(b"".join(a.send_iovec(b"iov")))
+		self.assertEqual((p.psn, p.payload), (a.psn, b"iov"))
+
+
+	def test_stop(self):
+		"""
+		Tests the stop exchange.
+		"""
+
+		a = session.PlusSession(cat=1)
+		b = session.PlusSession(cat=1)
+
+		b.receive(a.send())
+		a.stop()
+		b.receive(a.send())
+
+		self.assertTrue(b.peer_stopped and b.stopping)
+		self.assertFalse(a.stopped or b.stopped)
+
+		confirm = b.send()
+		self.assertTrue(packet.get_s(confirm))
+		self.assertTrue(b.stopped)
+
+		a.receive(confirm)
+		self.assertTrue(a.stopped)
+
+
+	def test_table(self):
+		"""
+		Tests dispatching to many sessions and removing stopped ones.
+		"""
+
+		clients = session.SessionTable(accept=False, rnd=random.Random(1))
+		server = session.SessionTable(rnd=random.Random(2))
+
+		cats = [clients.open(addr=("10.0.0.1", i)).cat for i in range(2000)]
+
+		for cat in cats:
+			s, payload = server.receive(clients.send(cat, b"hello"), ("10.0.0.2", 1))
+			self.assertEqual((s.cat, bytes(payload)), (cat, b"hello"))
+
+		self.assertEqual(len(server), 2000)
+		self.assertEqual(clients.receive(session.PlusSession(cat=7).send()), (None, None))
+		self.assertEqual(clients.unknown, 1)
+		self.assertEqual(server.receive(b"garbage"), (None, None))
+
+		clients.get(cats[0]).stop()
+		server.receive(clients.send(cats[0]))
+		clients.receive(server.send(cats[0]))
+
+		self.assertEqual((len(clients), len(server)), (1999, 1999))
+
+
+from pluspacket import rollup
+
+
+class TestRollup(unittest.TestCase):
+
+	def _payloads(self, n):
+		rnd = random.Random(4)
+		result = []
+
+		for i in range(n):
+			cat = rnd.randrange(20)
+
+			if i % 4:
+				p = packet.new_basic_packet(False, False, False, cat, i, 0, bytes(10))
+			else:
+				p = packet.new_extended_packet(False, False, False, cat, i, 0, 1 + i % 3, 0, b"", bytes(10))
+
+			result.append((100.0 + i * 0.001, p.to_bytes()))
+
+		return result
+
+
+	def test_stream(self):
+		"""
+		Tests per-second windows of a stream of payloads.
+		"""
+
+		r = rollup.Rollup(width=1.0)
+
+		for ts, buf in self._payloads(5000):
+			r.update(ts, buf)
+
+		self.assertEqual([w.start for w in r.pop_windows()], [100.0, 101.0])
+
+		r.flush()
+		windows = [w.to_dict() for w in r.pop_windows()]
+
+		self.assertEqual([w["start"] for w in windows], [102.0, 103.0, 104.0])
+		self.assertEqual(windows[0]["packets"], 1000)
+		self.assertEqual(windows[0]["bytes"], 30 * 750 + 32 * 250)
+		self.assertEqual(windows[0]["extended_ratio"], 0.25)
+		self.assertEqual(sum(windows[0]["pcf_types"].values()), 250)
+		self.assertTrue(18 <= windows[0]["distinct_cats"] <= 22)
+
+
+	def test_late(self):
+		"""
+		Tests tolerance for out of order timestamps.
+		"""
+
+		emitted = []
+		r = rollup.Rollup(width=1.0, lateness=2, on_window=emitted.append)
+		buf = packet.new_basic_packet(False, False, False, 1, 2, 3, b"").to_bytes()
+
+		for ts in (10.5, 11.2, 10.9, 12.9, 10.1):
+			r.update(ts, buf)
+
+		self.assertEqual((emitted, r.late), ([], 0))
+
+		r.update(14.0, buf)
+		r.update(11.5, buf)
+
+		self.assertEqual([(w.start, w.packets) for w in emitted], [(10.0, 3), (11.0, 1)])
+		self.assertEqual(r.late, 1)
+
+
+	def test_batch(self):
+		"""
+		Tests if batch updates give the same windows as single updates.
+		"""
+
+		payloads = self._payloads(3000) + [(103.0, b"short")]
+		ts = [t for t, buf in payloads]
+		result = batch.parse_batch([buf for t, buf in payloads])
+		numpy_ = rollup.numpy
+
+		single = rollup.Rollup()
+
+		for t, buf in payloads:
+			single.update(t, buf)
+
+		single.flush()
+		expected = [w.to_dict() for w in single.pop_windows()]
+
+		for module in set([numpy_, None]):
+			try:
+				rollup.numpy = module
+				batched = rollup.Rollup()
+				batched.update_batch(ts, result)
+				batched.flush()
+			finally:
+				rollup.numpy = numpy_
+
+			self.assertEqual([w.to_dict() for w in batched.pop_windows()], expected)
+			self.assertEqual(batched.malformed, 1)
+
+
+	def test_cascade(self):
+		"""
+		Tests per-minute windows built from per-second ones and RTTs.
+		"""
+
+		minutes = rollup.Rollup(width=60.0)
+		seconds = rollup.Rollup(width=1.0, on_window=minutes.add_window)
+		p = packet.new_basic_packet(False, False, False, 1, 2, 3, b"")
+
+		for i in range(150):
+			seconds.update_packet(i, p)
+			seconds.add_rtt(i, 0.010 if i % 10 else 0.100)
+
+		seconds.flush()
+		minutes.flush()
+		windows = [w.to_dict() for w in minutes.pop_windows()]
+
+		self.assertEqual([(w["start"], w["packets"], w["bytes"]) for w in windows], [(0.0, 60, 1200), (60.0, 60, 1200), (120.0, 30, 600)])
+		self.assertAlmostEqual(windows[0]["rtt_p50"], 0.010, delta=0.0005)
+		self.assertAlmostEqual(windows[0]["rtt_p99"], 0.100, delta=0.005)
+		self.assertEqual(windows[0]["distinct_cats"], 1)
+
+
+	def test_trace_rtt(self):
+		"""
+		Tests RTT percentiles of PSN/PSE echoes in a captured trace.
+		"""
+
+		frames = []
+
+		for i in range(200):
+			ts = 10.0 + i * 0.02
+			ping = packet.new_basic_packet(False, False, False, 5, i, 1000 + i - 1, b"")
+			pong = packet.new_basic_packet(False, False, False, 5, 1000 + i, i, b"")
+			frames.append((ts, _udp_frame(ping.to_bytes())))
+			frames.append((ts + 0.01, _udp_frame(pong.to_bytes(), 5000, 4000)))
+
+		with tempfile.TemporaryDirectory() as d:
+			path = os.path.join(d, "a.pcap")
+			_write_pcap(path, frames)
+			single = rollup.Rollup(width=1.0)
+			ts = []
+			bufs = []
+
+			with pcap.PcapReader(path) as reader:
+				for record in reader:
+					payload = bytes(decap.udp_payload(reader.linktype, record.data))
+					single.update(record.ts, payload)
+					ts.append(record.ts)
+					bufs.append(payload)
+
+		batched = rollup.Rollup(width=1.0)
+		batched.update_batch(ts, batch.parse_batch(bufs))
+
+		for r in (single, batched):
+			r.flush()
+			windows = [w.to_dict() for w in r.pop_windows()]
+
+			self.assertEqual(len(windows), 4)
+			self.assertEqual(windows[0]["rtt_samples"], 99)
+			self.assertAlmostEqual(windows[0]["rtt_p50"], 0.010, delta=0.0005)
+			self.assertAlmostEqual(windows[0]["rtt_p99"], 0.010, delta=0.0005)
+
+
+	def test_reordered_rtt(self):
+		"""
+		Tests if batches take the same RTT samples as single packets when
+		timestamps are slightly out of order.
+		"""
+
+		rnd = random.Random(4)
+		packets = []
+
+		for i in range(300):
+			ts = 10.008 + i * 0.01
+			packets.append((ts, packet.new_basic_packet(False, False, False, i % 3, i, 1000 + i - 3, b"").to_bytes()))
+			packets.append((ts + 0.005, packet.new_basic_packet(False, False, False, i % 3, 1000 + i, i, b"").to_bytes()))
+
+		# Swap neighbours, taking timestamps back across window borders.
+		for i in range(0, len(packets) - 1, 2):
+			if rnd.random() < 0.5:
+				packets[i], packets[i + 1] = packets[i + 1], packets[i]
+
+		single = rollup.Rollup(width=0.1)
+
+		for ts, buf in packets:
+			single.update(ts, buf)
+
+		batched = rollup.Rollup(width=0.1)
+
+		for i in range(0, len(packets), 128):
+			part = packets[i : i + 128]
+			batched.update_batch([ts for ts, buf in part], batch.parse_batch([buf for ts, buf in part]))
+
+		results = []
+
+		for r in (single, batched):
+			r.flush()
+			results.append([w.to_dict() for w in r.pop_windows()])
+
+		self.assertEqual(results[0], results[1])
+		self.assertTrue(sum(w["rtt_samples"] for w in results[0]) > 100)
+
+
+from pluspacket import export
+
+
+class TestExport(unittest.TestCase):
+
+	def setUp(self):
+		self.packets = [
+			(1.5, packet.new_basic_packet(True, False, False, 2**64 - 1, 1, 2, b"\x00\xff")),
+			(None, packet.new_extended_packet(False, True, False, 3, 4, 5, 0x0100, 1, b"ab", b"")),
+			(2.25, packet.new_extended_packet(False, False, True, 6, 7, 8, 0xFF, None, None, b"pay"))
+		]
+
+
+	def test_json(self):
+		"""
+		Tests if JSON lines decode to the packet fields.
+		"""
+
+		f = io.StringIO()
+
+		with export.PacketExporter(f, buffer_lines=2) as exporter:
+			exporter.write_all(self.packets)
+
+		rows = [json.loads(line) for line in f.getvalue().splitlines()]
+
+		self.assertEqual(len(rows), 3)
+		self.assertEqual(exporter.count, 3)
+		self.assertEqual(rows[0], {"ts" : 1.5, "cat" : 2**64 - 1, "psn" : 1, "pse" : 2, "l" : True, "r" : False,
+			"s" : False, "x" : False, "pcf_type" : None, "pcf_integrity" : None, "pcf_value" : None, "payload" : "00ff"})
+		self.assertEqual((rows[1]["ts"], rows[1]["pcf_type"], rows[1]["pcf_value"]), (None, 0x0100, "6162"))
+		self.assertEqual((rows[2]["pcf_type"], rows[2]["pcf_value"], rows[2]["payload"]), (0xFF, None, "706179"))
+
+
+	def test_csv(self):
+		"""
+		Tests CSV output with selected fields and length/base64 encoding.
+		"""
+
+		f = io.StringIO()
+		exporter = export.PacketExporter(f, format="csv", fields=("cat", "x", "pcf_value", "payload", "length"), encoding="length")
+		exporter.write_all(self.packets)
+		exporter.flush()
+
+		self.assertEqual(f.getvalue().splitlines(), [
+			"cat,x,pcf_value_len,payload_len,length",
+			"18446744073709551615,0,,2,22",
+			"3,1,2,0,25",
+			"6,1,,3,24"])
+
+		for ts, p in self.packets:
+			self.assertEqual(export._length(p), len(p.to_bytes()))
+
+		f = io.StringIO()
+		exporter = export.PacketExporter(f, format="csv", fields=("payload",), encoding="base64")
+		exporter.write(self.packets[0][1])
+		exporter.flush()
+
+		self.assertEqual(f.getvalue(), "payload\nAP8=\n")
+		self.assertRaises(ValueError, export.PacketExporter, f, fields=("nope",))
+		self.assertRaises(ValueError, export.PacketExporter, f, format="xml")
+
+
+from pluspacket import correlate
+
+
+class TestCorrelate(unittest.TestCase):
+
+	def test_traces(self):
+		"""
+		Tests per segment delay and loss over three captures.
+		"""
+
+		delays = (0.0, 0.010, 0.030)
+		captures = [[], [], []]
+
+		for i in range(1000):
+			ts = 100.0 + i * 0.001
+			buf = packet.new_basic_packet(False, False, False, 77, i, 0, b"data").to_bytes()
+
+			# Downstream 0 -> 1 -> 2, every 10th lost after 1, every 25th missed by 1.
+			for v in range(3):
+				if v == 2 and i % 10 == 0:
+					continue
+
+				if v == 1 and i % 25 == 1:
+					continue
+
+				captures[v].append((ts + delays[v], _udp_frame(buf, 4000, 5000)))
+
+			# Upstream 2 -> 1 -> 0, same PSNs, every 20th lost after 2.
+			for v in (2, 1, 0):
+				if v < 2 and i % 20 == 0:
+					continue
+
+				captures[v].append((ts + 0.0005 + delays[2] - delays[v], _udp_frame(buf, 5000, 4000)))
+
+		with tempfile.TemporaryDirectory() as tmp:
+			paths = []
+
+			for v, frames in enumerate(captures):
+				paths.append(os.path.join(tmp, "v%d.pcap" % v))
+				_write_pcap(paths[-1], sorted(frames))
+
+			# _udp_frame always uses the same addresses, tell directions by port.
+			by_port = lambda frame, result: int(struct.unpack_from(">H", frame, result.udp_offset)[0] == 5000)
+			summary = correlate.correlate_traces(paths, window=0.5, direction=by_port).summary()
+
+		segments = summary["segments"]
+
+		self.assertEqual((segments["0->1"]["matched"], segments["0->1"]["missed"]), (960, 40))
+		self.assertEqual((segments["1->2"]["matched"], segments["1->2"]["lost"]), (860, 100))
+		self.assertAlmostEqual(segments["0->1"]["p50_delay"], 0.010, places=4)
+		self.assertAlmostEqual(segments["1->2"]["mean_delay"], 0.020, places=4)
+
+		self.assertEqual((segments["2->1"]["matched"], segments["2->1"]["lost"]), (950, 50))
+		self.assertEqual((segments["1->0"]["matched"], segments["1->0"]["lost"]), (950, 0))
+		self.assertAlmostEqual(segments["2->1"]["p99_delay"], 0.020, places=4)
+		self.assertEqual(summary["unattributed"], 0)
+
+
+	def test_bounded(self):
+		"""
+		Tests that pending packets are bounded.
+		"""
+
+		c = correlate.Correlator(2, window=10.0, max_pending=100)
+
+		for i in range(1000):
+			c.add(0, i * 0.001, 1, i, 0)
+			self.assertTrue(len(c._pending) <= 100)
+
+		c.add(1, 1.0, 1, 999, 0)
+		c.flush()
+
+		self.assertEqual(c.evicted, 900)
+		self.assertEqual((c.segments[(0, 1)].matched, c.segments[(0, 1)].lost), (1, 999))
+
+
+from pluspacket import anonymize
+
+
+class TestAnonymize(unittest.TestCase):
+
+	def test_map(self):
+		a = anonymize.CatAnonymizer(b"secret")
+		b = anonymize.CatAnonymizer(b"other")
+
+		self.assertEqual(a.map(42), a.map(42))
+		self.assertEqual(a.map(42), anonymize.CatAnonymizer("secret").map(42))
+		self.assertNotEqual(a.map(42), a.map(43))
+		self.assertNotEqual(a.map(42), b.map(42))
+
+		with self.assertRaises(ValueError):
+			anonymize.CatAnonymizer(b"")
+
+
+	def test_batch(self):
+		a = anonymize.CatAnonymizer(b"secret")
+		bufs = [
+			bytearray(packet.new_basic_packet(False, False, False, 7, 1, 2, b"0123456789").to_bytes()),
+			bytearray(packet.new_extended_packet(False, False, False, 8, 1, 2, 0xFF, None, None, b"abcdef").to_bytes()),
+			bytearray(b"not a plus packet at all")]
+
+		self.assertEqual(a.anonymize_batch(bufs, truncate=4), 2)
+		self.assertEqual(packet.get_cat(bufs[0]), a.map(7))
+		self.assertEqual(packet.parse_packet(bufs[0]).payload, b"0123")
+		self.assertEqual(packet.get_cat(bufs[1]), a.map(8))
+		self.assertEqual(packet.parse_packet(bufs[1]).payload, b"abcd")
+		self.assertEqual(bufs[2], b"not a plus packet at all")
+
+
+	def test_checksum(self):
+		a = anonymize.CatAnonymizer(b"secret")
+		enc = pcap.UdpEncapsulator(udp_checksum=True)
+
+		for cat in (0, 1, 0xFFFFFFFFFFFFFFFF, 0x123456789):
+			payload = packet.new_basic_packet(False, False, False, cat, 1, 2, b"xyz").to_bytes()
+			frame = enc.frame(payload)
+
+			self.assertTrue(a.anonymize_frame(pcap.LINKTYPE_ETHERNET, frame))
+			self.assertEqual(packet.get_cat(frame[42:]), a.map(cat))
+			self.assertEqual(frame, enc.frame(frame[42:]))
+
+		# A disabled UDP checksum stays disabled.
+		frame = bytearray(_udp_frame(packet.new_basic_packet(False, False, False, 5, 1, 2, b"").to_bytes()))
+		self.assertTrue(a.anonymize_frame(pcap.LINKTYPE_ETHERNET, frame))
+		self.assertEqual(frame[40:42], b"\x00\x00")
+		self.assertFalse(a.anonymize_frame(pcap.LINKTYPE_ETHERNET, bytearray(_udp_frame(b"nope"))))
+
+
+	def test_pcap(self):
+		a = anonymize.CatAnonymizer(b"secret")
+		frames = []
+
+		for i in range(50):
+			p = packet.new_basic_packet(False, False, False, i % 5, i, i + 1, b"payload %d" % i)
+			frames.append((1000 + i * 0.001, _udp_frame(p.to_bytes())))
+
+		frames.append((1001, _udp_frame(b"other")))
+
+		with tempfile.TemporaryDirectory() as d:
+			path = os.path.join(d, "a.pcap")
+			copy = os.path.join(d, "b.pcap")
+			_write_pcap(path, frames)
+
+			self.assertEqual(anonymize.anonymize_pcap(path, b"secret", copy, truncate=2).rewritten, 50)
+			self.assertEqual(anonymize.anonymize_pcap(path, a).rewritten, 50)
+
+			with pcap.PcapReader(path) as reader:
+				records = list(reader)
+
+			with pcap.PcapReader(copy) as reader:
+				truncated = list(reader)
+
+		self.assertEqual(len(records), 51)
+		self.assertEqual(len(truncated), 51)
+
+		for i in range(50):
+			p = packet.parse_packet(records[i].data[42:])
+			self.assertEqual(p.cat, a.map(i % 5))
+			self.assertEqual(p.psn, i)
+			self.assertEqual(p.payload, b"payload %d" % i)
+
+			p = packet.parse_packet(truncated[i].data[42:])
+			self.assertEqual(p.cat, a.map(i % 5))
+			self.assertEqual(p.payload, b"pa")
+			self.assertEqual(truncated[i].caplen, 42 + 20 + 2)
+			self.assertEqual(truncated[i].wirelen, records[i].wirelen)
+			self.assertAlmostEqual(truncated[i].ts, records[i].ts)
+
+		self.assertEqual(records[50].data[42:], b"other")
+		self.assertEqual(truncated[50].data[42:], b"other")
+
+
+	def test_fragments(self):
+		"""
+		Tests if the CAT in the first fragment of a fragmented datagram is
+		rewritten and the other fragments are passed through.
+		"""
+
+		a = anonymize.CatAnonymizer(b"secret")
+		plus = packet.new_basic_packet(False, False, False, 0x1122334455667788, 1, 2, bytes(range(200))).to_bytes()
+		udp = bytearray(struct.pack(">HHHH", 1, 2, 8 + len(plus), 0) + plus)
+
+		for ipv6, header in ((False, 34), (True, 62)):
+			# The pseudo header of _fragments: all zero addresses, :: to ::1 for IPv6.
+			struct.pack_into(">H", udp, 6, 0)
+			s = pcap._ones_sum(udp) + 17 + len(udp) + ipv6
+			struct.pack_into(">H", udp, 6, ~pcap._fold(s) & 0xFFFF)
+			frames = [bytearray(frame) for frame in _fragments(bytes(udp), 64, ipv6)]
+
+			with tempfile.TemporaryDirectory() as d:
+				path = os.path.join(d, "a.pcap")
+				copy = os.path.join(d, "b.pcap")
+				_write_pcap(path, [(1000 + i, frame) for i, frame in enumerate(frames)])
+
+				stats = anonymize.anonymize_pcap(path, a, copy)
+				self.assertEqual(stats.summary(), {"rewritten" : 1, "fragments" : 1, "passthrough" : len(frames) - 1})
+				self.assertEqual(anonymize.anonymize_pcap(path, a).fragments, 1)
+
+				for p in (path, copy):
+					with pcap.PcapReader(p) as reader:
+						datagram = b"".join(bytes(record.data[header:]) for record in reader)
+
+					self.assertEqual(packet.get_cat(datagram[8:]), a.map(0x1122334455667788))
+					self.assertEqual(datagram[28:], udp[28:])
+					self.assertEqual(pcap._fold(pcap._ones_sum(datagram) + 17 + len(datagram) + ipv6), 0xFFFF)
+
+
+from pluspacket import proxy
+
+
+class TestProxy(unittest.TestCase):
+
+	def test_loopback(self):
+		"""
+		Forwards PLUS packets and other datagrams between a client and an
+		echo server through the proxy and back.
+		"""
+
+		server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		server.bind(("127.0.0.1", 0))
+		server.settimeout(5)
+		client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		client.settimeout(5)
+		seen = []
+		stop = threading.Event()
+
+		def on_packet(direction, view, flags, cat, psn, pse):
+			seen.append((direction, len(view), cat, psn))
+
+		def echo():
+			for _ in range(11):
+				data, addr = server.recvfrom(2048)
+				server.sendto(data, addr)
+
+		with proxy.PlusProxy(("127.0.0.1", 0), server.getsockname(), batch=4, on_packet=on_packet) as p:
+			threads = [threading.Thread(target=echo), threading.Thread(target=p.serve_forever, args=(stop, 0.01))]
+
+			for t in threads:
+				t.start()
+
+			try:
+				payloads = [packet.new_basic_packet(False, False, False, 7, i, 0, b"x" * i).to_bytes() for i in range(10)]
+				payloads.append(b"not plus")
+
+				for payload in payloads:
+					client.sendto(payload, p.address)
+					self.assertEqual(client.recv(2048), payload)
+			finally:
+				stop.set()
+
+				for t in threads:
+					t.join(5)
+
+				client.close()
+				server.close()
+
+		summary = p.stats.summary()
+		self.assertEqual(summary["packets"], 22)
+		self.assertEqual(summary["plus"], 20)
+		self.assertEqual(summary["dropped"], 0)
+		self.assertTrue(0 <= summary["p50_latency"] <= summary["max_latency"])
+		self.assertEqual(p.cats, {7 : [20, 2 * sum(20 + i for i in range(10))]})
+		self.assertEqual(seen[:2], [(proxy.UPSTREAM, 20, 7, 0), (proxy.DOWNSTREAM, 20, 7, 0)])
+
+
+	def test_expiry(self):
+		"""
+		Tests if upstream sockets of idle clients are closed, and of the
+		longest idle client when there are too many.
+		"""
+
+		now = [0.0]
+		server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		server.bind(("127.0.0.1", 0))
+		server.settimeout(5)
+		clients = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(3)]
+
+		for client in clients:
+			client.bind(("127.0.0.1", 0))
+
+		def roundtrip(p, client, ts):
+			now[0] = ts
+			client.settimeout(5)
+			client.sendto(b"ping", p.address)
+			self.assertEqual(p.step(5), 1)
+			data, addr = server.recvfrom(2048)
+			server.sendto(data, addr)
+			self.assertEqual(p.step(5), 1)
+			self.assertEqual(client.recv(2048), b"ping")
+
+		try:
+			with proxy.PlusProxy(("127.0.0.1", 0), server.getsockname(), clock=lambda: now[0], idle_timeout=10.0, max_clients=2) as p:
+				addrs = []
+
+				for client, ts in zip(clients, (0.0, 5.0, 8.0)):
+					roundtrip(p, client, ts)
+					addrs.append(client.getsockname())
+
+				# The first client was evicted for the third.
+				self.assertEqual(list(p._clients), addrs[1:])
+				self.assertEqual(p.stats.expired, 1)
+
+				now[0] = 16.0
+				p.step(0)
+				self.assertEqual(list(p._clients), addrs[2:])
+
+				now[0] = 30.0
+				p.step(0)
+				self.assertEqual(list(p._clients), [])
+				self.assertEqual(p.stats.summary()["expired"], 3)
+
+				roundtrip(p, clients[0], 31.0)
+				self.assertEqual(list(p._clients), addrs[:1])
+				self.assertEqual(p.stats.packets, 8)
+		finally:
+			server.close()
+
+			for client in clients:
+				client.close()
+
+
+from pluspacket import pipeline
+
+
+def _cats_column(chunk):
+	"""
+	Process stage of TestPipeline.
+	"""
+
+	chunk.extra["cat2"] = [cat * 2 for cat in chunk.result.cat]
+
+	return chunk
+
+
+class TestPipeline(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.dir.name, "a.pcap")
+		frames = []
+
+		for i in range(300):
+			if i % 10 == 9:
+				payload = b"not a plus packet at all"
+			else:
+				payload = packet.new_basic_packet(False, False, False, i % 4, i, 0, b"x").to_bytes()
+
+			frames.append((1000 + i * 0.001, _udp_frame(payload)))
+
+		_write_pcap(self.path, frames)
+
+
+	def tearDown(self):
+		self.dir.cleanup()
+
+
+	def run_pipeline(self, workers, processes):
+		out = []
+		p = pipeline.Pipeline(pipeline.pcap_source(self.path, 16), queue_size=2)
+		p.add(pipeline.parse_chunk)
+		p.add(pipeline.Filter(lambda chunk: [cat != 3 for cat in chunk.result.cat]), workers=1)
+		p.add(_cats_column, workers=workers, processes=processes)
+		p.add(lambda chunk: out.extend(zip(chunk.ts, chunk.result.psn, chunk.extra["cat2"])), name="sink")
+
+		return p.run(), out
+
+
+	def test_stages(self):
+		expected = [(1000 + i * 0.001, i, 2 * (i % 4)) for i in range(300) if i % 10 != 9 and i % 4 != 3]
+
+		for workers, processes in ((0, False), (1, False), (3, False), (2, True)):
+			summary, out = self.run_pipeline(workers, processes)
+
+			self.assertEqual([(psn, cat2) for ts, psn, cat2 in out], [(psn, cat2) for ts, psn, cat2 in expected])
+			self.assertEqual(list(summary), ["source", "parse_chunk", "filter", "_cats_column", "sink"])
+			self.assertEqual(summary["source"]["items_out"], 300)
+			self.assertEqual(summary["parse_chunk"]["items_out"], 270)
+			self.assertEqual(summary["filter"]["items_out"], len(expected))
+			self.assertEqual(summary["_cats_column"]["chunks"], summary["source"]["chunks"])
+
+
+	def test_error(self):
+		def fail(chunk):
+			raise ValueError("boom")
+
+		for workers in (0, 1, 2):
+			p = pipeline.Pipeline(pipeline.pcap_source(self.path, 4), queue_size=1)
+			p.add(pipeline.parse_chunk, workers=1)
+			p.add(fail, workers=workers)
+
+			with self.assertRaises(ValueError):
+				p.run()
+
+
+class TestPartial(unittest.TestCase):
+
+	def test_complete(self):
+		buf = packet.new_extended_packet(True, False, False, 7, 1, 2, 0x01, 3, b"abc", b"data").to_bytes()
+		p = packet.parse_partial(buf)
+
+		self.assertEqual((p.cat, p.pcf_value, p.payload, p.payload_len, p.wire_len), (7, b"abc", b"data", 4, len(buf)))
+		self.assertEqual(p.truncated, frozenset())
+		self.assertRaises(ValueError, packet.parse_partial, buf[:-5])
+
+
+	def test_truncated(self):
+		buf = packet.new_basic_packet(False, True, False, 7, 1, 2, b"x" * 100).to_bytes()
+		p = packet.parse_partial(buf[:30], len(buf))
+
+		self.assertEqual((p.r, p.cat, p.psn, p.pse), (True, 7, 1, 2))
+		self.assertEqual((p.payload, p.payload_len), (b"x" * 10, 100))
+		self.assertEqual(p.truncated, frozenset(["payload"]))
+
+		p = packet.parse_partial(buf[:14], len(buf))
+		self.assertEqual((p.cat, p.psn, p.pse, p.payload, p.payload_len), (7, None, None, b"", 100))
+		self.assertEqual(p.truncated, frozenset(["psn", "pse", "payload"]))
+
+		self.assertRaises(ValueError, packet.parse_partial, buf[:3], len(buf))
+		self.assertRaises(ValueError, packet.parse_partial, b"\x00" * 30, 100)
+		self.assertRaises(ValueError, packet.parse_partial, buf, 50)
+
+
+	def test_extended(self):
+		buf = packet.new_extended_packet(False, False, False, 7, 1, 2, 0x0100, 1, b"v" * 10, b"data").to_bytes()
+		n = len(buf)
+
+		p = packet.parse_partial(buf[:26], n)
+		self.assertEqual((p.pcf_type, p.pcf_len, p.pcf_integrity, p.pcf_value), (0x0100, 10, 1, b"vvv"))
+		self.assertEqual((p.payload, p.payload_len), (b"", 4))
+		self.assertEqual(p.truncated, frozenset(["pcf_value", "payload"]))
+
+		p = packet.parse_partial(buf[:21], n)
+		self.assertEqual((p.pcf_type, p.payload_len), (None, None))
+		self.assertEqual(p.truncated, frozenset(["pcf_type", "pcf_len", "pcf_integrity", "pcf_value", "payload"]))
+		self.assertEqual(p.to_dict()["truncated"], ["payload", "pcf_integrity", "pcf_len", "pcf_type", "pcf_value"])
+
+		# PCF_VALUE longer than the packet on the wire.
+		self.assertRaises(ValueError, packet.parse_partial, buf[:26], 30)
+
+		buf = packet.new_extended_packet(False, False, False, 7, 1, 2, 0xFF, None, None, b"data").to_bytes()
+		p = packet.parse_partial(buf[:22], len(buf))
+		self.assertEqual((p.pcf_type, p.payload, p.payload_len), (0xFF, b"d", 4))
+
+
+	def test_snaplen(self):
+		payload = packet.new_basic_packet(False, False, False, 9, 5, 4, b"y" * 500).to_bytes()
+		frame = _udp_frame(payload)[:96]
+		result = decap.decapsulate(pcap.LINKTYPE_ETHERNET, frame)
+
+		self.assertEqual(decap.udp_payload_length(frame, result), len(payload))
+
+		p = packet.parse_partial(frame[result.payload_offset : result.payload_end], decap.udp_payload_length(frame, result))
+		self.assertEqual((p.cat, p.psn, p.pse, p.payload_len, len(p.payload)), (9, 5, 4, 500, 96 - 62))
+
+
 if __name__ == "__main__":
 	unittest.main()
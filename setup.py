@@ -1,9 +1,17 @@
-from setuptools import setup
+from setuptools import setup, Extension
 setup(
 	name="pluspacket",
 	version="0.1",
 	packages=["pluspacket"],
 
+	# Optional accelerated batch parser, pluspacket.batch falls back to
+	# pure Python if it can not be built.
+	ext_modules=[Extension("pluspacket._batch", ["pluspacket/_batch.c"], optional=True)],
+
+	entry_points={
+		"console_scripts": ["pluspacket = pluspacket.cli:main"]
+	},
+
 	author="Roman Müntener",
 	author_email="munt@zhaw.ch",
 	description="Library for parsing PLUS packets.",
@@ -11,5 +19,5 @@ setup(
 	keywords="plus parse packet",
 	url="http://github.com/FMNSSun/PyPLUSPacket",
 
-	python_requires=">= 3.5.0"
+	python_requires=">= 3.7.0"
 )